@@ -1,14 +1,18 @@
 # Merge FeatureCount count files (counts per sample) to matrix with rows genes, columns samples
 # NOTE: Needs Python version 3.5+
+import os
 import glob
 import argparse
 import gzip
 import sys
+
+from merge_quantifications import QuantificationMerger
 parser = argparse.ArgumentParser(description='Merge multiple FeatureCount count files into a matrix. Uses featureCount_directory in which files are located to make matrix name')
 parser.add_argument('featureCount_directory', help='featureCount_directory which contains gzipped feature count .txt.gz files')
 parser.add_argument('feature_type', help='Type of feature that is being processed (e.g. exon or transcript')
 parser.add_argument('gtf', help='GTF file')
 parser.add_argument('out_prefix', help='prefix of outfile')
+parser.add_argument('--threads', help='Number of threads', default=1, type=int)
 
 args = parser.parse_args()
 set_of_features = set([])
@@ -48,75 +52,48 @@ def parse_gtf(gtf, feature_type):
     return(feature_info)
 
 feature_info = None
-prev_line = None
 number_of_transcript = 0
-with gzip.open(args.out_prefix+feature_type+'.txt.gz','wt') as out:
-    x = 0
+files = [x for x in glob.iglob(featureCount_directory+'/**/*txt.gz', recursive=True)]
+print(len(files), 'files found. start processing')
+# sample_name of the sample is everything before . of the filename
+samples = [f.split('/')[-1].split('.')[0] for f in files]
+# files are parsed in parallel; every file must have the features of the first file in the same order
+with QuantificationMerger('featurecounts', files, samples, args.threads, strict_order=True,
+                          tmpdir=os.path.dirname(args.out_prefix) or '.') as merger,\
+        gzip.open(args.out_prefix+feature_type+'.txt.gz','wt') as out:
     out.write('-')
-    files = [x for x in glob.iglob(featureCount_directory+'/**/*txt.gz', recursive=True)]
-    print(len(files), 'files found. start processing')
-    for f in files:
-        number_of_transcript_written = 0
-        # open the first file to get a list of features
+    # open the first file to get a list of features
+    print(feature_type+': read first file to get a list of features')
+    sys.stdout.flush()
+    with gzip.open(files[0]) as input_file:
+        for line in input_file:
 
-        if x == 0:
-            print(feature_type+': read first file to get a list of features')
-            sys.stdout.flush()
-            with gzip.open(f) as input_file:
-                for line in input_file:
+            line = line.decode('utf-8')
+            if line.startswith('#'):
+                if 'metaExon' not in feature_type:
+                    feature_info = parse_gtf(args.gtf, feature_type)
+                continue
+            if line.startswith('Geneid'):
+                continue
+            line = line.strip().split('\t')
+            chr = line[1]
+            if not chr.startswith('chr'):
+                continue
+            list_of_features.append(line[0])
+            if 'metaExon' not in feature_type:
+                out.write('\t'+feature_info[line[1]+'_'+line[2]+'_'+line[3]]+'_'+line[1]+'_'+line[2]+'_'+line[3])
+            else:
+                out.write('\t'+line[0]+line[1]+'_'+line[2]+'_'+line[3]+'_'+line[4])
+            number_of_transcript += 1
+    out.write('\n')
+    print(feature_type+': Done')
+    sys.stdout.flush()
 
-                    line = line.decode('utf-8')
-                    if line.startswith('#'):
-                        if 'metaExon' not in feature_type:
-                            feature_info = parse_gtf(args.gtf, feature_type)
-                        continue
-                    if line.startswith('Geneid'):
-                        continue
-                    line = line.strip().split('\t')
-                    chr = line[1]
-                    if not chr.startswith('chr'):
-                        continue
-                    list_of_features.append(line[0])
-                    if 'metaExon' not in feature_type:
-                        out.write('\t'+feature_info[line[1]+'_'+line[2]+'_'+line[3]]+'_'+line[1]+'_'+line[2]+'_'+line[3])
-                    else:
-                        out.write('\t'+line[0]+line[1]+'_'+line[2]+'_'+line[3]+'_'+line[4])
-                    number_of_transcript += 1
-            out.write('\n')
-            print(feature_type+': Done')
+    def write_sample(x, columns):
+        out.write(samples[x]+''.join(['\t'+str(count) for count in columns['count'].tolist()])+'\n')
+        if (x + 1) % 100 == 0:
+            print(feature_type+': '+str(x + 1))
             sys.stdout.flush()
 
-        x += 1
-        if x % 100 == 0:
-            print(feature_type+': '+str(x))
-            sys.stdout.flush()
-        # sample_name of the sample is everything before . of the filename
-        sample_name = f.split('/')[-1].split('.')[0]
-        out.write(sample_name)
-        print(f)
-        sys.stdout.flush()
-        with gzip.open(f) as input_file:
-            input_file.readline()
-            y = 0
-            for line in input_file:
-#                if line == prev_line:
-                    # some lines are identical because of overlapping transcript, if so, skip
-#                    y += 1
-#                    continue
-                prev_line = line
-                line = line.decode('utf-8')
-                if line.startswith('#') or line.startswith('Geneid'):
-                    continue
-                line = line.strip().split('\t')
-                chr = line[1]
-                if not chr.startswith('chr'):
-                    continue
-                if line[0] != list_of_features[y]:
-                    raise RuntimeError('feature not the same. Current: '+line[0]+'. Original: '+list_of_features[y]+'. Index: '+str(y))
-                feature =  line[0]
-                count = line[6]
-                out.write('\t'+count)
-                y += 1
-                number_of_transcript_written += 1
-        out.write('\n')
+    merger.merge(['count'], callback=write_sample)
 print(feature_type+': Done')
@@ -0,0 +1,368 @@
+# Merge per-sample quantification files (kallisto, HTSeq, STAR, featureCounts) into matrices.
+# Used by merge_kallisto_counts.py, merge_htseqCount.py, merge_star_counts.py and merge_featureCounts.py,
+# and can be run directly: python merge_quantifications.py {kallisto,htseq,star} ...
+# NOTE: Needs Python version 3.5+
+#
+# Files are parsed on a process pool by a parser per tool, which returns the feature ids and typed
+# NumPy columns. Columns are aligned to one shared feature index (the features of the first file)
+# and stored per sample in memory-mapped temporary matrices (samples x features), so memory use
+# does not grow with the number of samples. kallisto transcript counts are summed per gene with one
+# bincount per sample. Each output matrix is written in one pass, in blocks of features that are
+# formatted (and gzip-compressed when the output ends with .gz) on the pool. Every file must have the
+# same features as the first file (in any order, unless strict_order is set).
+import os
+import sys
+import glob
+import gzip
+import shutil
+import tempfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def openfile(filename, mode='rt'):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    else:
+        return open(filename, mode)
+
+
+def to_numbers(values):
+    # integer column if all values are integers, float column otherwise
+    try:
+        return np.array(values, dtype=np.int64)
+    except ValueError:
+        return np.array(values, dtype=np.float64)
+
+
+def parse_kallisto(kallisto_abundance_file):
+    # transcript ids without version, estimated counts and TPM
+    transcripts = []
+    est_counts = []
+    tpm = []
+    with open(kallisto_abundance_file) as input_file:
+        input_file.readline()
+        for line in input_file:
+            line = line.strip().split('\t')
+            try:
+                est_counts.append(line[3])
+                tpm.append(line[4])
+                transcripts.append(line[0].split('.')[0])
+            except IndexError:
+                print('ERROR!! Line does not have enough value for: '+kallisto_abundance_file, flush=True)
+                print(line, flush=True)
+                raise
+    return transcripts, {'est_counts': np.array(est_counts, dtype=np.float64),
+                         'tpm': np.array(tpm, dtype=np.float64)}
+
+
+def parse_count_table(count_file):
+    # HTSeq and STAR: feature id in the first column, count in the second
+    features = []
+    counts = []
+    with open(count_file) as input_file:
+        for line in input_file:
+            line = line.strip().split('\t')
+            features.append(line[0])
+            counts.append(line[1])
+    if len(set(features)) != len(features):
+        raise RuntimeError('feature should be unique per sample: '+count_file)
+    return features, {'count': to_numbers(counts)}
+
+
+def parse_featurecounts(featurecounts_file):
+    # features on chromosomes starting with chr, and their count (column 7)
+    features = []
+    counts = []
+    with gzip.open(featurecounts_file, 'rt') as input_file:
+        for line in input_file:
+            if line.startswith('#') or line.startswith('Geneid'):
+                continue
+            line = line.strip().split('\t')
+            if not line[1].startswith('chr'):
+                continue
+            features.append(line[0])
+            counts.append(line[6])
+    return features, {'count': to_numbers(counts)}
+
+
+PARSERS = {'kallisto': parse_kallisto,
+           'htseq': parse_count_table,
+           'star': parse_count_table,
+           'featurecounts': parse_featurecounts}
+
+# set in the worker processes
+INDEX_FEATURES = None
+INDEX = None
+AGGREGATION = None
+STRICT_ORDER = False
+
+
+def init_worker(features, aggregation, strict_order):
+    global INDEX_FEATURES, INDEX, AGGREGATION, STRICT_ORDER
+    INDEX_FEATURES = features
+    INDEX = {}
+    for i, feature in enumerate(features):
+        if feature not in INDEX:
+            INDEX[feature] = i
+    AGGREGATION = aggregation
+    STRICT_ORDER = strict_order
+
+
+def parse_and_align(parser, path):
+    # parses one file and returns its columns aligned to the feature index
+    features, columns = PARSERS[parser](path)
+    aligned = {}
+    if features == INDEX_FEATURES:
+        aligned.update(columns)
+    elif STRICT_ORDER:
+        for y in range(min(len(features), len(INDEX_FEATURES))):
+            if features[y] != INDEX_FEATURES[y]:
+                raise RuntimeError('feature not the same. Current: '+features[y]+'. Original: '+INDEX_FEATURES[y]+'. Index: '+str(y))
+        raise RuntimeError('number of features not the same in '+path+': '+str(len(features))+', expected '+str(len(INDEX_FEATURES)))
+    else:
+        rows = np.array([INDEX.get(feature, -1) for feature in features], dtype=np.int64)
+        present = rows >= 0
+        if not present.all():
+            raise RuntimeError(path+': '+str(int((~present).sum()))+' features are not in the first file, e.g. '+features[int(np.argmin(present))])
+        found = np.zeros(len(INDEX_FEATURES), dtype=bool)
+        found[rows[present]] = True
+        if not found.all():
+            raise RuntimeError(path+': '+str(int((~found).sum()))+' features of the first file are missing, e.g. '+INDEX_FEATURES[int(np.argmin(found))])
+        for name, values in columns.items():
+            column = np.zeros(len(INDEX_FEATURES), dtype=values.dtype)
+            column[rows[present]] = values[present]
+            aligned[name] = column
+    if AGGREGATION is not None:
+        # sum a column over the features of a group (e.g. transcripts of a gene), in file order
+        feature_to_group, nr_groups, source, target = AGGREGATION
+        groups = np.array([feature_to_group[feature] for feature in features], dtype=np.int64)
+        keep = groups >= 0
+        aligned[target] = np.bincount(groups[keep], weights=columns[source][keep], minlength=nr_groups)
+    return aligned
+
+
+def format_block(matrix_file, dtype, shape, r0, r1, features, compress):
+    # rows [r0, r1) of a samples x features matrix as lines feature\tvalue...\n
+    matrix = np.memmap(matrix_file, dtype=dtype, mode='r', shape=shape)
+    block = np.ascontiguousarray(matrix[:, r0:r1].T).tolist()
+    del matrix
+    data = ''.join([feature+'\t'+'\t'.join(map(str, values))+'\n' for feature, values in zip(features, block)]).encode()
+    if compress:
+        return gzip.compress(data, 6)
+    return data
+
+
+class QuantificationMerger:
+
+    def __init__(self, parser, files, samples, threads=1, strict_order=False, tmpdir=None):
+        if len(files) == 0:
+            raise RuntimeError('no files to merge')
+        self.parser = parser
+        self.files = files
+        self.samples = samples
+        self.threads = max(1, int(threads))
+        self.strict_order = strict_order
+        self.aggregation = None
+        self.group_features = None
+        self.matrices = {}
+
+        # the features of the first file define the index
+        features, _ = PARSERS[parser](files[0])
+        if strict_order:
+            self.features = features
+        else:
+            self.features = list(dict.fromkeys(features))
+        self.tmpdir = tempfile.mkdtemp(dir=tmpdir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def set_aggregation(self, feature_to_group, source, target):
+        # sums column source per group into column target; groups are ordered by their first
+        # feature in the first file
+        self.group_features = list(dict.fromkeys(feature_to_group[feature] for feature in self.features))
+        group_index = {group: i for i, group in enumerate(self.group_features)}
+        feature_to_row = {feature: group_index.get(group, -1) for feature, group in feature_to_group.items()}
+        self.aggregation = (feature_to_row, len(self.group_features), source, target)
+
+    def merge(self, columns, callback=None):
+        # parses all files; the requested columns are stored in temporary matrices, or passed to
+        # callback(sample index, aligned columns) in file order when a callback is given
+        nr_samples = len(self.files)
+        executor = None
+        if self.threads > 1:
+            executor = ProcessPoolExecutor(max_workers=self.threads, initializer=init_worker,
+                                           initargs=(self.features, self.aggregation, self.strict_order))
+        else:
+            init_worker(self.features, self.aggregation, self.strict_order)
+
+        try:
+            pending = []
+            sample = 0
+            for s in range(nr_samples + 1):
+                if s < nr_samples:
+                    if executor is not None:
+                        pending.append(executor.submit(parse_and_align, self.parser, self.files[s]))
+                    else:
+                        pending.append(parse_and_align(self.parser, self.files[s]))
+                while len(pending) > 0 and (s == nr_samples or len(pending) >= 2 * self.threads):
+                    result = pending.pop(0)
+                    aligned = result.result() if executor is not None else result
+                    if callback is not None:
+                        callback(sample, aligned)
+                    else:
+                        self.store(sample, aligned, columns)
+                    sample += 1
+                    if sample % 100 == 0:
+                        print(str(sample)+' / '+str(nr_samples)+' files merged', flush=True)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        print(str(nr_samples)+' / '+str(nr_samples)+' files merged', flush=True)
+
+    def store(self, sample, aligned, columns):
+        for name in columns:
+            values = aligned[name]
+            matrix = self.matrices.get(name)
+            if matrix is None:
+                matrix = np.memmap(os.path.join(self.tmpdir, name+'.bin'), dtype=values.dtype, mode='w+',
+                                   shape=(len(self.files), len(values)))
+                self.matrices[name] = matrix
+            elif matrix.dtype != values.dtype:
+                raise RuntimeError('values of '+self.files[sample]+' are '+str(values.dtype)+', first file: '+str(matrix.dtype))
+            matrix[sample] = values
+
+    def write(self, name, outfile, features=None, blocksize=None):
+        # writes matrix name with features on the rows and samples on the columns
+        if features is None:
+            features = self.features
+        matrix = self.matrices[name]
+        matrix.flush()
+        shape = matrix.shape
+        compress = outfile.endswith('.gz')
+        if blocksize is None:
+            blocksize = max(1, 5000000 // max(1, shape[0]))
+        blocks = [(r0, min(r0 + blocksize, shape[1])) for r0 in range(0, shape[1], blocksize)]
+        executor = ProcessPoolExecutor(max_workers=self.threads) if self.threads > 1 else None
+        try:
+            with open(outfile, 'wb') as out:
+                header = ''.join(['\t'+sample for sample in self.samples])+'\n'
+                out.write(gzip.compress(header.encode(), 6) if compress else header.encode())
+                pending = []
+                for b in range(len(blocks) + 1):
+                    if b < len(blocks):
+                        r0, r1 = blocks[b]
+                        task = (matrix.filename, matrix.dtype, shape, r0, r1, features[r0:r1], compress)
+                        pending.append(executor.submit(format_block, *task) if executor is not None else format_block(*task))
+                    while len(pending) > 0 and (b == len(blocks) or len(pending) >= 2 * self.threads):
+                        result = pending.pop(0)
+                        out.write(result.result() if executor is not None else result)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        print('Output written to: '+outfile, flush=True)
+
+    def close(self):
+        # removes the temporary matrices; used as a context manager, also when merging fails
+        self.matrices = {}
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def make_outdir(outfile):
+    outdir = os.path.dirname(outfile)
+    if len(outdir) > 0:
+        os.makedirs(outdir, exist_ok=True)
+    return outdir if len(outdir) > 0 else '.'
+
+
+def read_transcript_to_gene(gtf):
+    transcript_to_gene = {}
+    print('read gtf file', flush=True)
+    with open(gtf) as input_file:
+        for line in input_file:
+            if 'transcript_id' in line:
+                info = line.split('\t')[8]
+                transcript_id = info.split('transcript_id "')[1].split('"')[0].split('.')[0]
+                gene_id = info.split('gene_id "')[1].split('"')[0]
+                transcript_to_gene[transcript_id] = gene_id
+    print('done', flush=True)
+    return transcript_to_gene
+
+
+def merge_kallisto(kallisto_base_path, gtf, outfile_geneCounts, outfile_transcriptTPMs, outfile_transcriptCounts, threads=1):
+    tmpdir = make_outdir(outfile_geneCounts)
+    make_outdir(outfile_transcriptTPMs)
+    make_outdir(outfile_transcriptCounts)
+    if not os.path.isdir(kallisto_base_path):
+        raise RuntimeError(kallisto_base_path+' does not exist')
+    transcript_to_gene = read_transcript_to_gene(gtf)
+
+    print('start search for abundance.tsv in '+ kallisto_base_path, flush=True)
+    kallisto_files = glob.glob(kallisto_base_path+'/**/abundance.tsv', recursive=True)
+    print('found',len(kallisto_files),' kallisto files', flush=True)
+    samples = [f.split('/')[-2] for f in kallisto_files]
+
+    with QuantificationMerger('kallisto', kallisto_files, samples, threads, tmpdir=tmpdir) as merger:
+        merger.set_aggregation(transcript_to_gene, 'est_counts', 'gene_est_counts')
+        print('starting',threads,'processes', flush=True)
+        merger.merge(['gene_est_counts', 'tpm', 'est_counts'])
+        print('Done reading kallisto file, start writing output matrix', flush=True)
+        merger.write('gene_est_counts', outfile_geneCounts, merger.group_features)
+        merger.write('tpm', outfile_transcriptTPMs)
+        merger.write('est_counts', outfile_transcriptCounts)
+
+
+def merge_count_tables(parser, files, sample_names, outfile, threads=1):
+    # HTSeq or STAR count tables (one per sample) to a features x samples matrix
+    if len(set(sample_names)) != len(sample_names):
+        raise RuntimeError('sample_name should be unique')
+    with QuantificationMerger(parser, files, sample_names, threads, tmpdir=make_outdir(outfile)) as merger:
+        merger.merge(['count'])
+        merger.write('count', outfile)
+
+
+def find_count_tables(base_path, suffix):
+    files = glob.glob(base_path+'/**/star/*'+suffix, recursive=True)
+    for f in files:
+        print(f)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge per-sample quantification files into a matrix.')
+    parser.add_argument('--threads', help='Number of threads', default=1, type=int)
+    subparsers = parser.add_subparsers(dest='tool')
+    kallisto = subparsers.add_parser('kallisto', help='kallisto abundance.tsv files')
+    kallisto.add_argument('kallisto_base_path', help='base path from where to search for kallisto abundance.tsv files')
+    kallisto.add_argument('gtf', help='GTF file containing mapping of transcript ID to gene ID')
+    kallisto.add_argument('outfile_geneCounts', help='output file name gene counts')
+    kallisto.add_argument('outfile_transcriptTPMs', help='output file name transcript TPMs')
+    kallisto.add_argument('outfile_transcriptCounts', help='output file name transcript counts')
+    for tool, suffix in [('htseq', '.htSeqCount.txt'), ('star', '.ReadsPerGene.out.tab')]:
+        counts = subparsers.add_parser(tool, help='*'+suffix+' files in star directories')
+        counts.add_argument('base_path', help='base path from where to search for star/*'+suffix+' files')
+        counts.add_argument('outfile', help='output file name')
+    args = parser.parse_args()
+
+    if args.tool == 'kallisto':
+        merge_kallisto(args.kallisto_base_path, args.gtf, args.outfile_geneCounts,
+                       args.outfile_transcriptTPMs, args.outfile_transcriptCounts, args.threads)
+    elif args.tool == 'htseq':
+        files = find_count_tables(args.base_path, '.htSeqCount.txt')
+        merge_count_tables('htseq', files, [f.split('/')[-1].split('.htSeqCount.txt')[0] for f in files], args.outfile, args.threads)
+    elif args.tool == 'star':
+        files = find_count_tables(args.base_path, 'ReadsPerGene.out.tab')
+        merge_count_tables('star', files, [f.split('/')[-1].split('.ReadsPerGene')[0] for f in files], args.outfile, args.threads)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,12 +5,15 @@ from time import strftime
 import os
 from pathlib import Path
 import argparse
+from pathway_matrix import build_matrix, write_outputs
 
 parser = argparse.ArgumentParser(description='Make GO matrices.')
 parser.add_argument('ordered_gene_list',
                     help='List with ordered gene IDs')
 parser.add_argument('uniprot_ID_mapping',
                     help='idmapping_selected.tab.gz from uniprot.org')
+parser.add_argument('--dense', action='store_true',
+                    help='Also write the dense matrix.txt (by default only the sparse matrix.npz is written, see pathway_matrix.py)')
 
 
 
@@ -46,7 +49,7 @@ Path("PathwayMatrix/").mkdir(parents=True, exist_ok=True)
 f = 'PathwayMatrix/'+go_date+'-goa_human_F.matrix.txt'
 c = 'PathwayMatrix/'+go_date+'-goa_human_C.matrix.txt'
 p = 'PathwayMatrix/'+go_date+'-goa_human_P.matrix.txt'
-if os.path.exists(f) and os.path.exists(c) and os.path.exists(p):
+if all(os.path.exists(x.replace('matrix.txt','matrix.npz')) and (not args.dense or os.path.exists(x)) for x in [f, c, p]):
     print('All matrices exist, done')
     exit()
 
@@ -81,26 +84,14 @@ def write_matrix(go_type, outfile):
     with open(outfile.replace('matrix.txt','terms.txt'),'w') as out:
         for go_id in gene_per_go[go_type]:
             out.write(go_id + '\t' + go_info[go_id][0] + '\t' + go_info[go_id][1] + '\n')
-    with open(args.ordered_gene_list) as input_file, open(outfile,'w') as out, open(outfile.replace('matrix.txt','genesInPathways.txt'),'w') as out2:
-        out.write(date_generated)
-        for go_term in gene_per_go[go_type]:
-            out.write('\t'+go_term)
-        out.write('\n')
-        genes_in_at_least_1_pathway = set()
-        for gene in input_file:
-            gene = gene.strip()
-            out.write(gene)
-            for go_term in gene_per_go[go_type]:
-                if gene in gene_per_go[go_type][go_term]:
-                    out.write('\t1.0')
-                    genes_in_at_least_1_pathway.add(gene)
-                else:
-                    out.write('\t0.0')
-            out.write('\n')
-
-        for gene in genes_in_at_least_1_pathway:
-            out2.write(gene+'\n')
-    print('outfile written to',outfile)
+    with open(args.ordered_gene_list) as input_file:
+        genes = [gene.strip() for gene in input_file]
+    go_ids = list(gene_per_go[go_type])
+    matrix = build_matrix(genes, gene_per_go[go_type].items(),
+                          term_urls=[go_info[go_id][0] for go_id in go_ids],
+                          term_names=[go_info[go_id][1] for go_id in go_ids],
+                          header=date_generated, values=('1.0', '0.0'))
+    write_outputs(matrix, outfile, dense=args.dense)
 write_matrix('F', f)
 write_matrix('P', p)
 write_matrix('C', c)
@@ -5,12 +5,15 @@ import os
 from pathlib import Path
 import gzip
 import argparse
+from pathway_matrix import build_matrix, write_outputs
 
 parser = argparse.ArgumentParser(description='Make HPO matrix.')
 parser.add_argument('ordered_gene_list',
                     help='List with ordered gene IDs')
 parser.add_argument('ncbi_to_ensembl_file',
                     help='Gzipped file with in first column ensembl IDs, second column NCBI IDs')
+parser.add_argument('--dense', action='store_true',
+                    help='Also write the dense matrix.txt (by default only the sparse matrix.npz is written, see pathway_matrix.py)')
 args = parser.parse_args()
 Path("PathwayMatrix/").mkdir(parents=True, exist_ok=True)
 
@@ -35,6 +38,7 @@ if not os.path.exists(input_file_name):
 outfile = 'PathwayMatrix/'+input_file_name.replace('.txt.gz','')+'.matrix.txt'
 
 pathway_genes = {}
+pathway_info = {}
 pathways = set([])
 print('Start reading '+input_file_name)
 mapped = 0
@@ -53,10 +57,10 @@ with gzip.open(input_file_name,'rt') as input_file, open(outfile.replace('matrix
         else:
             not_mapped += 1
         if pathway not in pathways:
-            out.write(pathway+'\thttp://www.human-phenotype-ontology.org/hpoweb/showterm?id='+pathway+'\t'+line[1]+'\n')
+            pathway_info[pathway] = ['http://www.human-phenotype-ontology.org/hpoweb/showterm?id='+pathway, line[1]]
+            out.write(pathway+'\t'+pathway_info[pathway][0]+'\t'+pathway_info[pathway][1]+'\n')
         pathways.add(pathway)
-        
-exit()
+
 print('Could not map ID',not_mapped,'times')
 print('Could map ID',mapped,'times')
 
@@ -64,23 +68,10 @@ print('done')
 
 pathways = sorted(pathways)
 print('start writing matrix')
-with open(args.ordered_gene_list) as input_file, open(outfile,'w') as out, open(outfile.replace('matrix.txt','genesInPathways.txt'),'w') as out2:
-    out.write(today)
-    for pathway in pathways:
-        out.write('\t'+pathway)
-    out.write('\n')
-    gene_in_atleast_1_hpo = set([])
-    for gene in input_file:
-        gene = gene.strip()
-        out.write(gene)
-        for pathway in pathways:
-            out.write('\t')
-            if gene in pathway_genes[pathway]:
-                out.write('1')
-                gene_in_atleast_1_hpo.add(gene)
-            else:
-                out.write('0')
-        out.write('\n')
-    for gene in gene_in_atleast_1_hpo:
-        out2.write(gene+'\n')
-print('Output written to '+outfile)
+with open(args.ordered_gene_list) as input_file:
+    genes = [gene.strip() for gene in input_file]
+matrix = build_matrix(genes, [(pathway, pathway_genes[pathway]) for pathway in pathways],
+                      term_urls=[pathway_info[pathway][0] for pathway in pathways],
+                      term_names=[pathway_info[pathway][1] for pathway in pathways],
+                      header=today)
+write_outputs(matrix, outfile, dense=args.dense)
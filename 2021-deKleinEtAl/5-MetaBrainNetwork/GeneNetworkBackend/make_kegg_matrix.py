@@ -5,6 +5,7 @@ import os
 from pathlib import Path
 import gzip
 import argparse
+from pathway_matrix import build_matrix, write_outputs
 
 parser = argparse.ArgumentParser(description='Make KEGG matrix.')
 parser.add_argument('ordered_gene_list',
@@ -13,6 +14,8 @@ parser.add_argument('kegg_version',
                     help='Kegg version to use (e.g.: 7.0)')
 parser.add_argument('ncbi_to_ensembl_file',
                     help='Gzipped file with in first column ensembl IDs, second column NCBI IDs')
+parser.add_argument('--dense', action='store_true',
+                    help='Also write the dense matrix.txt (by default only the sparse matrix.npz is written, see pathway_matrix.py)')
 args = parser.parse_args()
 Path("PathwayMatrix/").mkdir(parents=True, exist_ok=True)
 
@@ -36,6 +39,7 @@ if not os.path.exists(input_file):
     os.remove(input_file.rstrip('.gz'))
 
 pathway_genes = {}
+pathway_info = {}
 pathways = set([])
 outfile = 'PathwayMatrix/'+today+'-c2.cp.kegg.v'+args.kegg_version+'.matrix.txt'
 
@@ -44,7 +48,8 @@ with  gzip.open(input_file,'rt') as input_file, open(outfile.replace('matrix.txt
     for line in input_file:
         line = line.strip().split('\t')
         pathway = line[0] #' '.join(line[0].replace('KEGG_','').lower().split('_')).capitalize()
-        out.write(pathway+'\t'+line[1]+'\t'+' '.join(pathway.lower().replace('kegg_','').split('_')).capitalize()+'\n')
+        pathway_info[pathway] = [line[1], ' '.join(pathway.lower().replace('kegg_','').split('_')).capitalize()]
+        out.write(pathway+'\t'+pathway_info[pathway][0]+'\t'+pathway_info[pathway][1]+'\n')
         ncbi_genes = line[2:]
         pathway_genes[pathway] = set([ncbi_to_ensembl[x] for x in ncbi_genes if x in ncbi_to_ensembl])
         pathways.add(pathway)
@@ -52,23 +57,10 @@ print('done')
 
 pathways = sorted(pathways)
 print('start writing matrix')
-with open(args.ordered_gene_list) as input_file, open(outfile,'w') as out, open(outfile.replace('matrix.txt','genesInPathways.txt'),'w') as out2:
-    out.write(today)
-    for pathway in pathways:
-        out.write('\t'+pathway)
-    out.write('\n')
-    gene_in_at_least_1_kegg = set([])
-    for gene in input_file:
-        gene = gene.strip()
-        out.write(gene)
-        for pathway in pathways:
-            out.write('\t')
-            if gene in pathway_genes[pathway]:
-                out.write('1')
-                gene_in_at_least_1_kegg.add(gene)
-            else:
-                out.write('0')
-        out.write('\n')
-    for gene in gene_in_at_least_1_kegg:
-        out2.write(gene+'\n')
-print('Output written to '+outfile)
+with open(args.ordered_gene_list) as input_file:
+    genes = [gene.strip() for gene in input_file]
+matrix = build_matrix(genes, [(pathway, pathway_genes[pathway]) for pathway in pathways],
+                      term_urls=[pathway_info[pathway][0] for pathway in pathways],
+                      term_names=[pathway_info[pathway][1] for pathway in pathways],
+                      header=today)
+write_outputs(matrix, outfile, dense=args.dense)
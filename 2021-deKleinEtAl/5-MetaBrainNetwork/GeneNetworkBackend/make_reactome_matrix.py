@@ -5,10 +5,13 @@ import os
 from pathlib import Path
 import gzip
 import argparse
+from pathway_matrix import build_matrix, write_outputs
 
 parser = argparse.ArgumentParser(description='Make REACTOME matrix.')
 parser.add_argument('ordered_gene_list',
                     help='List with ordered gene IDs')
+parser.add_argument('--dense', action='store_true',
+                    help='Also write the dense matrix.txt (by default only the sparse matrix.npz is written, see pathway_matrix.py)')
 args = parser.parse_args()
 Path("PathwayMatrix/").mkdir(parents=True, exist_ok=True)
 
@@ -26,6 +29,7 @@ if not os.path.exists(input_file):
 
 
 pathway_genes = {}
+pathway_info = {}
 pathways = set([])
 outfile = 'PathwayMatrix/'+today+'-Ensembl2Reactome_All_Levels.matrix.txt'
 
@@ -38,33 +42,20 @@ with  gzip.open(input_file,'rt') as input_file, open(outfile.replace('matrix.txt
         ensembl_id = line[0]
         pathway = line[1]
         if pathway not in pathways:
-            out.write(pathway+'\t'+line[2]+'\t'+line[3]+'\n')
+            pathway_info[pathway] = [line[2], line[3]]
+            out.write(pathway+'\t'+pathway_info[pathway][0]+'\t'+pathway_info[pathway][1]+'\n')
         if pathway not in pathway_genes:
             pathway_genes[pathway] = set([])
         pathway_genes[pathway].add(ensembl_id)
         pathways.add(pathway)
-exit()
 print('done')
 
 pathways = sorted(pathways)
 print('start writing matrix')
-with open(args.ordered_gene_list) as input_file, open(outfile,'w') as out, open(outfile.replace('matrix.txt','genesInPathways.txt'),'w') as out2:
-    out.write(today)
-    for pathway in pathways:
-        out.write('\t'+pathway)
-    out.write('\n')
-    gene_in_atleast_1_reactome = set([])
-    for gene in input_file:
-        gene = gene.strip()
-        out.write(gene)
-        for pathway in pathways:
-            out.write('\t')
-            if gene in pathway_genes[pathway]:
-                out.write('1')
-                gene_in_atleast_1_reactome.add(gene)
-            else:
-                out.write('0')
-        out.write('\n')
-    for gene in gene_in_atleast_1_reactome:
-        out2.write(gene+'\n')
-print('Output written to '+outfile)
+with open(args.ordered_gene_list) as input_file:
+    genes = [gene.strip() for gene in input_file]
+matrix = build_matrix(genes, [(pathway, pathway_genes[pathway]) for pathway in pathways],
+                      term_urls=[pathway_info[pathway][0] for pathway in pathways],
+                      term_names=[pathway_info[pathway][1] for pathway in pathways],
+                      header=today)
+write_outputs(matrix, outfile, dense=args.dense)
@@ -0,0 +1,179 @@
+import gzip
+import argparse
+import numpy as np
+
+# Sparse gene x term membership matrices. A matrix is stored as <name>.matrix.npz with
+#   indptr, indices     CSR structure: the term (column) indices of gene (row) i are
+#                       indices[indptr[i]:indptr[i+1]], sorted
+#   genes               row names, in the order of the ordered gene list
+#   terms               column names
+#   term_urls, term_names  term metadata, in column order
+#   header              first cell of the header line of the dense matrix (e.g. the GO date)
+#   values              the (one, zero) strings written for members and non-members in the dense matrix
+# The dense text matrix that GeneNetworkBackend reads can be written from this with
+#   python pathway_matrix.py <name>.matrix.npz <name>.matrix.txt [--genes eigenvectors.txt]
+
+
+class PathwayMatrix():
+    def __init__(self, indptr, indices, genes, terms, term_urls=None, term_names=None, header='', values=('1', '0')):
+        self.indptr = indptr
+        self.indices = indices
+        self.genes = list(genes)
+        self.terms = list(terms)
+        self.term_urls = list(term_urls) if term_urls is not None else ['']*len(self.terms)
+        self.term_names = list(term_names) if term_names is not None else ['']*len(self.terms)
+        self.header = header
+        self.values = tuple(values)
+
+    @property
+    def shape(self):
+        return len(self.genes), len(self.terms)
+
+    def row(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def gene_sizes(self):
+        '''Number of terms per gene'''
+        return np.diff(self.indptr)
+
+    def term_sizes(self):
+        '''Number of genes per term'''
+        return np.bincount(self.indices, minlength=len(self.terms))
+
+    def genes_in_pathways(self):
+        '''Genes that are in at least one term, in row order, without duplicates'''
+        sizes = self.gene_sizes()
+        seen = set()
+        genes = []
+        for i in np.flatnonzero(sizes):
+            if self.genes[i] not in seen:
+                seen.add(self.genes[i])
+                genes.append(self.genes[i])
+        return genes
+
+    def to_scipy(self):
+        from scipy.sparse import csr_matrix
+        return csr_matrix((np.ones(len(self.indices), dtype=np.int8), self.indices, self.indptr), shape=self.shape)
+
+
+def build_matrix(genes, term_genes, **metadata):
+    '''Gene x term matrix with the genes (ordered gene list) as rows and the terms of term_genes, a list of
+    (term, set of genes) in column order, as columns. Genes that are not in the gene list are left out.'''
+    gene_rows = {}
+    for i, gene in enumerate(genes):
+        if gene not in gene_rows:
+            gene_rows[gene] = []
+        gene_rows[gene].append(i)
+    terms = []
+    rows = []
+    cols = []
+    for j, (term, members) in enumerate(term_genes):
+        terms.append(term)
+        for gene in members:
+            for i in gene_rows.get(gene, ()):
+                rows.append(i)
+                cols.append(j)
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(cols, dtype=np.int32)
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(len(genes)+1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(genes)), out=indptr[1:])
+    return PathwayMatrix(indptr, cols[order], genes, terms, **metadata)
+
+
+def save_matrix(matrix, outfile):
+    np.savez_compressed(outfile,
+                        indptr=matrix.indptr,
+                        indices=matrix.indices,
+                        genes=np.array(matrix.genes, dtype=str),
+                        terms=np.array(matrix.terms, dtype=str),
+                        term_urls=np.array(matrix.term_urls, dtype=str),
+                        term_names=np.array(matrix.term_names, dtype=str),
+                        header=np.array(matrix.header, dtype=str),
+                        values=np.array(matrix.values, dtype=str))
+
+
+def load_matrix(infile):
+    with np.load(infile, allow_pickle=False) as data:
+        return PathwayMatrix(data['indptr'], data['indices'], data['genes'].tolist(), data['terms'].tolist(),
+                             term_urls=data['term_urls'].tolist(), term_names=data['term_names'].tolist(),
+                             header=str(data['header']), values=tuple(data['values'].tolist()))
+
+
+def open_out(outfile):
+    if outfile.endswith('.gz'):
+        return gzip.open(outfile, 'wb')
+    return open(outfile, 'wb')
+
+
+def write_dense(matrix, outfile, genes=None):
+    '''Writes the dense tab separated matrix, one row at a time: header line with the terms, then per gene
+    the gene name and the one/zero value of every term. With genes, only the rows of those genes are
+    written, in that order (genes that are not in the matrix are skipped).'''
+    one, zero = matrix.values
+    if len(one) != len(zero):
+        raise ValueError('Values '+one+' and '+zero+' should have the same length')
+    nterms = len(matrix.terms)
+    width = len(zero.encode())+1
+    # a row of \t<zero> cells; the member cells are set to \t<one> and reset after writing the row
+    line = np.frombuffer((('\t'+zero)*nterms).encode(), dtype=np.uint8).copy()
+    row = line.reshape(nterms, width)
+    one_cell = np.frombuffer(('\t'+one).encode(), dtype=np.uint8)
+    zero_cell = np.frombuffer(('\t'+zero).encode(), dtype=np.uint8)
+    if genes is None:
+        rows = range(len(matrix.genes))
+    else:
+        gene_index = {}
+        for i, gene in enumerate(matrix.genes):
+            gene_index.setdefault(gene, i)
+        rows = [gene_index[gene] for gene in genes if gene in gene_index]
+    with open_out(outfile) as out:
+        out.write((matrix.header+''.join('\t'+term for term in matrix.terms)+'\n').encode())
+        for i in rows:
+            cols = matrix.row(i)
+            row[cols] = one_cell
+            out.write(matrix.genes[i].encode())
+            out.write(line.data)
+            out.write(b'\n')
+            row[cols] = zero_cell
+    return len(rows)
+
+
+def write_genes_in_pathways(matrix, outfile):
+    with open(outfile, 'w') as out:
+        for gene in matrix.genes_in_pathways():
+            out.write(gene+'\n')
+
+
+def write_outputs(matrix, outfile, dense=False):
+    '''Writes <name>.matrix.npz and <name>.genesInPathways.txt for outfile <name>.matrix.txt, and the dense
+    <name>.matrix.txt itself when dense is set'''
+    save_matrix(matrix, outfile.replace('matrix.txt', 'matrix.npz'))
+    write_genes_in_pathways(matrix, outfile.replace('matrix.txt', 'genesInPathways.txt'))
+    if dense:
+        write_dense(matrix, outfile)
+    print('Output written to '+outfile.replace('matrix.txt', 'matrix.npz'))
+
+
+def read_genes(genes_file):
+    '''First column of a (tab separated) file'''
+    with open(genes_file) as input_file:
+        return [line.rstrip('\n').split('\t')[0] for line in input_file]
+
+
+def command_line():
+    parser = argparse.ArgumentParser(description='Write the dense text matrix of a sparse pathway matrix (.matrix.npz).')
+    parser.add_argument('matrix', help='.matrix.npz file')
+    parser.add_argument('outfile', help='Dense matrix to write (gzipped when it ends with .gz)')
+    parser.add_argument('--genes',
+                        help='''File with the genes in the first column (e.g. the eigenvector file): only write the rows of
+                        these genes, in the order of this file''')
+    args = parser.parse_args()
+    matrix = load_matrix(args.matrix)
+    genes = read_genes(args.genes) if args.genes else None
+    nrows = write_dense(matrix, args.outfile, genes)
+    print(str(nrows)+' genes x '+str(len(matrix.terms))+' terms written to '+args.outfile)
+
+
+if __name__ == '__main__':
+    command_line()
@@ -2,8 +2,9 @@ from termcolor import colored
 from scipy.stats import t
 from scipy.stats import norm
 import math
-import re
+import os
 import sqlite3
+import numpy as np
 import argparse
 from beautifultable import BeautifulTable
 from datetime import datetime
@@ -42,19 +43,34 @@ class GetCoreg():
         return self
 
     def __init__(self, db_location):
-        # Connection the the database
-        self.conn = sqlite3.connect(db_location)
-        self.c = self.conn.cursor()
+        # db_location is either a sqlite database or a binary coreg store directory (see coreg_store)
+        self.store = None
+        self.conn = None
+        if os.path.isdir(db_location):
+            from .coreg_store import CoregStore
+            self.store = CoregStore(db_location)
+        else:
+            # Connection the the database
+            self.conn = sqlite3.connect(db_location)
+            self.c = self.conn.cursor()
 
-    def get_coreg(self,gene1, gene2, regions=['all','amyg','basal','cerebellum',
-                                         'cortex','hippocampus','hypothalamus',
-                                         'spinal']):
+    def check_regions(self, regions):
         allowed_regions = set(['all','amyg','basal','cerebellum',
                                          'cortex','hippocampus','hypothalamus',
                                          'spinal'])
         for e in regions:
             if e not in allowed_regions:
                 raise RuntimeError('regions included "'+e+'". Regions can only include: '+','.join(allowed_regions))
+
+    def get_coreg(self,gene1, gene2, regions=['all','amyg','basal','cerebellum',
+                                         'cortex','hippocampus','hypothalamus',
+                                         'spinal']):
+        self.check_regions(regions)
+        if self.store is not None:
+            correlations = self.store.get_pairs([gene1], [gene2], regions)[:, 0]
+            if np.isnan(correlations).all():
+                raise RuntimeError('Gene pair '+gene1+' + '+gene2+' not in database')
+            return(tuple(None if math.isnan(c) else float(c) for c in correlations))
         gene_pair = (shortenENSG(gene1)+'_'+shortenENSG(gene2),)
         co_regions_names = 'cor_'+',cor_'.join(regions)
         self.c.execute("SELECT "+co_regions_names+" FROM correlations where gene_pair=?", 
@@ -71,7 +87,55 @@ class GetCoreg():
         return(row)
 
     def __exit__(self, type, value, traceback):
-        self.conn.close()
+        if self.conn is not None:
+            self.conn.close()
+        if self.store is not None:
+            self.store.close()
+
+    def get_coreg_batch(self, genes1, genes2, regions=['all','amyg','basal','cerebellum',
+                                         'cortex','hippocampus','hypothalamus',
+                                         'spinal']):
+        '''Correlations of the gene pairs (genes1[i], genes2[i]): array of regions x pairs. Unlike get_coreg,
+        pairs that are not in the database do not raise an error but are NaN (with both backends)'''
+        self.check_regions(regions)
+        if self.store is not None:
+            return(self.store.get_pairs(genes1, genes2, regions).astype(np.float64))
+        # sqlite: one query per pair
+        correlations = np.empty((len(regions), len(genes1)))
+        for i in range(len(genes1)):
+            try:
+                row = self.get_coreg(genes1[i], genes2[i], regions)
+            except RuntimeError:
+                correlations[:, i] = np.nan
+                continue
+            correlations[:, i] = [np.nan if c is None else c for c in row]
+        return(correlations)
+
+    def get_coreg_vs_all(self, gene, regions=['all','amyg','basal','cerebellum',
+                                         'cortex','hippocampus','hypothalamus',
+                                         'spinal']):
+        '''Correlations of a gene with all other genes: (gene keys, array of regions x genes). Needs a coreg store'''
+        self.check_regions(regions)
+        if self.store is None:
+            raise RuntimeError('Querying a gene against all genes needs a coreg store, see coreg_store.py to convert the database')
+        return(self.store.genes, self.store.get_gene_vs_all(gene, regions).astype(np.float64))
+
+    def get_coreg_and_zScores_batch(self, genes1, genes2, regions=['all','amyg','basal','cerebellum',
+                                         'cortex','hippocampus','hypothalamus',
+                                         'spinal']):
+        '''Vectorised get_coreg_and_zScores for lists of gene pairs; all values are arrays of regions x pairs, NaN
+        for pairs that are not in the database'''
+        coreg_scores = self.get_coreg_batch(genes1, genes2, regions)
+        pvalues, pvalues_bonf, zscores = coregStatistics(coreg_scores, regions)
+        return(coreg_scores, pvalues, pvalues_bonf, zscores, regions)
+
+    def get_coreg_and_zScores_vs_all(self, gene, regions=['all','amyg','basal','cerebellum',
+                                         'cortex','hippocampus','hypothalamus',
+                                         'spinal']):
+        '''get_coreg_and_zScores of a gene against all genes; returns the gene keys and arrays of regions x genes'''
+        genes, coreg_scores = self.get_coreg_vs_all(gene, regions)
+        pvalues, pvalues_bonf, zscores = coregStatistics(coreg_scores, regions)
+        return(genes, coreg_scores, pvalues, pvalues_bonf, zscores, regions)
 
     def get_coreg_and_zScores(self,gene1, gene2, regions=['all','amyg','basal','cerebellum',
                                          'cortex','hippocampus','hypothalamus',
@@ -116,6 +180,28 @@ def correlationToZ(correlation, nrSamples):
         z_score = -norm.ppf(p_value)
     return p_value,z_score
 
+def correlationsToZ(correlations, nrSamples):
+    '''Vectorised correlationToZ: p-values and z-scores of an array of correlations'''
+    correlations = np.asarray(correlations, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_val = correlations / np.sqrt((1.0 - correlations * correlations) / (nrSamples - 2))
+    # *2 because .cdf is two-tailed, but this is 1-tailed test
+    p_value = t.cdf(-np.abs(t_val), nrSamples-2) * 2
+    p_value = np.maximum(p_value, 2.0e-323)
+    z_score = norm.ppf(p_value)
+    z_score = np.where(t_val < 0.0, z_score, -z_score)
+    return p_value, z_score
+
+def coregStatistics(coreg_scores, regions):
+    '''p-values, Bonferroni corrected p-values and z-scores of a regions x genes array of correlations'''
+    pvalues = np.empty(coreg_scores.shape)
+    zscores = np.empty(coreg_scores.shape)
+    pvalues_bonf = np.empty(coreg_scores.shape)
+    for index, region in enumerate(regions):
+        pvalues[index], zscores[index] = correlationsToZ(coreg_scores[index], n_PCs[region])
+        pvalues_bonf[index] = np.minimum(pvalues[index] * n_tests[region], 1)
+    return pvalues, pvalues_bonf, zscores
+
 def shortenENSG(string):
     '''Function to replace all leading
        zeros from a a given string
@@ -124,13 +210,12 @@ def shortenENSG(string):
     '''
     if string.startswith('ENSG'):
         string = string.replace('ENSG','')
-    nzeros = len(string) - len(string.lstrip('0'))
-    # Regex to remove leading
-    # zeros from a string
-    regex = "^0+(?!$)"
-    # Replaces the matched
-    # value with given string
-    string = str(nzeros) + re.sub(regex, "", string)
+    stripped = string.lstrip('0')
+    nzeros = len(string) - len(stripped)
+    # keep one zero when the string is only zeros
+    if stripped == '' and string != '':
+        stripped = '0'
+    string = str(nzeros) + stripped
     return(string)
 
 
@@ -141,7 +226,7 @@ def command_line():
     parser = argparse.ArgumentParser(description='Select correlation between two genes.')
     parser.add_argument('gene1', help='1st gene in pair')
     parser.add_argument('gene2', help='2nd  gene in pair')
-    parser.add_argument('db_location', help='database location')
+    parser.add_argument('db_location', help='database location (sqlite database or coreg store directory)')
     parser.add_argument('--regions', help='comma separated regions to select',
                         default='all,amyg,basal,cerebellum,'+
                                  'cortex,hippocampus,hypothalamus,'+
@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import argparse
+import numpy as np
+
+from .coreg_selector import shortenENSG
+
+# Binary co-regulation store: a directory with
+#   genes.txt          gene keys (shortenENSG form, as the gene_pair keys of the sqlite database)
+#   <region>.npy       float32 upper triangle (including the diagonal) of the gene x gene matrix of a
+#                      region, row by row; NaN for pairs that are not in the region
+# The .npy files are opened memory-mapped, so a query only reads the values it needs. The value of
+# genes i <= j is at row_start[i] + (j - i), with row_start[i] = i * n - i * (i - 1) / 2.
+
+
+class CoregStore():
+    def __enter__(self):
+        return self
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'genes.txt')) as input_file:
+            self.genes = [line.rstrip('\n') for line in input_file]
+        self.gene_index = {gene: index for index, gene in enumerate(self.genes)}
+        n = len(self.genes)
+        rows = np.arange(n, dtype=np.int64)
+        self.row_start = rows * n - rows * (rows - 1) // 2
+        self.matrices = {}
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.matrices = {}
+
+    def regions(self):
+        return sorted(f[:-len('.npy')] for f in os.listdir(self.store_dir) if f.endswith('.npy'))
+
+    def matrix(self, region):
+        if region not in self.matrices:
+            path = os.path.join(self.store_dir, region+'.npy')
+            if not os.path.exists(path):
+                raise RuntimeError('Region '+region+' not in coreg store '+self.store_dir)
+            self.matrices[region] = np.load(path, mmap_mode='r')
+        return self.matrices[region]
+
+    def indices(self, genes, missing=False):
+        '''Index of each gene in the store; raises for genes that are not in the store, or with missing
+        gives them index -1'''
+        indices = np.empty(len(genes), dtype=np.int64)
+        for i, gene in enumerate(genes):
+            index = self.gene_index.get(shortenENSG(gene))
+            if index is None:
+                if not missing:
+                    raise RuntimeError('Gene '+gene+' not in coreg store')
+                index = -1
+            indices[i] = index
+        return indices
+
+    def offsets(self, indices1, indices2):
+        low = np.minimum(indices1, indices2)
+        high = np.maximum(indices1, indices2)
+        return self.row_start[low] + (high - low)
+
+    def get_pairs(self, genes1, genes2, regions):
+        '''Correlations of the gene pairs (genes1[i], genes2[i]) per region: regions x pairs; NaN for pairs
+        with a gene that is not in the store'''
+        if len(genes1) != len(genes2):
+            raise RuntimeError('genes1 and genes2 should have the same length')
+        indices1 = self.indices(genes1, missing=True)
+        indices2 = self.indices(genes2, missing=True)
+        found = np.flatnonzero((indices1 >= 0) & (indices2 >= 0))
+        offsets = self.offsets(indices1[found], indices2[found])
+        # reading the memmap in file order
+        order = found[np.argsort(offsets, kind='stable')]
+        offsets = np.sort(offsets, kind='stable')
+        correlations = np.full((len(regions), len(genes1)), np.nan, dtype=np.float32)
+        for r, region in enumerate(regions):
+            correlations[r, order] = self.matrix(region)[offsets]
+        return correlations
+
+    def get_gene_vs_all(self, gene, regions):
+        '''Correlations of one gene with all genes of the store (in the order of self.genes): regions x genes'''
+        index = self.indices([gene])[0]
+        n = len(self.genes)
+        # column part (genes before index), then the contiguous row part (index onwards)
+        before = self.row_start[:index] + (index - np.arange(index, dtype=np.int64))
+        correlations = np.empty((len(regions), n), dtype=np.float32)
+        for r, region in enumerate(regions):
+            matrix = self.matrix(region)
+            correlations[r, :index] = matrix[before]
+            correlations[r, index:] = matrix[self.row_start[index]:self.row_start[index] + (n - index)]
+        return correlations
+
+
+def create_store(store_dir, genes):
+    '''Creates a store directory for the given genes (ENSG ids or shortened keys)'''
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, 'genes.txt'), 'w') as out:
+        for gene in genes:
+            out.write(shortenENSG(gene)+'\n' if gene.startswith('ENSG') else gene+'\n')
+
+
+def open_region(store_dir, region, n_genes):
+    '''Writable upper triangle of a region, all NaN'''
+    matrix = np.lib.format.open_memmap(os.path.join(store_dir, region+'.npy'), mode='w+',
+                                       dtype=np.float32, shape=(n_genes * (n_genes + 1) // 2,))
+    matrix[:] = np.nan
+    return matrix
+
+
+def write_region(store_dir, region, matrix, blocksize=1000):
+    '''Writes the upper triangle of a square gene x gene matrix (e.g. a memmap), in the gene order of the store'''
+    n = matrix.shape[0]
+    out = np.lib.format.open_memmap(os.path.join(store_dir, region+'.npy'), mode='w+',
+                                    dtype=np.float32, shape=(n * (n + 1) // 2,))
+    offset = 0
+    for r0 in range(0, n, blocksize):
+        block = np.asarray(matrix[r0:min(r0 + blocksize, n)], dtype=np.float32)
+        for i in range(block.shape[0]):
+            row = block[i, r0 + i:]
+            out[offset:offset + len(row)] = row
+            offset += len(row)
+    out.flush()
+
+
+def convert_sqlite(db_location, store_dir, regions, batchsize=1000000):
+    '''Converts the correlations table of a coreg sqlite database to a store'''
+    conn = sqlite3.connect(db_location)
+    c = conn.cursor()
+    print('Reading gene pairs')
+    gene_index = {}
+    c.execute('SELECT gene_pair FROM correlations')
+    while True:
+        rows = c.fetchmany(batchsize)
+        if not rows:
+            break
+        for (gene_pair,) in rows:
+            for gene in gene_pair.split('_'):
+                if gene not in gene_index:
+                    gene_index[gene] = len(gene_index)
+    genes = list(gene_index.keys())
+    print(str(len(genes))+' genes')
+    create_store(store_dir, genes)
+    n = len(genes)
+    rows = np.arange(n, dtype=np.int64)
+    row_start = rows * n - rows * (rows - 1) // 2
+    matrices = [open_region(store_dir, region, n) for region in regions]
+
+    print('Reading correlations')
+    c.execute('SELECT gene_pair, cor_'+', cor_'.join(regions)+' FROM correlations')
+    nr_pairs = 0
+    while True:
+        rows = c.fetchmany(batchsize)
+        if not rows:
+            break
+        indices = np.array([[gene_index[gene] for gene in row[0].split('_')] for row in rows], dtype=np.int64)
+        low = indices.min(axis=1)
+        offsets = row_start[low] + (indices.max(axis=1) - low)
+        values = np.array([row[1:] for row in rows], dtype=np.float64)
+        for r in range(len(regions)):
+            matrices[r][offsets] = values[:, r]
+        nr_pairs += len(rows)
+        print(str(nr_pairs)+' gene pairs', end='\r', flush=True)
+    print('')
+    for matrix in matrices:
+        matrix.flush()
+    conn.close()
+
+
+def command_line():
+    parser = argparse.ArgumentParser(description='Convert a coreg sqlite database to a binary coreg store.')
+    parser.add_argument('db_location', help='database location')
+    parser.add_argument('store_dir', help='store directory to write')
+    parser.add_argument('--regions', help='comma separated regions to convert',
+                        default='all,amyg,basal,cerebellum,'+
+                                 'cortex,hippocampus,hypothalamus,'+
+                                 'spinal')
+    args = parser.parse_args()
+    convert_sqlite(args.db_location, args.store_dir, args.regions.split(','))
+
+
+if __name__ == "__main__":
+    command_line()
@@ -1,7 +1,10 @@
 import gzip
 import argparse
+import hashlib
 import os
 
+import numpy as np
+
 parser = argparse.ArgumentParser(description='Remove genes from expression file that have exact same expression levels (likely duplicates), are only found on scaffolds, or have duplicate names.')
 parser.add_argument('-g','--gtf', help='GTF file')
 parser.add_argument('-e','--expression_file', help='expression file from which to filter genes')
@@ -25,7 +28,7 @@ def openfile(filename, mode='r'):
 
 def parse_gtf():
     gene_chr = {}
-    with openfile(args.gtf) as input_file:
+    with openfile(args.gtf,'rt') as input_file:
         for line in input_file:
             if line.startswith('#'):
                 continue
@@ -48,19 +51,34 @@ for chr in accepted_chr_tmp:
     accepted_chr.add('chr'+chr)
     accepted_chr.add(chr)
 
+DECIMAL_CHARS = b'0123456789.\t\r\n'
+ZERO_CHARS = b'0.\t\r\n'
+def has_expression(values):
+    # plain decimals (no sign or exponent): any non-zero digit means that a value is > 0
+    if not values.translate(None, DECIMAL_CHARS) and values.translate(None, ZERO_CHARS):
+        return True
+    return bool((np.array(values.split(b'\t')).astype(np.float64) > 0).any())
+
+# One pass over the expression file: rows with exactly the same expression are found on a digest
+# of the raw row bytes, and per row only the byte offset, length and gene are kept, so memory scales
+# with the number of genes. The rows that are kept are then copied from the file by offset.
 expr_set = set()
 genes_to_filter = set([])
-print('start first read of file to find duplicate expression')
+print('start read of file to find duplicate expression')
 gene_on_scaffold = 0
 genes_to_keep = set([])
 no_expression = 0
 gene_seen = set([])
 average_expression_10 = 0
-with openfile(args.expression_file,'rt') as input_file:
+rows = []
+with openfile(args.expression_file,'rb') as input_file:
     header = input_file.readline()
+    offset = len(header)
     for line in input_file:
-        spl_line = line.split('\t')
-        gene = spl_line[0]
+        tab = line.index(b'\t')
+        gene = line[:tab].decode()
+        rows.append((offset, len(line), gene))
+        offset += len(line)
 
         if gene.startswith('LRG'):
             gene_on_scaffold += 1
@@ -81,48 +99,52 @@ with openfile(args.expression_file,'rt') as input_file:
             continue
         gene_seen.add(gene)
 
-        all_expression = '_'.join(spl_line[1:])
-        if all_expression not in expr_set:
-            expr_set.add(all_expression)
+        values = line[tab+1:]
+        digest = hashlib.blake2b(values, digest_size=16).digest()
+        if digest not in expr_set:
+            expr_set.add(digest)
         else:
             genes_to_filter.add(gene)
 
-        has_expr = False
-#        average_expression = 0
-        for element in spl_line[1:]:
-            if float(element) > 0:
-                has_expr = True
-#                average_expression += float(element)
-                break
-#        average_expression = average_expression / len(spl_line[1:])
-        if not has_expr:
+        if not has_expression(values):
             no_expression += 1
             continue
-#        if average_expression < 10:
-#            average_expression_10 += 1
-#            continue
 
         genes_to_keep.add(gene)
 
 gene_seen = set([])
-print('Done. Start second read of file to write filtered expression file')
+print('Done. Write filtered expression file')
 duplicate_genes = 0
 genes_written = 0
-with openfile(args.expression_file,'rt') as input_file, openfile(args.outfile,'wt') as out:
-    out.write(header)
-    for line in input_file:
-        gene = line.split('\t')[0]
-        if gene not in genes_to_keep:
-            continue
-
-        if gene in gene_seen:
-            duplicate_genes += 1
-            continue
-        gene_seen.add(gene)
+# consecutive rows that are written are copied as one range
+ranges = []
+for offset, length, gene in rows:
+    if gene not in genes_to_keep:
+        continue
+
+    if gene in gene_seen:
+        duplicate_genes += 1
+        continue
+    gene_seen.add(gene)
+
+    if gene not in genes_to_filter:
+        if len(ranges) > 0 and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1][1] += length
+        else:
+            ranges.append([offset, length])
+        genes_written += 1
+rows = None
 
-        if gene not in genes_to_filter:
-            out.write(line)
-            genes_written += 1
+with openfile(args.expression_file,'rb') as input_file, openfile(args.outfile,'wb') as out:
+    out.write(header)
+    for offset, length in ranges:
+        input_file.seek(offset)
+        while length > 0:
+            block = input_file.read(min(length, 1 << 24))
+            if len(block) == 0:
+                raise RuntimeError('Unexpected end of file: '+args.expression_file)
+            out.write(block)
+            length -= len(block)
 
 with open(outdir+'/number_of_genes_filtered.txt','w') as out:
     out.write('Filtered genes for these reasons:\n')
@@ -8,6 +8,7 @@
 #SBATCH --qos=REPLACEQOS
 
 ml Java
+ml Python
 
 set -e
 set -u
@@ -26,8 +27,14 @@ fi
 comm -1 -2 <(awk '{print $1}' REPLACEEIGENVECTORS | sort) <(sort REPLACEBACKGROUND) > $(basename REPLACEBACKGROUND.onlyInEigenvector.neig_REPLACENEIG.txt)
 
 echo "Subsetting REPLACEIDENTITYMATRIX by genes in REPLACEEIGENVECTORS"
-head -n1 REPLACEIDENTITYMATRIX > $TMPDIR/$(basename REPLACEIDENTITYMATRIX.subsetted.txt)
-awk -F"\t" 'FNR==NR {a[$1]=$0; next}; $1 in a {print a[$1]}' REPLACEIDENTITYMATRIX REPLACEEIGENVECTORS >> $TMPDIR/$(basename REPLACEIDENTITYMATRIX.subsetted.txt)
+if [[ REPLACEIDENTITYMATRIX == *.npz ]];
+then
+    # sparse pathway matrix (see GeneNetworkBackend/pathway_matrix.py): only the rows of the eigenvector genes are written as text
+    python REPLACEGITHUBDIR/GeneNetworkBackend/pathway_matrix.py REPLACEIDENTITYMATRIX $TMPDIR/$(basename REPLACEIDENTITYMATRIX.subsetted.txt) --genes REPLACEEIGENVECTORS
+else
+    head -n1 REPLACEIDENTITYMATRIX > $TMPDIR/$(basename REPLACEIDENTITYMATRIX.subsetted.txt)
+    awk -F"\t" 'FNR==NR {a[$1]=$0; next}; $1 in a {print a[$1]}' REPLACEIDENTITYMATRIX REPLACEEIGENVECTORS >> $TMPDIR/$(basename REPLACEIDENTITYMATRIX.subsetted.txt)
+fi
 
 java -jar -XmsREPLACEMEM -XmxREPLACEMEM REPLACEGENENETWORKDIR/GeneNetworkBackend-1.0.7-SNAPSHOT-jar-with-dependencies.jar \
   -e REPLACEEIGENVECTORS \
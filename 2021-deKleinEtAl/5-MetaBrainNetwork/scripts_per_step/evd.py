@@ -3,69 +3,190 @@ import os
 import pandas as pd
 import numpy as np
 import argparse
-from sklearn.decomposition import PCA
 from pathlib import Path
 from datetime import datetime
 
+sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent.absolute().__str__() + "/2023-MetaBrainV2/library/"))
+from decomposition import PCA, truncatedEigh
+from correlation import standardizeRows, tiledCorrelation
+
 parser = argparse.ArgumentParser(description='Do PCA over correlation matrix')
-parser.add_argument('corfile',help='Path to correlation file')
+parser.add_argument('corfile',help='''Path to correlation file. When it ends with .npy, the binary gene x gene correlation matrix
+                    is written there, or reused when it was made from the same expression file (same path, size and modification
+                    time, see <corfile>.source.txt); other (text) correlation files are not read, the matrix is then written to
+                    correlation.npy in the output directory''')
 parser.add_argument('expressionfile',help='Path to expression file that was used to make the correlation file')
 parser.add_argument('outdir',help='Path to the output directory')
+parser.add_argument('--method', choices=['correlation', 'covariance'],
+                    help='''correlation: eigendecomposition of the gene x gene correlation matrix, computed in tiles on disk;
+                    covariance: PCA over the (gene-centered) expression matrix (default: correlation)''',
+                    default='correlation')
 parser.add_argument('--svd_solver',
-                    help='svd solver to use (see https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.PCA.html)',
+                    help='svd solver to use when the matrix is loaded in memory (--method covariance --in_memory): auto, full or randomized',
                     default='auto')
+parser.add_argument('--n_components', type=int,
+                    help='Number of components to compute (default: all)',
+                    default=None)
+parser.add_argument('--chunksize', type=int,
+                    help='Number of expression file rows to read at once',
+                    default=5000)
+parser.add_argument('--tilesize', type=int,
+                    help='Number of genes per tile of the correlation matrix (--method correlation)',
+                    default=2000)
+parser.add_argument('--threads', type=int,
+                    help='Number of tiles of the correlation matrix that are computed at the same time (--method correlation)',
+                    default=1)
+parser.add_argument('--n_iter', type=int,
+                    help='Number of subspace iterations of the truncated eigendecomposition (--method correlation)',
+                    default=10)
+parser.add_argument('--oversamples', type=int,
+                    help='Number of extra vectors in the truncated eigendecomposition (--method correlation)',
+                    default=20)
+parser.add_argument('--float32', action='store_true',
+                    help='Use single precision for the expression data (and the correlation matrix)')
+parser.add_argument('--in_memory', action='store_true',
+                    help='Load the full expression matrix instead of reading it in chunks (--method covariance)')
+parser.add_argument('--tsv', action='store_true',
+                    help='Also write the eigenvectors and PC scores as text (eigenvectors.txt, pc-scores.txt)')
 args = parser.parse_args()
 
-df = pd.read_csv(
-    filepath_or_buffer=args.corfile,
-    sep='\t',index_col=0)
-
 Path(args.outdir).mkdir(parents=True, exist_ok=True)
+dtype = np.float32 if args.float32 else np.float64
+
+# Output: eigenvectors.npy (genes x components) and pc-scores.npy (samples x components), which can
+# be opened with np.load(..., mmap_mode='r'), with the row names in genes.txt and samples.txt, and
+# eigenvalues.txt. For the correlation method also cronbach.txt.
+
+def expressionFingerprint(nrgenes):
+    stat = os.stat(args.expressionfile)
+    return "\n".join([os.path.abspath(args.expressionfile), str(stat.st_size), str(stat.st_mtime_ns),
+                      np.dtype(dtype).name, str(nrgenes)]) + "\n"
+
+def correlationEvd():
+    # The expression file is read in chunks of genes; each gene is centered and scaled to unit
+    # length (Z) and appended to a binary file on disk. The correlation matrix Z Z' is computed in
+    # tiles into a memory-mapped .npy file, of which the largest eigenvalues and eigenvectors are
+    # computed with block subspace iteration (one pass over the matrix per iteration). PC scores are
+    # the projections of the z-scored expression (Z * sqrt(samples - 1)) on the eigenvectors, so that
+    # the variance of each PC equals its eigenvalue.
+    zfile = os.path.join(args.outdir, "expression.standardized.tmp")
+    genes = []
+    samples = None
+    with open(zfile, 'wb') as fho:
+        for chunk in pd.read_csv(args.expressionfile, sep='\t', index_col=0, chunksize=args.chunksize):
+            if samples is None:
+                samples = list(chunk.columns)
+            standardizeRows(chunk.to_numpy(dtype=np.float64), dtype=dtype).tofile(fho)
+            genes.extend(chunk.index)
+            print("{} genes read".format(len(genes)), end='\r', flush=True)
+    print("")
+    if samples is None:
+        raise ValueError("No data in " + args.expressionfile)
+    Z = np.memmap(zfile, dtype=dtype, mode='r', shape=(len(genes), len(samples)))
+
+    if args.corfile.endswith(".npy"):
+        corfile = args.corfile
+    else:
+        corfile = os.path.join(args.outdir, "correlation.npy")
+    # the matrix is only reused when it was computed from the same expression file, in the same precision
+    sourcefile = corfile + ".source.txt"
+    source = expressionFingerprint(len(genes))
+    cor = None
+    if os.path.exists(corfile) and os.path.exists(sourcefile):
+        with open(sourcefile) as fh:
+            if fh.read() == source:
+                cor = np.load(corfile, mmap_mode='r')
+                print("Using correlation matrix: " + corfile)
+    if cor is None:
+        if os.path.exists(corfile):
+            print("Correlation matrix " + corfile + " was not made from this expression file, recalculating")
+        print("Calculating {} x {} correlation matrix: {}".format(len(genes), len(genes), corfile))
+        sys.stdout.flush()
+        if os.path.exists(sourcefile):
+            os.remove(sourcefile)
+        cor = tiledCorrelation(Z, corfile, tilesize=args.tilesize, threads=args.threads)
+        with open(sourcefile, 'w') as fh:
+            fh.write(source)
 
-df = pd.read_csv(
-    filepath_or_buffer=args.expressionfile,
-    sep='\t',index_col=0)
+    k = min(len(genes), len(samples))
+    if args.n_components is not None:
+        k = min(k, args.n_components)
+    print("Eigendecomposition: {} components".format(k))
+    sys.stdout.flush()
+    eigenvalues, eigenvectors = truncatedEigh(cor, k, oversamples=args.oversamples, nIter=args.n_iter,
+                                              tilesize=args.tilesize, verbose=True)
+    cor = None
 
+    pc_scores = np.zeros((len(samples), k))
+    for r0 in range(0, len(genes), args.tilesize):
+        r1 = min(r0 + args.tilesize, len(genes))
+        pc_scores += np.asarray(Z[r0:r1], dtype=np.float64).T @ eigenvectors[r0:r1]
+    pc_scores *= np.sqrt(len(samples) - 1)
+    Z = None
+    os.remove(zfile)
+    return eigenvalues, eigenvectors.astype(dtype), pc_scores.astype(dtype), genes, samples
+
+def covariancePca():
+    pca = PCA(n_components=args.n_components, solver=args.svd_solver, dtype=dtype, verbose=True)
+    # by default the expression file is read in chunks of genes and only a samples x samples matrix is
+    # kept in memory (see decomposition.PCA.fitFile)
+    if args.in_memory:
+        df = pd.read_csv(
+            filepath_or_buffer=args.expressionfile,
+            sep='\t',index_col=0)
+        projected_data = pca.fit_transform(df.T)
+        genes = df.index
+        samples = df.columns
+    else:
+        pca.fitFile(args.expressionfile, chunksize=args.chunksize)
+        projected_data = pca.scores_
+        genes = pca.feature_names_
+        samples = pca.sample_names_
+    return pca.explained_variance_, pca.components_.T, projected_data, list(genes), list(samples)
+
+def CronbachAlpha(pc_scores, eigenvectors):
+    n_items = eigenvectors.shape[0]
+    # Calculates Cronbach's alpha values for each component, with the (unit variance) genes as items
+    # weighted by their loadings: the item variances sum to the sum of the squared loadings, so
+    # alpha = n/(n-1) * (1 - 1/eigenvalue), independent of the signs of the eigenvectors
+    # Only works if evd was calculated on correlation matrix
+    loading_squares = (eigenvectors.astype(np.float64)**2).sum(axis=0)
+    pc_var = pc_scores.var(axis=0, ddof=1, dtype=np.float64)
+    alphas = (n_items / (n_items - 1.0)) * (1.0 - loading_squares / pc_var)
+    return(alphas)
+
+def writeTable(values, rownames, filename):
+    table = pd.DataFrame(values)
+    table.columns = table.columns + 1
+    table = table.add_prefix("PC")
+    table.index = rownames
+    table.index.name = datetime.now().strftime('%d/%m/%Y')
+    table.to_csv(filename,sep='\t')
 
-pca = PCA()
-#pca = PCA(args.svd_solver)
 now = datetime.now()
 dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
 
 print('Start PCA - '+dt_string)
 sys.stdout.flush()
-projected_data = pca.fit_transform(df.T)
-eigenvalues = pca.explained_variance_
+if args.method == 'correlation':
+    eigenvalues, eigenvectors, pc_scores, genes, samples = correlationEvd()
+else:
+    eigenvalues, eigenvectors, pc_scores, genes, samples = covariancePca()
 print('done')
 sys.stdout.flush()
-components = pca.components_
-eigenvectors = pd.DataFrame(components.T)
-pc_scores = pd.DataFrame(projected_data)
-eigenvectors.columns = eigenvectors.columns + 1
-eigenvectors = eigenvectors.add_prefix("PC")
-eigenvectors.index = df.index
-eigenvectors.index.name = datetime.now().strftime('%d/%m/%Y')
-pc_scores.columns = pc_scores.columns + 1
-pc_scores = pc_scores.add_prefix("PC")
-pc_scores.index = df.columns
-pc_scores.index.name = datetime.now().strftime('%d/%m/%Y')
-eigenvectors.to_csv(os.path.join(args.outdir, "eigenvectors.txt"),sep='\t')
-pc_scores.to_csv(os.path.join(args.outdir, "pc-scores.txt"),sep='\t')
-
-
-#print('Calculate cronbach alpha')
-#def CronbachAlpha(pc_scores, eigenvectors):
-#    n_samples = eigenvectors.shape[0]
-#    # Calculates Cronbach's alpha values for each component
-    # Based on the cronbach alpha implementation in pca.cc of pca++
-    # Only works if evd was calculated on correlation matrix
-#    print("NOTE! Cronbach alpha calculation is assuming that evd is done on correlation matrix")
-#    eigenvector_sums = eigenvectors.sum(axis=0)
-#    pc_var = pc_scores.var(axis=0)
-#    alphas = (n_samples / (n_samples - 1.0)) * (1.0 - eigenvector_sums.values / pc_var.values)
-#    return(alphas)
 
-pd.DataFrame(eigenvalues, columns=['eigenvalues']).to_csv('eigenvalues.txt', index=False)
-#cronbach = CronbachAlpha(pc_scores, eigenvectors)
-#cronbach = pd.DataFrame(cronbach, columns=['cronbach']).to_csv('cronbach.txt', index=False)
+np.save(os.path.join(args.outdir, "eigenvectors.npy"), eigenvectors)
+np.save(os.path.join(args.outdir, "pc-scores.npy"), pc_scores)
+with open(os.path.join(args.outdir, "genes.txt"), 'w') as out:
+    out.write("".join(str(gene)+"\n" for gene in genes))
+with open(os.path.join(args.outdir, "samples.txt"), 'w') as out:
+    out.write("".join(str(sample)+"\n" for sample in samples))
+if args.tsv:
+    writeTable(eigenvectors, genes, os.path.join(args.outdir, "eigenvectors.txt"))
+    writeTable(pc_scores, samples, os.path.join(args.outdir, "pc-scores.txt"))
 
+pd.DataFrame(eigenvalues, columns=['eigenvalues']).to_csv(os.path.join(args.outdir, 'eigenvalues.txt'), index=False)
+if args.method == 'correlation':
+    print('Calculate cronbach alpha')
+    cronbach = CronbachAlpha(pc_scores, eigenvectors)
+    pd.DataFrame(cronbach, columns=['cronbach']).to_csv(os.path.join(args.outdir, 'cronbach.txt'), index=False)
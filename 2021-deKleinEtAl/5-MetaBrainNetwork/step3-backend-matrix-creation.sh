@@ -148,11 +148,16 @@ print_command_arguments(){
     # if all output files already made we have to keep track, so a later step can be skipped
     at_least_1_job_submitted=false
     cd $output_dir/10_GeneNetwork_predictions/scripts/
-    for f in $github_dir/GeneNetworkBackend/PathwayMatrix/*matrix.txt;
+    for f in $github_dir/GeneNetworkBackend/PathwayMatrix/*matrix.npz $github_dir/GeneNetworkBackend/PathwayMatrix/*matrix.txt;
     do
+        # sparse .matrix.npz files are used when they exist, dense .matrix.txt files otherwise
+        if [ ! -f $f ] || ([[ $f == *matrix.txt ]] && [ -f ${f%txt}npz ]);
+        then
+            continue
+        fi
         echo "Start predicting with $f"
-        matrix_name=$(basename ${f%_matrix.txt})
-        matrix_name=${matrix_name%.matrix.txt}
+        matrix_name=$(basename ${f%_matrix.*})
+        matrix_name=${matrix_name%.matrix.*}
         mkdir -p $output_dir/10_GeneNetwork_predictions/scripts/
         outfile="$output_dir/10_GeneNetwork_predictions/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.txt"
         echo $matrix_name
@@ -166,7 +171,8 @@ print_command_arguments(){
             sed -i "s;REPLACEIDENTITYMATRIX;$f;g" $output_dir/10_GeneNetwork_predictions/scripts/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.sh
             sed -i "s;REPLACEEIGENVECTORS;$output_dir/7_evd_on_correlation_matrix/${name}.eigenvectors.${n_eigenvectors}_eigenvectors.txt;g" $output_dir/10_GeneNetwork_predictions/scripts/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.sh
             sed -i "s;REPLACEOUT;$outfile;" $output_dir/10_GeneNetwork_predictions/scripts/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.sh
-            sed -i "s;REPLACEBACKGROUND;${f%matrix.txt}genesInPathways.txt;g" $output_dir/10_GeneNetwork_predictions/scripts/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.sh
+            sed -i "s;REPLACEGITHUBDIR;${github_dir};g" $output_dir/10_GeneNetwork_predictions/scripts/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.sh
+            sed -i "s;REPLACEBACKGROUND;${f%matrix.*}genesInPathways.txt;g" $output_dir/10_GeneNetwork_predictions/scripts/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.sh
             sed -i "s;REPLACEMEM;${mem};g" $output_dir/10_GeneNetwork_predictions/scripts/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.sh
             sed -i "s;REPLACEQOS;${qos};" $output_dir/10_GeneNetwork_predictions/scripts/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.sh
             sed -i "s;REPLACENEIG;${n_eigenvectors};" $output_dir/10_GeneNetwork_predictions/scripts/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.sh
@@ -253,10 +259,25 @@ print_command_arguments(){
 
 11_WebsiteMatrixCreator(){
     echo "# Copy the commented files to your local machine where you cloned molgenis-app-genenetwork in a separate data/ directory, then run this code" > $output_dir/11_ImportToWebsite/populate_database.sh
-    for f in $github_dir/GeneNetworkBackend/PathwayMatrix/*.matrix.txt;
+    for f in $github_dir/GeneNetworkBackend/PathwayMatrix/*.matrix.npz $github_dir/GeneNetworkBackend/PathwayMatrix/*.matrix.txt;
     do
-        matrix_name=$(basename ${f%.matrix.txt})
-        matrix_name=${matrix_name%_matrix.txt}
+        if [ ! -f $f ] || ([[ $f == *matrix.txt ]] && [ -f ${f%txt}npz ]);
+        then
+            continue
+        fi
+        matrix_name=$(basename ${f%.matrix.*})
+        matrix_name=${matrix_name%_matrix.*}
+        identity_matrix=$f
+        if [[ $f == *.npz ]];
+        then
+            # the website matrix creator reads the dense text matrix
+            identity_matrix=$output_dir/11_ImportToWebsite/${matrix_name}.matrix.txt
+            if [ ! -f $identity_matrix ];
+            then
+                mkdir -p $output_dir/11_ImportToWebsite/
+                python $github_dir/GeneNetworkBackend/pathway_matrix.py $f $identity_matrix
+            fi
+        fi
         echo $output_dir/11_ImportToWebsite/${matrix_name}.${n_eigenvectors}_eigenvectors_gnInputFormat.txt
         if [ ! -f $output_dir/11_ImportToWebsite/${n_eigenvectors}/${matrix_name}.${n_eigenvectors}_eigenvectors.matrix_gnInputFormat.txt ];
         then
@@ -278,7 +299,7 @@ print_command_arguments(){
                 zcat $output_dir/10_GeneNetwork_predictions/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.bonSigOnly.txt.gz > $output_dir/10_GeneNetwork_predictions/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.bonSigOnly.txt
             fi
 
-            bash ${github_dir}/GeneNetwork/scripts_per_step/12_GeneNetwork_WebsiteMatrixCreator.sh  -i $f \
+            bash ${github_dir}/GeneNetwork/scripts_per_step/12_GeneNetwork_WebsiteMatrixCreator.sh  -i $identity_matrix \
                                                                                                     -t $output_dir/10_GeneNetwork_predictions/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.AUC.bonSigTerms.txt \
                                                                                                     -a $output_dir/10_GeneNetwork_predictions/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.AUC.bonferonni.txt \
                                                                                                     -z $output_dir/10_GeneNetwork_predictions/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.bonSigOnly.txt \
@@ -288,7 +309,7 @@ print_command_arguments(){
                                                                                                     -p $project_dir
         fi
 
-        echo "# $github_dir/GeneNetworkBackend/PathwayMatrix/${matrix_name}.matrix.txt" >> $output_dir/11_ImportToWebsite/populate_database.${n_eigenvectors}_eigenvectors.sh
+        echo "# $identity_matrix" >> $output_dir/11_ImportToWebsite/populate_database.${n_eigenvectors}_eigenvectors.sh
         echo "# $output_dir/10_GeneNetwork_predictions/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.AUC.bonSigTerms.txt" >> $output_dir/11_ImportToWebsite/populate_database.${n_eigenvectors}_eigenvectors.sh
         echo "# $output_dir/10_GeneNetwork_predictions/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.AUC.bonferonni.txt" >> $output_dir/11_ImportToWebsite/populate_database.${n_eigenvectors}_eigenvectors.sh
         echo "# $output_dir/10_GeneNetwork_predictions/${matrix_name}.${n_eigenvectors}_eigenvectors.predictions.bonSigOnly.txt" >> $output_dir/11_ImportToWebsite/populate_database.${n_eigenvectors}_eigenvectors.sh
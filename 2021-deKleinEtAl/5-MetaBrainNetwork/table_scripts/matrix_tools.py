@@ -0,0 +1,288 @@
+import argparse
+import csv
+import gzip
+import io
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Streaming tools for tab separated matrices with a header line and row names in the first column
+# (genes x samples, genes x terms, covariates x samples), plain or gzipped. Files are read in chunks
+# of lines; the next chunk is read (and decompressed) on a thread while the current chunk is
+# processed, and chunks are written on a thread as well, so at most a few chunks are in memory.
+# Numeric values are parsed per chunk with the C parser of pandas; rows that are written unchanged
+# are written as the original text.
+#
+#   python matrix_tools.py colsums matrix.txt.gz sums.txt
+#   python matrix_tools.py variance_filter covariates.txt out.txt --samples samples.txt
+#   python matrix_tools.py strip_versions matrix.txt.gz [--outfile out.txt.gz]
+#   python matrix_tools.py merge out.txt a.txt b.txt c.txt
+
+
+def open_text(path, mode='rt'):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode[0])
+
+
+class ChunkedReader():
+    '''Reads the header (split on tabs) and then chunks of lines (with their newline) of a matrix file'''
+    def __init__(self, path, chunksize=5000):
+        self.path = path
+        self.chunksize = chunksize
+        self.fh = open_text(path)
+        self.header = self.fh.readline().rstrip('\n').split('\t')
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+        self.fh.close()
+
+    def read(self):
+        return list(itertools.islice(self.fh, self.chunksize))
+
+    def __iter__(self):
+        future = self.executor.submit(self.read)
+        while True:
+            lines = future.result()
+            if len(lines) == 0:
+                return
+            future = self.executor.submit(self.read)
+            yield lines
+
+
+class ChunkedWriter():
+    '''Writes text on a thread, keeping at most one chunk waiting'''
+    def __init__(self, path):
+        self.fh = open_text(path, 'wt')
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def write(self, text):
+        if self.future is not None:
+            self.future.result()
+        self.future = self.executor.submit(self.fh.write, text)
+
+    def close(self):
+        if self.future is not None:
+            self.future.result()
+        self.executor.shutdown()
+        self.fh.close()
+
+
+def row_names(lines):
+    return [line[:line.find('\t')] if '\t' in line else line.rstrip('\n') for line in lines]
+
+
+def parse_values(lines, usecols=None):
+    '''Row names and float64 values (rows x columns) of a chunk of lines; usecols are column indices of the
+    line, with the row names at index 0'''
+    table = pd.read_csv(io.StringIO(''.join(lines)), sep='\t', header=None, index_col=0, dtype={0: str},
+                        usecols=None if usecols is None else [0]+list(usecols),
+                        quoting=csv.QUOTE_NONE, float_precision='round_trip')
+    return row_names(lines), table.to_numpy(dtype=np.float64)
+
+
+def colsums(infile, outfile=None, chunksize=5000):
+    '''Per column the sum and the number of non-zero values, written to outfile when given'''
+    with ChunkedReader(infile, chunksize) as reader:
+        columns = reader.header[1:]
+        sums = np.zeros(len(columns))
+        nonzero = np.zeros(len(columns), dtype=np.int64)
+        nrows = 0
+        for lines in reader:
+            _, values = parse_values(lines)
+            sums += values.sum(axis=0)
+            nonzero += np.count_nonzero(values, axis=0)
+            nrows += len(lines)
+    print(str(nrows)+' rows, '+str(len(columns))+' columns')
+    if outfile is not None:
+        with open_text(outfile, 'wt') as out:
+            out.write('column\tsum\tnonzero\n')
+            for column, total, n in zip(columns, sums, nonzero):
+                out.write(column+'\t'+repr(float(total))+'\t'+str(n)+'\n')
+        print('Column sums written to '+outfile)
+    return columns, sums, nonzero
+
+
+def variance_filter(infile, outfile, samples=None, min_sd=0, chunksize=5000):
+    '''Keeps the columns of samples (all columns when None, in the order of the file) and removes the
+    rows with a standard deviation of at most min_sd over those columns (with min_sd 0: rows where all
+    values are the same)'''
+    with ChunkedReader(infile, chunksize) as reader, ChunkedWriter(outfile) as writer:
+        header = reader.header
+        if samples is None:
+            keep = list(range(1, len(header)))
+        else:
+            samples = set(samples)
+            keep = [i for i in range(1, len(header)) if header[i] in samples]
+        subset = len(keep) < len(header)-1
+        writer.write(header[0]+''.join('\t'+header[i] for i in keep)+'\n')
+        nkept = 0
+        nremoved = 0
+        for lines in reader:
+            names, values = parse_values(lines, keep)
+            if min_sd == 0:
+                removed = values.max(axis=1, initial=-np.inf) == values.min(axis=1, initial=np.inf)
+            else:
+                removed = values.std(axis=1, ddof=1) <= min_sd
+            out = []
+            for i in range(len(lines)):
+                if removed[i]:
+                    print('Standard deviation of '+names[i]+' is '+('0' if min_sd == 0 else 'at most '+str(min_sd))+
+                          ' for these samples, excluding it')
+                    nremoved += 1
+                    continue
+                if subset:
+                    elems = lines[i].rstrip('\n').split('\t')
+                    out.append(elems[0]+''.join('\t'+elems[c] for c in keep)+'\n')
+                else:
+                    out.append(lines[i] if lines[i].endswith('\n') else lines[i]+'\n')
+                nkept += 1
+            writer.write(''.join(out))
+    print(str(nkept)+' rows x '+str(len(keep))+' columns written to '+outfile+', '+str(nremoved)+' rows removed')
+    return nkept, nremoved
+
+
+def strip_version(name):
+    return name.split('.')[0]
+
+
+def strip_versions(infile, outfile=None, chunksize=5000):
+    '''Removes the version (.N) of the row names; of rows that get the same name only the first is kept.
+    Without outfile infile is replaced, unless no row name changed.'''
+    target = infile if outfile is None else outfile
+    tmp = target+'.tmp'+('.gz' if target.endswith('.gz') else '')
+    seen = set()
+    nchanged = 0
+    nduplicates = 0
+    with ChunkedReader(infile, chunksize) as reader, ChunkedWriter(tmp) as writer:
+        writer.write('\t'.join(reader.header)+'\n')
+        for lines in reader:
+            out = []
+            for line, name in zip(lines, row_names(lines)):
+                gene = strip_version(name)
+                if gene in seen:
+                    nduplicates += 1
+                    continue
+                seen.add(gene)
+                if gene != name:
+                    nchanged += 1
+                    line = gene+line[len(name):]
+                out.append(line if line.endswith('\n') else line+'\n')
+            writer.write(''.join(out))
+    if outfile is None and nchanged == 0 and nduplicates == 0:
+        os.remove(tmp)
+        print('genes do not have version number, nothing to change')
+    else:
+        os.replace(tmp, target)
+        print('removed version of '+str(nchanged)+' genes, '+str(nduplicates)+' duplicate genes removed, written to '+target)
+    return nchanged, nduplicates
+
+
+def merge(outfile, infiles, corner='-', chunksize=5000):
+    '''Pastes the columns of the infiles. All files must have the same row names in the same order, so that
+    the rows can be streamed; a RuntimeError is raised at the first row where they differ (the output is
+    then not written).'''
+    tmp = outfile+'.tmp'+('.gz' if outfile.endswith('.gz') else '')
+    readers = []
+    try:
+        for f in infiles:
+            readers.append(ChunkedReader(f, chunksize))
+        ncols = [len(reader.header)-1 for reader in readers]
+        iterators = [iter(reader) for reader in readers]
+        pending = [[] for _ in readers]
+        nrows = 0
+        with ChunkedWriter(tmp) as writer:
+            writer.write(corner+''.join('\t'+'\t'.join(reader.header[1:]) for reader in readers if len(reader.header) > 1)+'\n')
+            while True:
+                for r in range(len(readers)):
+                    if len(pending[r]) == 0:
+                        pending[r] = next(iterators[r], [])
+                n = min(len(lines) for lines in pending)
+                if n == 0:
+                    break
+                names = [row_names(lines[:n]) for lines in pending]
+                for r in range(1, len(readers)):
+                    if names[r] != names[0]:
+                        i = next(i for i in range(n) if names[r][i] != names[0][i])
+                        raise RuntimeError('Row '+str(nrows+i+1)+' of '+infiles[r]+' is '+names[r][i]+', but '+names[0][i]+
+                                           ' in '+infiles[0]+'; all files must have the same rows in the same order')
+                out = []
+                for i in range(n):
+                    out.append(names[0][i]+''.join(pending[r][i][len(names[0][i]):].rstrip('\n') for r in range(len(readers)))+'\n')
+                writer.write(''.join(out))
+                nrows += n
+                pending = [lines[n:] for lines in pending]
+            for r in range(len(readers)):
+                if len(pending[r]) > 0:
+                    raise RuntimeError(infiles[r]+' has more rows than '+infiles[[len(lines) for lines in pending].index(0)]+
+                                       ' ('+str(nrows)+' rows); all files must have the same rows in the same order')
+        os.replace(tmp, outfile)
+    finally:
+        for reader in readers:
+            reader.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    print(str(nrows)+' rows x '+str(sum(ncols))+' columns written to '+outfile)
+    return nrows
+
+
+def read_list(path):
+    with open_text(path) as input_file:
+        return [line.rstrip('\n') for line in input_file if len(line.rstrip('\n')) > 0]
+
+
+def command_line():
+    parser = argparse.ArgumentParser(description='Streaming operations on tab separated matrices (plain or gzipped) with a header and row names.')
+    parser.add_argument('--chunksize', type=int, help='Number of lines to process at once (default: 5000)', default=5000)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    colsums_parser = subparsers.add_parser('colsums', help='Sum and number of non-zero values per column')
+    colsums_parser.add_argument('matrix')
+    colsums_parser.add_argument('outfile')
+
+    variance_parser = subparsers.add_parser('variance_filter', help='Select columns and remove rows without variance')
+    variance_parser.add_argument('matrix')
+    variance_parser.add_argument('outfile')
+    variance_parser.add_argument('--samples', help='File with the columns to keep (default: all columns)')
+    variance_parser.add_argument('--min_sd', type=float, help='Remove rows with a standard deviation of at most this (default: 0)', default=0)
+
+    strip_parser = subparsers.add_parser('strip_versions', help='Remove gene versions from the row names and remove duplicate rows')
+    strip_parser.add_argument('matrix')
+    strip_parser.add_argument('--outfile', help='File to write (default: replace the matrix)')
+
+    merge_parser = subparsers.add_parser('merge', help='Paste the columns of matrices that have the same row names in the same order (fails otherwise)')
+    merge_parser.add_argument('outfile')
+    merge_parser.add_argument('matrices', nargs='+')
+    merge_parser.add_argument('--corner', help='First cell of the header of the output (default: -)', default='-')
+
+    args = parser.parse_args()
+    if args.command == 'colsums':
+        colsums(args.matrix, args.outfile, args.chunksize)
+    elif args.command == 'variance_filter':
+        samples = read_list(args.samples) if args.samples else None
+        variance_filter(args.matrix, args.outfile, samples, args.min_sd, args.chunksize)
+    elif args.command == 'strip_versions':
+        strip_versions(args.matrix, args.outfile, args.chunksize)
+    elif args.command == 'merge':
+        merge(args.outfile, args.matrices, args.corner, args.chunksize)
+
+
+if __name__ == '__main__':
+    command_line()
@@ -28,6 +28,7 @@ from functools import reduce
 import argparse
 import time
 import glob
+import sys
 import os
 
 # Third party imports.
@@ -35,7 +36,6 @@ import numpy as np
 import pandas as pd
 from scipy import stats
 from statsmodels.regression.linear_model import OLS
-from sklearn.decomposition import PCA
 import seaborn as sns
 import matplotlib
 matplotlib.use('Agg')
@@ -43,6 +43,8 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 
 # Local application imports.
+sys.path.insert(0, os.path.join(str(Path(__file__).parent.parent.parent.parent.parent.absolute()), "2023-MetaBrainV2", "library"))
+from decomposition import PCA
 
 # Metadata
 __program__ = "Do PCA over Expression Matrix"
@@ -75,6 +77,7 @@ class main():
         self.data_path = getattr(arguments, 'data')
         self.std_path = getattr(arguments, 'sample_to_dataset')
         self.n_components = getattr(arguments, 'n_components')
+        self.dtype = np.float32 if getattr(arguments, 'float32') else np.float64
         outdir = getattr(arguments, 'outdir')
         outfolder = getattr(arguments, 'outfolder')
 
@@ -140,6 +143,11 @@ class main():
                             default=100,
                             help="The number of PCA components to calculate. "
                                  "Default: 100.")
+        parser.add_argument("-float32",
+                            "--float32",
+                            action='store_true',
+                            help="Perform the PCA in single precision. "
+                                 "Default: False.")
         parser.add_argument("-od",
                             "--outdir",
                             type=str,
@@ -193,7 +201,7 @@ class main():
     def pca(self, df, filename, sample_to_dataset, file_appendix="", plot_appendix=""):
         # samples should be on the columns and genes on the rows.
         zscores = (df - df.mean(axis=0)) / df.std(axis=0)
-        pca = PCA(n_components=self.n_components)
+        pca = PCA(n_components=self.n_components, dtype=self.dtype)
         pca.fit(zscores)
         components_df = pd.DataFrame(pca.components_)
         components_df.index = ["PC{}".format(i + 1) for i, _ in enumerate(components_df.index)]
@@ -276,6 +284,7 @@ class main():
         print("  > Data: {}".format(self.data_path))
         print("  > Sample-to-dataset path: {}".format(self.std_path))
         print("  > N-components: {}".format(self.n_components))
+        print("  > Float32: {}".format(self.dtype == np.float32))
         print("  > Plot output directory: {}".format(self.plot_outdir))
         print("  > File output directory: {}".format(self.file_outdir))
         print("")
@@ -1,15 +1,26 @@
+import argparse
+import csv
 import glob
-import sys
 import gzip
-
-
-
-if len(sys.argv) < 3:
-    print("Usage: indir outfile.txt.gz")
-    sys.exit(-1)
-
-indir = sys.argv[1]
-outfile = sys.argv[2]
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+parser = argparse.ArgumentParser(description="Combine Picard and STAR QC files into a metrics x samples table")
+parser.add_argument("indir")
+parser.add_argument("outfile", help="outfile.txt.gz")
+parser.add_argument("nrthreads", nargs="?", type=int, default=1, help="default=1")
+parser.add_argument("--cache", dest="cachefile", default=None,
+                    help="cache.txt.gz: per-file parse results; files with the same size and mtime as in the cache are not parsed again")
+args = parser.parse_args()
+
+indir = args.indir
+outfile = args.outfile
+nrthreads = args.nrthreads
+cachefile = args.cachefile
 
 def getfh(file):
     if file.endswith(".gz"):
@@ -27,7 +38,7 @@ def getSample(file,removeStr):
     sample = file.split("/")[-1]
     sample = sample.replace(".gz","")
     sample = sample.replace(removeStr,"")
-    return sample    
+    return sample
 
 def getSamples(files,removeStr):
     print("{} files".format(len(files)))
@@ -46,171 +57,61 @@ def toSortedArr(s):
     d.sort()
     return d
 
-    
-# inventorize samples
-files = glob.glob(indir+"/collectMultipleMetrics_QC/*.multiplemetrics.alignment_summary_metrics")
-samples = getSamples(files,".multiplemetrics.alignment_summary_metrics")
-print("{} samples loaded sofar ".format(len(samples)))
-files = glob.glob(indir+"/collectMultipleMetrics_QC/*.multiplemetrics.insert_size_metrics")
-samples.update(getSamples(files,".multiplemetrics.insert_size_metrics"))
-print("{} samples loaded sofar ".format(len(samples)))
-files = glob.glob(indir+"/collectRnaSeqMetrics_QC/*.rna_metrics.log")
-samples.update(getSamples(files,".rna_metrics.log"))
-print("{} samples loaded sofar ".format(len(samples)))
-files = glob.glob(indir+"/star/*.ReadsPerGene.out.tab")
-samples.update(getSamples(files,".ReadsPerGene.out.tab"))
-print("{} samples loaded sofar ".format(len(samples)))
-files = glob.glob(indir+"/star/*.Log.final.out")
-samples.update(getSamples(files,".Log.final.out"))
-print("{} samples loaded total ".format(len(samples)))
-
 
+# Metric collectors. Each parser gets an open file and the options of its collector, and returns
+# the metric values of the sample and the metric names the file defines (metrics without a value
+# are written as nan).
 
-# collection bins
-data = {}
-metrics = set()
+EXCLUDEDCOLUMNS = set(["SAMPLE", "LIBRARY", "READ_GROUP"])
 
-## collectMultipleMetrics_QC
-# alignment_summary_metrics - skip lines w/ #, skip empty lines
-# header line starts with CATEGORY
-# line with PAIR has average numbers
-files = glob.glob(indir+"/collectMultipleMetrics_QC/*.multiplemetrics.alignment_summary_metrics")
-for file in files:
-    print("Parsing: "+file)
-    sample = getSample(file,".multiplemetrics.alignment_summary_metrics")
-    fh = getfh(file)
-    header = []
+def parsePicard(fh, header, prefix, firstcolumn, dataline):
+    # Picard metrics: skip lines until the column header (the line starting with header); values
+    # are on the line starting with dataline, or on the line after the header when dataline is None
+    columns = []
+    metrics = []
     sampledata = {}
-
     for line in fh:
         line = line.strip()
-        if line.startswith("CATEGORY"):
-            elems = line.strip().split("\t")
-            for i in range(1,len(elems)):
+        if line.startswith(header):
+            elems = line.split("\t")
+            for i in range(firstcolumn, len(elems)):
                 col = elems[i]
-                if col != "SAMPLE" and col != "LIBRARY" and col != "READ_GROUP":
-                    header.append("ALIGNMENT_METRICS_"+elems[i])
-                    metrics.add("ALIGNMENT_METRICS_"+elems[i])
-        elif line.startswith("PAIR"):
-            elems = line.strip().split("\t")
-            for i in range(1,len(elems)):
-                sampledata[header[i-1]] = elems[i]
+                if col not in EXCLUDEDCOLUMNS:
+                    columns.append(prefix+col)
+                    metrics.append(prefix+col)
+            if dataline is None:
+                elems = fh.readline().strip().split("\t")
+                for i in range(firstcolumn, len(elems)):
+                    sampledata[columns[i-firstcolumn]] = elems[i]
+                break
+        elif dataline is not None and line.startswith(dataline):
+            elems = line.split("\t")
+            for i in range(firstcolumn, len(elems)):
+                sampledata[columns[i-firstcolumn]] = elems[i]
             break # no need to read the rest
-    fh.close()    
-    data[sample] = sampledata        
-
-# insert_size_metrics - skip lines w/ #, skip empty lines; first line begins with; second line has stats 
-# MEDIAN_INSERT_SIZE
-files = glob.glob(indir+"/collectMultipleMetrics_QC/*.multiplemetrics.insert_size_metrics")
-for file in files:
-    print("Parsing: "+file)
-    sample = getSample(file,".multiplemetrics.insert_size_metrics")
-    fh = getfh(file)
-    header = []
-    sampledata = data.get(sample)
-    if sampledata is None:
-        sampledata = {}
+    return sampledata, metrics
 
-    for line in fh:
-        line = line.strip()
-        if line.startswith("MEDIAN_INSERT_SIZE"):
-            elems = line.strip().split("\t")
-            for i in range(0,len(elems)):
-                col = elems[i]
-                if col != "SAMPLE" and col != "LIBRARY" and col != "READ_GROUP":
-                    dta = sampledata.get(col)
-                    col = "INSERT_METRICS_"+col
-                    header.append(col)
-                    metrics.add(col)
-
-            dataline = fh.readline()
-            elems = dataline.strip().split("\t")
-            for i in range(0,len(elems)):
-                sampledata[header[i]] = elems[i]
-            break
-    fh.close()
-    data[sample] = sampledata
-
-## collectRnaSeqMetrics_QC
-# *.rna_metrics.log
-# header starts with ## METRICS CLASS; next line has column names, starting with PF_BASES
-# line afterwards values
-files = glob.glob(indir+"/collectRnaSeqMetrics_QC/*.rna_metrics.log")
-for file in files:
-    print("Parsing: "+file)
-    sample = getSample(file,".rna_metrics.log")
-    fh = getfh(file)
-    header = []
-    sampledata = data.get(sample)
-    if sampledata is None:
-        sampledata = {}
-
-    for line in fh:
-        line = line.strip()
-        if line.startswith("PF_BASES"):
-            elems = line.strip().split("\t")
-            for i in range(0,len(elems)):
-                col = elems[i]
-                if col != "SAMPLE" and col != "LIBRARY" and col != "READ_GROUP":
-                    dta = sampledata.get(col)
-                    col = "RNASEQ_METRICS_"+col
-                    header.append(col)
-                    metrics.add(col)
-
-            dataline = fh.readline()
-            elems = dataline.strip().split("\t")
-
-            for i in range(0,len(elems)):
-                sampledata[header[i]] = elems[i]
-            break
-    fh.close()
-    data[sample] = sampledata
-
-# STAR count metrics
-files = glob.glob(indir+"/star/*.ReadsPerGene.out.tab")
-for file in files:
-    print("Parsing: "+file)
-    sample = getSample(file,".ReadsPerGene.out.tab")
-    samples.add(sample)
-    sampledata = data.get(sample)
-    if sampledata is None:
-        sampledata = {}
-    fh = getfh(file)
-    mapped = [0,0,0]
-    
-    for line in fh:
-        elems = line.strip().split("\t")
-        phen = elems[0]
-        if not phen.startswith("ENSG"):
-            for i in range(1,4):
-                ct = elems[i]
-                phenoname = elems[0]
-                if i == 1:
-                    phenoname = "STAR_TAB_"+phenoname + "_sum"
-                elif i == 2:
-                    phenoname = "STAR_TAB_"+phenoname + "_strandA"
-                else:
-                    phenoname = "STAR_TAB_"+phenoname + "_strandB"
-                sampledata[phenoname] = ct
-                metrics.add(phenoname)
-        else:
-            # sum up the counts for each column
-            for i in range(1,4):
-                ct = int(elems[i])
-                mapped[i-1] += ct
-    for i in range(0,len(mapped)): 
-            if i == 0:
-                phenoname = "STAR_TAB_N_mapped_sum"
-            elif i == 1:
-                phenoname = "STAR_TAB_N_mapped_strandA"
-            else:
-                phenoname = "STAR_TAB_N_mapped_strandB"
-            sampledata[phenoname] = str(mapped[i])
-            metrics.add(phenoname)
-
-    fh.close()
-    data[sample] = sampledata
+STRANDS = ["_sum", "_strandA", "_strandB"]
 
+def parseReadsPerGene(fh):
+    # STAR ReadsPerGene: the N_* lines (and any other non-ENSG line) are metrics; the gene counts
+    # are summed per column into N_mapped
+    table = pd.read_csv(fh, sep="\t", header=None, usecols=[0, 1, 2, 3], dtype={0: str, 1: np.int64, 2: np.int64, 3: np.int64},
+                        quoting=csv.QUOTE_NONE, skip_blank_lines=True)
+    isgene = table[0].str.strip().str.startswith("ENSG").to_numpy()
+    sampledata = {}
+    metrics = []
+    for row in table[~isgene].itertuples(index=False):
+        for i in range(3):
+            phenoname = "STAR_TAB_"+row[0].strip()+STRANDS[i]
+            sampledata[phenoname] = str(row[i+1])
+            metrics.append(phenoname)
+    mapped = table[isgene][[1, 2, 3]].to_numpy().sum(axis=0, dtype=np.int64)
+    for i in range(3):
+        phenoname = "STAR_TAB_N_mapped"+STRANDS[i]
+        sampledata[phenoname] = str(mapped[i])
+        metrics.append(phenoname)
+    return sampledata, metrics
 
 # STAR final logs
 allowedp = [
@@ -240,40 +141,131 @@ allowedp = [
     "Number_of_chimeric_reads",
     "PCT_of_chimeric_reads"
 ]
-allowedpset = set()
-for p in allowedp:
-    allowedpset.add(p)
-
-files = glob.glob(indir+"/star/*.Log.final.out")
-for file in files:
-    print("Parsing: "+file)
-    sample = getSample(file,".Log.final.out")
-    samples.add(sample)
-    sampledata = data.get(sample)
-    if sampledata is None:
-        sampledata = {}
 
-    fh = getfh(file)
+def parseStarLog(fh, allowed):
+    allowedpset = set(allowed)
+    sampledata = {}
+    metrics = []
     for line in fh:
         line = line.strip()
         if "|" in line:
             line = line.replace("|","").strip()
-            
             elems = line.split("\t")
             if len(elems) == 2:
                 p = elems[0].strip().replace(" ","_")
                 p = p.replace(":","")
                 p = p.replace(",","")
                 p = p.replace("%","PCT")
-                # print(p)
                 if p in allowedpset:
                     v = elems[1].replace("%","")
                     p = "STAR_LOG_"+p
                     sampledata[p] = v
-                    metrics.add(p)
+                    metrics.append(p)
+    return sampledata, metrics
+
+# file glob relative to indir, suffix that is removed to get the sample name, parser, parser options
+COLLECTORS = [
+    # alignment_summary_metrics: header line starts with CATEGORY, line with PAIR has average numbers
+    ("collectMultipleMetrics_QC/*.multiplemetrics.alignment_summary_metrics", ".multiplemetrics.alignment_summary_metrics",
+     parsePicard, {"header": "CATEGORY", "prefix": "ALIGNMENT_METRICS_", "firstcolumn": 1, "dataline": "PAIR"}),
+    # insert_size_metrics: header line starts with MEDIAN_INSERT_SIZE, next line has the stats
+    ("collectMultipleMetrics_QC/*.multiplemetrics.insert_size_metrics", ".multiplemetrics.insert_size_metrics",
+     parsePicard, {"header": "MEDIAN_INSERT_SIZE", "prefix": "INSERT_METRICS_", "firstcolumn": 0, "dataline": None}),
+    # rna_metrics.log: header line (after ## METRICS CLASS) starts with PF_BASES, next line has the values
+    ("collectRnaSeqMetrics_QC/*.rna_metrics.log", ".rna_metrics.log",
+     parsePicard, {"header": "PF_BASES", "prefix": "RNASEQ_METRICS_", "firstcolumn": 0, "dataline": None}),
+    ("star/*.ReadsPerGene.out.tab", ".ReadsPerGene.out.tab", parseReadsPerGene, {}),
+    ("star/*.Log.final.out", ".Log.final.out", parseStarLog, {"allowed": allowedp}),
+]
+
+def parseFile(file, collector):
+    _, _, parse, options = COLLECTORS[collector]
+    fh = getfh(file)
+    sampledata, metrics = parse(fh, **options)
+    fh.close()
+    return sampledata, metrics
+
+def fileKey(file):
+    stat = os.stat(file)
+    return os.path.abspath(file), stat.st_size, stat.st_mtime
+
+def readCache(file):
+    cache = {}
+    if file is None or not os.path.exists(file):
+        return cache
+    fh = getfh(file)
+    for line in fh:
+        path, size, mtime, result = line.rstrip("\n").split("\t", 3)
+        sampledata, metrics = json.loads(result)
+        cache[path] = (int(size), float(mtime), (dict(sampledata), metrics))
     fh.close()
-    # sys.exit()
-    data[sample] = sampledata
+    return cache
+
+def writeCache(file, entries):
+    tmp = file+".tmp"+(".gz" if file.endswith(".gz") else "")
+    fho = getfho(tmp)
+    for (path, size, mtime), (sampledata, metrics) in entries:
+        fho.write(path+"\t"+str(size)+"\t"+repr(mtime)+"\t"+json.dumps([list(sampledata.items()), metrics])+"\n")
+    fho.close()
+    os.replace(tmp, file)
+
+
+# inventorize samples
+samples = set()
+tasks = []
+for c in range(len(COLLECTORS)):
+    query, removeStr, _, _ = COLLECTORS[c]
+    files = glob.glob(indir+"/"+query)
+    samples.update(getSamples(files,removeStr))
+    if c < len(COLLECTORS)-1:
+        print("{} samples loaded sofar ".format(len(samples)))
+    else:
+        print("{} samples loaded total ".format(len(samples)))
+    for file in files:
+        tasks.append((file, c))
+
+# parse the files that are not in the cache
+cache = readCache(cachefile)
+keys = [fileKey(file) for file, _ in tasks]
+results = [None] * len(tasks)
+toparse = []
+for t in range(len(tasks)):
+    path, size, mtime = keys[t]
+    entry = cache.get(path)
+    if entry is not None and entry[0] == size and entry[1] == mtime:
+        results[t] = entry[2]
+    else:
+        toparse.append(t)
+if cachefile is not None:
+    print("{} files in cache, {} files to parse".format(len(tasks)-len(toparse), len(toparse)))
+
+if nrthreads > 1 and len(toparse) > 1:
+    with ProcessPoolExecutor(max_workers=nrthreads) as executor:
+        futures = [executor.submit(parseFile, *tasks[t]) for t in toparse]
+        for i in range(len(toparse)):
+            print("Parsing: "+tasks[toparse[i]][0])
+            results[toparse[i]] = futures[i].result()
+            futures[i] = None
+else:
+    for t in toparse:
+        print("Parsing: "+tasks[t][0])
+        results[t] = parseFile(*tasks[t])
+
+if cachefile is not None and len(toparse) > 0:
+    print("Writing cache: "+cachefile)
+    writeCache(cachefile, zip(keys, results))
+
+# collection bins
+data = {}
+metrics = set()
+for t in range(len(tasks)):
+    file, c = tasks[t]
+    sampledata, filemetrics = results[t]
+    sample = getSample(file, COLLECTORS[c][1])
+    if sample not in data:
+        data[sample] = {}
+    data[sample].update(sampledata)
+    metrics.update(filemetrics)
 
 print("{} metrics loaded ".format(len(metrics)))
 print("{} samples loaded ".format(len(samples)))
@@ -292,7 +284,7 @@ for metric in metrics:
     outln = metric
     for sample in samples:
         sampledata = data.get(sample)
-        if sample is None:
+        if sampledata is None:
             outln+="\tnan"
         else:
             v = sampledata.get(metric)
@@ -302,6 +294,6 @@ for metric in metrics:
                 outln +="\tnan"
             else:
                 outln +="\t"+v
-    
+
     fho.write(outln+"\n")
-fho.close()
\ No newline at end of file
+fho.close()
@@ -1,10 +1,26 @@
+import argparse
 import glob
 import gzip
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
-if len(sys.argv) < 3:
-    print("Usage: stardir outfile.txt.gz")
-    sys.exit(-1)
+import numpy as np
+
+path = str(Path(__file__).parent.parent.absolute().__str__() + "/library/")
+sys.path.insert(0, path)
+from matrixstore import MatrixStore, fileChecksum
+
+parser = argparse.ArgumentParser(description="Combine STAR ReadsPerGene.out.tab files into a genes x samples count matrix")
+parser.add_argument("stardir")
+parser.add_argument("outfile", help="outfile.txt.gz")
+parser.add_argument("nrthreads", nargs="?", type=int, default=1, help="default=1")
+parser.add_argument("binaryout", nargs="?", default=None,
+                    help="counts.npz: optional binary output with the int32 count matrix (counts, -1 when missing), genes and samples")
+parser.add_argument("--store", dest="storedir", default=None,
+                    help="incremental matrix store directory: only files that are new or changed since the last run are parsed")
+parser.add_argument("--compact", action="store_true", help="rewrite the store into a single chunk, dropping removed samples")
+args = parser.parse_args()
 
 parseSJs = False
 # if len(sys.argv) == 5:
@@ -24,8 +40,11 @@ def getfho(file):
     else:
         return open(file,'w')
 
-indir = sys.argv[1]
-outfile = sys.argv[2]
+indir = args.stardir
+outfile = args.outfile
+nrthreads = args.nrthreads
+binaryout = args.binaryout
+storedir = args.storedir
 
 query = "ReadsPerGene.out.tab"
 if parseSJs:
@@ -42,70 +61,198 @@ if files == 0:
 files.sort()
 
 print(f"{nrfiles} files found.")
-samples = []
-genes = set()
-data = {}
 
-for file in files:
-    print("Parsing: "+file)
-    sample = file.split("/")[-1] # get file name
-    sample = sample.replace(".gz","")
-    sample = sample.replace("."+query,"")
-    samples.append(sample)
-    sampledata = {}
+# Files are parsed on a process pool into int32 count arrays aligned to one gene index (the genes
+# of the first file; STAR writes the genes of the annotation in the same order for every sample).
+# Genes that are not in the index are returned separately and added as extra rows. Missing counts
+# are -1 in the matrix and written as nan.
+
+GENEINDEX = None
+
+def initWorker(geneIndex):
+    global GENEINDEX
+    GENEINDEX = geneIndex
+
+def readGenes(file):
+    genes = []
+    fh = getfh(file)
+    for line in fh:
+        gene = line.split("\t", 1)[0]
+        if gene.startswith("ENSG"):
+            genes.append(gene)
+    fh.close()
+    return genes
+
+def parseFile(file, sample, geneIndex=None, checksum=False):
+    if geneIndex is None:
+        geneIndex = GENEINDEX
+    counts = np.full(len(geneIndex), -1, dtype=np.int32)
+    extra = {}
+    messages = []
     fh = getfh(file)
     for line in fh:
         elems = line.strip().split("\t")
         gene = elems[0]
         if gene.startswith("ENSG"):
-            ct = elems[1]
-            genes.add(gene)
-            oldct = sampledata.get(gene)
-            if oldct is not None:
-                print("Duplicate gene: "+gene+" in sample: "+sample)
+            ct = int(elems[1])
+            idx = geneIndex.get(gene)
+            if idx is None:
+                if gene in extra:
+                    messages.append("Duplicate gene: "+gene+" in sample: "+sample)
+                else:
+                    extra[gene] = ct
+            elif counts[idx] >= 0:
+                messages.append("Duplicate gene: "+gene+" in sample: "+sample)
             else:
-                sampledata[gene] = ct
+                counts[idx] = ct
     fh.close()
-    data[sample] = sampledata
+    return counts, extra, messages, fileChecksum(file) if checksum else None
+
+def formatBlock(genes, block, compress):
+    lines = []
+    for gene, row in zip(genes, block.tolist()):
+        if min(row) < 0:
+            lines.append(gene+"\t"+"\t".join(str(ct) if ct >= 0 else "nan" for ct in row)+"\n")
+        else:
+            lines.append(gene+"\t"+"\t".join(map(str, row))+"\n")
+    data = "".join(lines).encode()
+    if compress:
+        return gzip.compress(data, 6)
+    return data
 
+samples = []
+for file in files:
+    sample = file.split("/")[-1] # get file name
+    sample = sample.replace(".gz","")
+    sample = sample.replace("."+query,"")
+    samples.append(sample)
 nrsamples = len(samples)
-nrgenes = len(genes)
 
-genearr = []
-for gene in genes:
-    genearr.append(gene)
-genes = genearr
-genearr.sort()
+# parses the files at the given indices; returns the counts aligned to geneIndex, the counts of
+# genes that are not in geneIndex and, when requested, the file checksums
+def parseColumns(indices, geneIndex, checksum=False):
+    counts = np.empty((len(geneIndex), len(indices)), dtype=np.int32)
+    extraCounts = {}
+    checksums = []
+
+    def collect(col, result):
+        sampleCounts, extra, messages, sampleChecksum = result
+        if checksum:
+            checksums.append(sampleChecksum)
+        for message in messages:
+            print(message)
+        counts[:, col] = sampleCounts
+        for gene, ct in extra.items():
+            extraRow = extraCounts.get(gene)
+            if extraRow is None:
+                extraRow = np.full(len(indices), -1, dtype=np.int32)
+                extraCounts[gene] = extraRow
+            extraRow[col] = ct
+
+    if nrthreads > 1 and len(indices) > 1:
+        with ProcessPoolExecutor(max_workers=nrthreads, initializer=initWorker, initargs=(geneIndex,)) as executor:
+            futures = []
+            for i in indices:
+                futures.append(executor.submit(parseFile, files[i], samples[i], None, checksum))
+            for col in range(len(indices)):
+                collect(col, futures[col].result())
+                futures[col] = None
+                print(f"{col + 1}/{len(indices)} files parsed", end='\r')
+    else:
+        for col, i in enumerate(indices):
+            collect(col, parseFile(files[i], samples[i], geneIndex, checksum))
+            print(f"{col + 1}/{len(indices)} files parsed", end='\r')
+    print(f"{len(indices)}/{len(indices)} files parsed", end='\n')
+    return counts, extraCounts, checksums
+
+if storedir is not None:
+    # incremental mode: parse new and changed files into a new column chunk of the store, mask
+    # removed samples, then write the matrix from the store
+    store = MatrixStore(storedir)
+    if len(store.features) == 0:
+        store.addFeatures(readGenes(files[0]))
+    update, removed = store.status(samples, files)
+    print(f"Store {storedir}: {len(store.active())} samples, {len(update)} new or changed files, {len(removed)} removed samples")
+    if len(removed) > 0:
+        store.mask(removed)
+    if len(update) > 0:
+        counts, extraCounts, checksums = parseColumns(update, store.featureIndex, checksum=True)
+        if len(extraCounts) > 0:
+            print(f"{len(extraCounts)} genes added to the store")
+            store.addFeatures(list(extraCounts.keys()))
+            counts = np.vstack([counts, np.array(list(extraCounts.values()), dtype=np.int32)])
+        # files that were touched but not changed keep their column
+        keep = [col for col, i in enumerate(update) if not store.touch(samples[i], files[i], checksums[col])]
+        if len(keep) > 0:
+            store.append([samples[update[col]] for col in keep], [files[update[col]] for col in keep],
+                         [checksums[col] for col in keep], counts[:, keep])
+        store.writeManifest()
+        counts = None
+    if args.compact:
+        print("Compacting store")
+        store.compact()
+
+    print(f"{nrsamples} samples found.")
+    print(f"Writing {outfile}")
+    nrgenes = store.export(outfile, samples=samples, sortFeatures=True, threads=nrthreads)
+    print(f"{nrgenes} genes found.")
+    if binaryout is not None:
+        print(f"Writing {binaryout}")
+        store.exportBinary(binaryout, samples=samples, sortFeatures=True)
+    sys.exit(0)
+
+indexGenes = readGenes(files[0])
+geneIndex = {}
+for gene in indexGenes:
+    if gene not in geneIndex:
+        geneIndex[gene] = len(geneIndex)
+indexGenes = list(geneIndex.keys())
+print(f"{len(indexGenes)} genes in gene index from: {files[0]}")
+
+counts, extraCounts, _ = parseColumns(list(range(nrsamples)), geneIndex)
+
+if len(extraCounts) > 0:
+    print(f"{len(extraCounts)} genes not in the gene index of the first file")
+    indexGenes = indexGenes + list(extraCounts.keys())
+    counts = np.vstack([counts, np.array(list(extraCounts.values()), dtype=np.int32)])
+    extraCounts = None
+
+genes = sorted(indexGenes)
+order = np.array([i for _, i in sorted(zip(indexGenes, range(len(indexGenes))))], dtype=np.int64)
+nrgenes = len(genes)
 
 print(f"{nrsamples} samples found.")
 print(f"{nrgenes} genes found.")
 
 print(f"Writing {outfile}")
 
-fho = getfho(outfile)
+# rows are formatted (and compressed) in blocks on the pool; gzip members are concatenated in order
+executor = ProcessPoolExecutor(max_workers=nrthreads) if nrthreads > 1 else None
+compress = outfile.endswith(".gz")
+fho = open(outfile,'wb')
 header = "-\t"+"\t".join(samples)+"\n"
-fho.write(header)
+fho.write(gzip.compress(header.encode(), 6) if compress else header.encode())
+blocksize = max(1, 5000000 // max(1, nrsamples))
+blocks = [(b, min(b + blocksize, nrgenes)) for b in range(0, nrgenes, blocksize)]
 ctr = 0
-for gene in genes:
-    
-    outct = []
-    for sample in samples:
-        # do stuff
-        sampledata = data.get(sample)
-        if sampledata is None:
-            print("Sample found, but not loaded: "+sample)
-            sys.exit(-1)
+pending = []
+for b in range(len(blocks) + 1):
+    if b < len(blocks):
+        r0, r1 = blocks[b]
+        if executor is not None:
+            pending.append((r1 - r0, executor.submit(formatBlock, genes[r0:r1], counts[order[r0:r1]], compress)))
         else:
-            genect = sampledata.get(gene)
-            if genect is None:
-                outct.append("nan")
-            else:
-                outct.append(genect)
-    outln = gene+"\t"+"\t".join(outct)+"\n"
-    fho.write(outln)
-    ctr += 1
-    if ctr % 1000 == 0:
+            pending.append((r1 - r0, formatBlock(genes[r0:r1], counts[order[r0:r1]], compress)))
+    while len(pending) > 0 and (b == len(blocks) or len(pending) >= 2 * nrthreads):
+        n, result = pending.pop(0)
+        fho.write(result.result() if executor is not None else result)
+        ctr += n
         print(f"{ctr} lines written",end='\r')
 print(f"{ctr} lines written",end='\n')
 fho.close()
+if executor is not None:
+    executor.shutdown()
 
+if binaryout is not None:
+    print(f"Writing {binaryout}")
+    np.savez(binaryout, counts=counts[order], genes=np.array(genes), samples=np.array(samples))
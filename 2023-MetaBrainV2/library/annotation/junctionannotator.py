@@ -0,0 +1,177 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from features.feature import Feature
+from features.strand import Strand
+from parsers.GTFAnnotationStore import GTFAnnotationStore
+
+# Junction -> gene annotation on a GTFAnnotationStore. Junctions are partitioned by chromosome and
+# each partition is annotated with array operations: one batch interval query for the genes within
+# the wiggle, then CSR expansions (gene -> transcripts -> exons) to find the overlapping transcripts
+# and exons. Partitions are processed on a process pool; workers load the store from its cache file.
+
+STORE = None
+
+
+def initWorker(gtffile, cachefile):
+    global STORE
+    STORE = GTFAnnotationStore(gtffile, cachefile=cachefile, verbose=False)
+
+
+def expand(offsets, keys):
+    # for each key, all positions in [offsets[key], offsets[key + 1]); returns (owner, position)
+    counts = offsets[keys + 1] - offsets[keys]
+    owner = np.repeat(np.arange(len(keys)), counts)
+    firstpos = np.cumsum(counts) - counts
+    position = np.arange(int(counts.sum())) - firstpos[owner] + offsets[keys][owner]
+    return owner, position
+
+
+def coordStrs(chrcode, starts, stops):
+    return [f"{chrcode}:{sta}-{sto}" for sta, sto in zip(starts.tolist(), stops.tolist())]
+
+
+def annotatePartition(chrcode, names, starts, stops, wiggle, store=None):
+    # returns, per junction: the overlappingGenesAndExons lines, the nearest gene line (None when no
+    # gene is within the wiggle) and whether the junction overlaps a gene, transcript and exon
+    s = store if store is not None else STORE
+    n = len(names)
+    chrstr = str(chrcode)
+
+    offsets, gidx = s.getOverlappingGeneIdx(np.full(n, chrcode), starts, stops, wiggle)
+    jidx = np.repeat(np.arange(n), np.diff(offsets))
+    jsta = starts[jidx]
+    jsto = stops[jidx]
+    gsta = s.geneStart[gidx].astype(np.int64)
+    gsto = s.geneStop[gidx].astype(np.int64)
+    gdist = Feature.absoluteMinimalDistanceArray(gsta, gsto, jsta, jsto)
+    gov = Feature.overlapsArray(0, gsta, gsto, 0, jsta, jsto)
+
+    # nearest gene: first gene with the minimal distance per junction
+    nearest = np.full(n, -1, dtype=np.int64)
+    if len(gidx) > 0:
+        order = np.lexsort((np.arange(len(gidx)), gdist, jidx))
+        first = order[np.r_[True, jidx[order][1:] != jidx[order][:-1]]]
+        nearest[jidx[first]] = first
+
+    # gene -> transcript -> exon expansion, restricted to overlapping genes and transcripts
+    pairs = np.flatnonzero(gov)
+    towner, tpos = expand(s.geneTranscriptOffsets, gidx[pairs])
+    tidx = s.geneTranscripts[tpos]
+    tpair = pairs[towner]
+    tsta = s.transcriptStart[tidx].astype(np.int64)
+    tsto = s.transcriptStop[tidx].astype(np.int64)
+    tov = Feature.overlapsArray(0, tsta, tsto, 0, jsta[tpair], jsto[tpair])
+    tidx, tpair, tsta, tsto = tidx[tov], tpair[tov], tsta[tov], tsto[tov]
+    tdist = Feature.absoluteMinimalDistanceArray(tsta, tsto, jsta[tpair], jsto[tpair])
+
+    eowner, epos = expand(s.transcriptExonOffsets, tidx)
+    eidx = s.transcriptExons[epos]
+    erank = s.transcriptExonRanks[epos]
+    etr = eowner
+    esta = s.exonStart[eidx].astype(np.int64)
+    esto = s.exonStop[eidx].astype(np.int64)
+    epair = tpair[etr]
+    eov = Feature.overlapsArray(0, esta, esto, 0, jsta[epair], jsto[epair])
+    eidx, erank, etr, esta, esto, epair = eidx[eov], erank[eov], etr[eov], esta[eov], esto[eov], epair[eov]
+    edist = Feature.absoluteMinimalDistanceArray(esta, esto, jsta[epair], jsto[epair])
+
+    overlapsGene = np.zeros(n, dtype=bool)
+    overlapsGene[jidx[pairs]] = True
+    overlapsTranscript = np.zeros(n, dtype=bool)
+    overlapsTranscript[jidx[tpair]] = True
+    overlapsExon = np.zeros(n, dtype=bool)
+    overlapsExon[jidx[epair]] = True
+
+    # gene columns, formatted once per gene-junction pair that is written
+    written = np.union1d(pairs, nearest[nearest >= 0])
+    geneCols = {}
+    for p, coords in zip(written.tolist(), coordStrs(chrcode, gsta[written], gsto[written])):
+        g = int(gidx[p])
+        symbol = s.geneSymbols[g]
+        type = s.geneType[g]
+        geneCols[p] = "\t".join([s.geneIds[g], symbol if symbol != "" else "-", coords,
+                                 Strand.toStr(Strand.fromCode(int(s.geneStrand[g]))),
+                                 s.typeNames[type] if type >= 0 else "-", str(int(gdist[p]))])
+
+    # overlappingGenesAndExons lines: a gene line, then per overlapping transcript a transcript line
+    # followed by its overlapping exon lines
+    fullLines = [[] for _ in range(n)]
+    tcoords = coordStrs(chrcode, tsta, tsto)
+    ecoords = coordStrs(chrcode, esta, esto)
+    tstart = np.searchsorted(tpair, pairs, side="left")
+    tend = np.searchsorted(tpair, pairs, side="right")
+    estart = np.searchsorted(etr, np.arange(len(tidx)), side="left")
+    eend = np.searchsorted(etr, np.arange(len(tidx)), side="right")
+    for k, p in enumerate(pairs.tolist()):
+        j = int(jidx[p])
+        prefix = f"LeafCutter\t{names[j]}\t{chrstr}\t{starts[j]}\t{stops[j]}\t{geneCols[p]}"
+        lines = fullLines[j]
+        lines.append(prefix + "\t-\t-\t-\t-\t-\t-\t-\n")
+        for t in range(tstart[k], tend[k]):
+            tprefix = f"{prefix}\t{s.transcriptIds[tidx[t]]}\t{tcoords[t]}\t{tdist[t]}"
+            lines.append(tprefix + "\t-\t-\t-\t-\n")
+            for e in range(estart[t], eend[t]):
+                rank = erank[e]
+                rankstr = str(rank) if rank >= 0 else "-"
+                lines.append(f"{tprefix}\t{s.exonIds[eidx[e]]}\t{rankstr}\t{ecoords[e]}\t{edist[e]}\n")
+
+    nearestLines = [None] * n
+    for j in np.flatnonzero(nearest >= 0).tolist():
+        p = int(nearest[j])
+        nearestLines[j] = f"LeafCutterNearestGene\t{names[j]}\t{chrstr}\t{starts[j]}\t{stops[j]}\t{geneCols[p]}\t{bool(gov[p])}\n"
+
+    return ["".join(lines) for lines in fullLines], nearestLines, overlapsGene, overlapsTranscript, overlapsExon
+
+
+class JunctionAnnotator:
+
+    def __init__(self, store, gtffile, wiggle, nrprocs=1):
+        self.store = store
+        self.gtffile = gtffile
+        self.wiggle = wiggle
+        self.nrprocs = nrprocs
+
+    # names, chrcodes, starts and stops are per junction; returns results as annotatePartition,
+    # in the input order of the junctions
+    def annotate(self, names, chrcodes, starts, stops):
+        chrcodes = np.asarray(chrcodes, dtype=np.int64)
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        n = len(names)
+        partitions = []
+        for chrcode in np.unique(chrcodes).tolist():
+            sel = np.flatnonzero(chrcodes == chrcode)
+            partitions.append((chrcode, sel))
+
+        fullLines = [None] * n
+        nearestLines = [None] * n
+        overlapsGene = np.zeros(n, dtype=bool)
+        overlapsTranscript = np.zeros(n, dtype=bool)
+        overlapsExon = np.zeros(n, dtype=bool)
+
+        def collect(chrcode, sel, result):
+            full, nearest, og, ot, oe = result
+            for i, j in enumerate(sel.tolist()):
+                fullLines[j] = full[i]
+                nearestLines[j] = nearest[i]
+            overlapsGene[sel] = og
+            overlapsTranscript[sel] = ot
+            overlapsExon[sel] = oe
+            print(f"Chromosome {chrcode}: {len(sel)} junctions annotated")
+
+        nrprocs = min(self.nrprocs, len(partitions))
+        if nrprocs <= 1 or not os.path.exists(self.store.cachefile):
+            for chrcode, sel in partitions:
+                collect(chrcode, sel, annotatePartition(chrcode, [names[j] for j in sel], starts[sel], stops[sel], self.wiggle, self.store))
+        else:
+            print(f"Annotating {len(partitions)} chromosomes using {nrprocs} processes")
+            with ProcessPoolExecutor(max_workers=nrprocs, initializer=initWorker, initargs=(self.gtffile, self.store.cachefile)) as executor:
+                futures = []
+                for chrcode, sel in partitions:
+                    futures.append((chrcode, sel, executor.submit(annotatePartition, chrcode, [names[j] for j in sel], starts[sel], stops[sel], self.wiggle)))
+                for chrcode, sel, future in futures:
+                    collect(chrcode, sel, future.result())
+        return fullLines, nearestLines, overlapsGene, overlapsTranscript, overlapsExon
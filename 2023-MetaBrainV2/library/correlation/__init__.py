@@ -0,0 +1 @@
+from .correlation import pairwiseCorrelation, saveCorrelationMatrix, loadCorrelationMatrix, standardizeRows, tiledCorrelation
@@ -0,0 +1,134 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Pearson correlation between the columns of a matrix with missing values (NaN), using for each
+# pair of columns only the rows where both are present (pairwise complete observations), as
+# scipy.stats.pearsonr on the filtered values would. Instead of filtering per pair, the sums, sums
+# of squares, cross products and co-counts over the co-present rows are all matrix products on
+# zero-filled arrays:
+#   n[i,j]   = M[:,i]' M[:,j]        (M: 1 where present)
+#   sx[i,j]  = Z[:,i]' M[:,j]        (Z: values, 0 where missing)
+#   sxx[i,j] = (Z*Z)[:,i]' M[:,j]
+#   sxy[i,j] = Z[:,i]' Z[:,j]
+# Columns are centered on their mean first, which does not change the correlations but avoids
+# cancellation in the sums of squares. The matrix is computed in tiles of columns, so that the
+# intermediate products are at most tilesize x tilesize.
+
+
+def tileArrays(values, c0, c1):
+    # Z, Z*Z and M of the columns c0:c1, with the columns centered on their mean
+    tile = np.asarray(values[:, c0:c1], dtype=np.float64)
+    present = ~np.isnan(tile)
+    means = np.nanmean(tile, axis=0)
+    Z = np.where(present, tile - np.nan_to_num(means), 0)
+    return Z, Z * Z, present.astype(np.float64)
+
+
+def pairwiseCorrelation(values, tilesize=1000, threads=1, undefined=0.0):
+    # values: rows x columns, NaN for missing values. Returns a columns x columns matrix; pairs
+    # without a defined correlation (less than 2 co-present rows, or no variance) get undefined.
+    # Z, Z*Z and M are made per tile of columns, so that besides the result at most two tiles of
+    # them (per thread) are in memory.
+    values = np.asarray(values)
+    ncols = values.shape[1]
+
+    cor = np.empty((ncols, ncols))
+    tiles = [(a, min(a + tilesize, ncols)) for a in range(0, ncols, tilesize)]
+
+    def computeTile(tileI, arraysI, tileJ, arraysJ):
+        i0, i1 = tileI
+        j0, j1 = tileJ
+        Zi, ZZi, Mi = arraysI
+        Zj, ZZj, Mj = arraysJ
+        n = Mi.T @ Mj
+        sx = Zi.T @ Mj
+        sy = Mi.T @ Zj
+        sxx = ZZi.T @ Mj
+        syy = Mi.T @ ZZj
+        sxy = Zi.T @ Zj
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = sxy - sx * sy / n
+            varx = sxx - sx * sx / n
+            vary = syy - sy * sy / n
+            r = cov / np.sqrt(varx * vary)
+        r[~((n >= 2) & (varx > 0) & (vary > 0))] = undefined
+        np.clip(r, -1, 1, out=r)
+        cor[i0:i1, j0:j1] = r
+        cor[j0:j1, i0:i1] = r.T
+
+    def computeRowTile(a):
+        # the tiles of row a from the diagonal on; the arrays of the other tiles are made per tile
+        arraysI = tileArrays(values, *tiles[a])
+        computeTile(tiles[a], arraysI, tiles[a], arraysI)
+        for b in range(a + 1, len(tiles)):
+            computeTile(tiles[a], arraysI, tiles[b], tileArrays(values, *tiles[b]))
+
+    if threads > 1:
+        # the matrix products release the GIL
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for future in [executor.submit(computeRowTile, a) for a in range(len(tiles))]:
+                future.result()
+    else:
+        for a in range(len(tiles)):
+            computeRowTile(a)
+
+    np.fill_diagonal(cor, 1)
+    return cor
+
+
+def saveCorrelationMatrix(filename, cor, names):
+    np.savez(filename, cor=cor, names=np.array(names, dtype=str))
+
+
+def loadCorrelationMatrix(filename):
+    with np.load(filename, allow_pickle=False) as data:
+        return data["cor"], data["names"].tolist()
+
+
+# Correlation between the rows of a complete matrix (no missing values), e.g. genes x samples, for
+# matrices whose correlation matrix does not fit in memory. Rows are centered and scaled to unit
+# length, so that the correlation matrix is Z Z'; it is computed in tiles of rows (one matrix
+# product per tile) and written to a memory-mapped .npy file.
+
+def standardizeRows(values, dtype=np.float32):
+    # rows centered and scaled to unit length; rows without variance are all 0
+    values = np.asarray(values, dtype=np.float64)
+    Z = values - values.mean(axis=1, keepdims=True)
+    norms = np.sqrt((Z * Z).sum(axis=1, keepdims=True))
+    Z = np.divide(Z, norms, out=np.zeros_like(Z), where=norms > 0)
+    return Z.astype(dtype, copy=False)
+
+
+def tiledCorrelation(Z, outfile, tilesize=2000, threads=1):
+    # Z: rows x columns, rows standardized with standardizeRows (may be a memmap). Returns the rows x
+    # rows correlation matrix as a memmap of outfile (.npy, dtype of Z); rows without variance have
+    # correlation 0 with the other rows.
+    nrows = Z.shape[0]
+    cor = np.lib.format.open_memmap(outfile, mode='w+', dtype=Z.dtype, shape=(nrows, nrows))
+    tiles = [(a, min(a + tilesize, nrows)) for a in range(0, nrows, tilesize)]
+
+    def computeRowTile(a):
+        # upper triangle of the tiles in row a, mirrored to the lower triangle
+        i0, i1 = tiles[a]
+        Zi = np.asarray(Z[i0:i1])
+        for b in range(a, len(tiles)):
+            j0, j1 = tiles[b]
+            r = Zi @ np.asarray(Z[j0:j1]).T
+            np.clip(r, -1, 1, out=r)
+            cor[i0:i1, j0:j1] = r
+            if b != a:
+                cor[j0:j1, i0:i1] = r.T
+
+    if threads > 1:
+        # the matrix products release the GIL
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for future in [executor.submit(computeRowTile, a) for a in range(len(tiles))]:
+                future.result()
+    else:
+        for a in range(len(tiles)):
+            computeRowTile(a)
+
+    idx = np.arange(nrows)
+    cor[idx, idx] = 1
+    cor.flush()
+    return cor
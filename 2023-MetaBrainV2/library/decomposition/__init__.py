@@ -0,0 +1,2 @@
+from .pca import PCA, randomizedSVD
+from .eigh import truncatedEigh, tiledProduct
@@ -0,0 +1,48 @@
+import numpy as np
+
+from .pca import PCA
+
+# Largest eigenvalues and eigenvectors of a symmetric positive semi-definite matrix (e.g. a
+# correlation matrix) that may be a memory-mapped .npy file larger than memory. Block subspace
+# iteration: a random block of k + oversamples vectors is multiplied with the matrix nIter times,
+# with a QR decomposition after each product, after which the Rayleigh-Ritz projection Q'AQ gives the
+# eigenvalues and eigenvectors. Each product reads the matrix once, in tiles of rows. When the block
+# would cover (almost) the whole matrix, the matrix is loaded and decomposed directly. Eigenvector
+# signs are chosen such that the largest absolute loading of each eigenvector is positive.
+
+
+def tiledProduct(A, B, tilesize=2000):
+    # A @ B, reading A in tiles of rows; the products are done in the dtype of A
+    out = np.empty((A.shape[0], B.shape[1]), dtype=np.float64)
+    Bt = B.astype(A.dtype, copy=False)
+    for r0 in range(0, A.shape[0], tilesize):
+        r1 = min(r0 + tilesize, A.shape[0])
+        out[r0:r1] = np.asarray(A[r0:r1]) @ Bt
+    return out
+
+
+def truncatedEigh(A, k, oversamples=10, nIter=7, tilesize=2000, seed=0, verbose=False):
+    # returns the k largest eigenvalues (descending) and the corresponding eigenvectors (n x k)
+    n = A.shape[0]
+    k = min(k, n)
+    nRandom = min(k + oversamples, n)
+    if nRandom >= 0.8 * n:
+        if verbose:
+            print("Eigendecomposition of the full {} x {} matrix".format(n, n))
+        eigenvalues, V = PCA.eigh(np.asarray(A, dtype=np.float64), k)
+    else:
+        rng = np.random.RandomState(seed)
+        Q = rng.standard_normal((n, nRandom))
+        for i in range(nIter):
+            if verbose:
+                print("Subspace iteration {}/{}".format(i + 1, nIter), end='\r', flush=True)
+            Q, _ = np.linalg.qr(tiledProduct(A, Q, tilesize))
+        if verbose:
+            print("")
+        T = Q.T @ tiledProduct(A, Q, tilesize)
+        eigenvalues, W = np.linalg.eigh((T + T.T) / 2)
+        order = np.argsort(eigenvalues)[::-1][:k]
+        eigenvalues, V = eigenvalues[order], Q @ W[:, order]
+    signs = np.sign(V[np.argmax(np.abs(V), axis=0), np.arange(V.shape[1])])
+    signs[signs == 0] = 1
+    return eigenvalues, V * signs
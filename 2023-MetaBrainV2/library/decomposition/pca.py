@@ -0,0 +1,156 @@
+import numpy as np
+
+# PCA that only computes the requested number of components. Mirrors the parts of the
+# sklearn.decomposition.PCA interface that the pipeline scripts use (fit, fit_transform, transform,
+# components_, explained_variance_, explained_variance_ratio_, singular_values_, mean_), so that it
+# can replace it directly. Solvers:
+#   full        LAPACK SVD of the centered matrix; all components are computed, then truncated
+#   randomized  randomized range finder with power iterations (Halko et al. 2011); only the
+#               requested components (plus some oversampling) are computed
+#   arpack      accepted for compatibility with sklearn options, uses the randomized solver
+#   auto        randomized when less than 80% of the components of a larger (>500) matrix are
+#               requested, full otherwise
+# fitFile() fits on a matrix file that is too large to load at once: rows are read in chunks and
+# only a samples x samples cross-product matrix is kept in memory (see fitFile).
+# Component signs are chosen such that the largest absolute loading of each component is positive.
+
+
+def randomizedSVD(X, nComponents, oversamples=10, nIter=7, seed=0):
+    # truncated SVD of X: returns U (n x k), s (k) and Vt (k x p)
+    rng = np.random.RandomState(seed)
+    nRandom = min(nComponents + oversamples, min(X.shape))
+    Q = X @ rng.standard_normal((X.shape[1], nRandom)).astype(X.dtype, copy=False)
+    for _ in range(nIter):
+        Q, _ = np.linalg.qr(Q)
+        Q, _ = np.linalg.qr(X.T @ Q)
+        Q = X @ Q
+    Q, _ = np.linalg.qr(Q)
+    Uh, s, Vt = np.linalg.svd(Q.T @ X, full_matrices=False)
+    return (Q @ Uh)[:, :nComponents], s[:nComponents], Vt[:nComponents]
+
+
+def flipSigns(U, Vt):
+    signs = np.sign(Vt[np.arange(Vt.shape[0]), np.argmax(np.abs(Vt), axis=1)])
+    signs[signs == 0] = 1
+    return U * signs, Vt * signs[:, None]
+
+
+class PCA:
+
+    def __init__(self, n_components=None, solver="auto", dtype=np.float64, seed=0, verbose=False):
+        self.n_components = n_components
+        self.solver = solver
+        self.dtype = dtype
+        self.seed = seed
+        self.verbose = verbose
+
+    def chooseSolver(self, nComponents, shape):
+        if self.solver == "arpack":
+            return "randomized"
+        if self.solver != "auto":
+            return self.solver
+        if max(shape) > 500 and nComponents < 0.8 * min(shape):
+            return "randomized"
+        return "full"
+
+    def setResult(self, U, s, Vt, nSamples, totalVariance):
+        U, Vt = flipSigns(U, Vt)
+        self.components_ = Vt
+        self.singular_values_ = s
+        self.explained_variance_ = (s * s) / (nSamples - 1)
+        self.explained_variance_ratio_ = self.explained_variance_ / totalVariance if totalVariance > 0 else np.zeros(len(s))
+        self.scores_ = U * s
+        self.n_components_ = len(s)
+
+    # X: samples (observations) x features
+    def fit(self, X):
+        X = np.asarray(X, dtype=self.dtype)
+        nSamples = X.shape[0]
+        self.mean_ = X.mean(axis=0)
+        Xc = X - self.mean_
+        k = min(X.shape) if self.n_components is None else min(self.n_components, min(X.shape))
+        solver = self.chooseSolver(k, X.shape)
+        if self.verbose:
+            print("PCA: {} components of a {} x {} matrix, {} solver".format(k, X.shape[0], X.shape[1], solver))
+        if solver == "randomized":
+            U, s, Vt = randomizedSVD(Xc, k, seed=self.seed)
+        elif solver == "full":
+            U, s, Vt = np.linalg.svd(Xc, full_matrices=False)
+            U, s, Vt = U[:, :k], s[:k], Vt[:k]
+        else:
+            raise ValueError("Unknown PCA solver: " + str(solver))
+        totalVariance = float((Xc * Xc).sum(dtype=np.float64)) / (nSamples - 1)
+        self.setResult(U, s, Vt, nSamples, totalVariance)
+        return self
+
+    def fit_transform(self, X):
+        return self.fit(X).scores_
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=self.dtype) - self.mean_) @ self.components_.T
+
+    # Fits on a (gzipped) text matrix with features on the rows and samples (observations) on the
+    # columns, e.g. genes x samples, as PCA().fit(df.T) would. The file is read twice in chunks of
+    # rows. The first pass centers each row and accumulates the samples x samples matrix G = Xc Xc'
+    # (float64), whose eigenvectors are the left singular vectors U of Xc, with the squared singular
+    # values as eigenvalues. The second pass computes the loadings of each chunk of features,
+    # V = Xc' U / s. Memory use is samples x samples plus one chunk, instead of the full matrix.
+    # Row and column names are stored in feature_names_ and sample_names_.
+    def fitFile(self, path, sep="\t", chunksize=5000):
+        import pandas as pd
+
+        G = None
+        means = []
+        self.feature_names_ = []
+        totalSS = 0.0
+        for chunk in pd.read_csv(path, sep=sep, index_col=0, chunksize=chunksize):
+            C = chunk.to_numpy(dtype=self.dtype)
+            rowMeans = C.mean(axis=1, keepdims=True)
+            C = C - rowMeans
+            if G is None:
+                G = np.zeros((C.shape[1], C.shape[1]))
+                self.sample_names_ = list(chunk.columns)
+            G += C.T @ C
+            totalSS += float((C * C).sum(dtype=np.float64))
+            means.append(rowMeans[:, 0])
+            self.feature_names_.extend(chunk.index)
+            if self.verbose:
+                print("{} rows read".format(len(self.feature_names_)), end='\r', flush=True)
+        if G is None:
+            raise ValueError("No data in " + path)
+        self.mean_ = np.concatenate(means)
+        nSamples = G.shape[0]
+        k = min(nSamples, len(self.feature_names_))
+        if self.n_components is not None:
+            k = min(k, self.n_components)
+        if self.verbose:
+            print("\nPCA: {} components of a {} x {} matrix, eigendecomposition of {} x {} cross products".format(k, nSamples, len(self.feature_names_), nSamples, nSamples))
+
+        eigenvalues, U = self.eigh(G, k)
+        s = np.sqrt(np.maximum(eigenvalues, 0))
+        sInv = np.divide(1, s, out=np.zeros_like(s), where=s > 0)
+        U = U.astype(self.dtype)
+
+        V = np.zeros((len(self.feature_names_), k), dtype=self.dtype)
+        offset = 0
+        for chunk in pd.read_csv(path, sep=sep, index_col=0, chunksize=chunksize):
+            C = chunk.to_numpy(dtype=self.dtype)
+            C = C - C.mean(axis=1, keepdims=True)
+            V[offset:offset + len(C)] = (C @ U) * sInv.astype(self.dtype)
+            offset += len(C)
+
+        self.setResult(U, s, V.T, nSamples, totalSS / (nSamples - 1))
+        return self
+
+    @staticmethod
+    def eigh(G, k):
+        # the k largest eigenvalues and eigenvectors of symmetric G, in descending order
+        n = G.shape[0]
+        try:
+            import scipy.linalg
+            eigenvalues, U = scipy.linalg.eigh(G, subset_by_index=[n - k, n - 1])
+        except (ImportError, TypeError):
+            # no scipy, or a version without subset_by_index
+            eigenvalues, U = np.linalg.eigh(G)
+            eigenvalues, U = eigenvalues[n - k:], U[:, n - k:]
+        return eigenvalues[::-1], U[:, ::-1]
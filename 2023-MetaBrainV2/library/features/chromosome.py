@@ -32,6 +32,22 @@ class Chromosome(Enum):
 
     @classmethod
     def parse(self, chrstr):
+        chr = PARSECACHE.get(chrstr)
+        if chr is None:
+            chr = Chromosome.parseUncached(chrstr)
+            PARSECACHE[chrstr] = chr
+        return chr
+
+    @classmethod
+    def parseCode(self, chrstr):
+        return Chromosome.parse(chrstr).value
+
+    @classmethod
+    def fromCode(self, code):
+        return CODETOCHROMOSOME[code]
+
+    @classmethod
+    def parseUncached(self, chrstr):
         chrstr = chrstr.lower()
         chrstr = chrstr.replace("chr","")
         if chrstr == "m" or chrstr == "mt":
@@ -57,4 +73,8 @@ class Chromosome(Enum):
         return self.name
     
     def isAutosomal(self):
-        return (self.value > 0 and self.value < 23)
\ No newline at end of file
+        return (self.value > 0 and self.value < 23)
+
+# chromosome codes are the enum values; the parse cache avoids string handling for repeated names
+CODETOCHROMOSOME = {chr.value: chr for chr in Chromosome}
+PARSECACHE = {}
@@ -2,19 +2,20 @@ from enum import Enum
 from features.feature import Feature
 
 class Exon(Feature):
-    gene = None
-    transcripts = None
-    name = None
+    __slots__ = ('gene', 'transcripts', 'name')
 
     def __init__(self, chr, start, stop, strand, name, gene):
         Feature.__init__(self,chr,start,stop,strand)
         self.name = name
         self.gene = gene
+        self.transcripts = None
 
     def addTranscript(self, transcript):
-        if self.transcripts is None:
-            self.transcripts = set()
-        self.transcripts.add(transcript)
+        self.transcripts = Feature.addRelation(self.transcripts, transcript)
+
+    # transcripts are made unique, as in a set
+    def freeze(self):
+        self.transcripts = Feature.freezeRelation(self.transcripts, unique=True)
 
     def describe(self):
         nrTranscripts = 0
@@ -1,8 +1,12 @@
+import numpy as np
+
+from features.chromosome import Chromosome
+from features.strand import Strand
+
 class Feature:
-    chr = None
-    start = None
-    stop = None
-    strand = None
+    # chromosome and strand are stored as integer codes (see Chromosome.getNumber and Strand.getCode);
+    # chr and strand remain available as enum properties
+    __slots__ = ('chrCode', 'start', 'stop', 'strandCode')
 
     def __init__(self, chr, start, stop, strand):
         self.chr = chr
@@ -10,8 +14,58 @@ class Feature:
         self.stop = stop
         self.strand = strand
 
+    @property
+    def chr(self):
+        return None if self.chrCode is None else Chromosome.fromCode(self.chrCode)
+
+    @chr.setter
+    def chr(self, chr):
+        self.chrCode = None if chr is None else chr.value
+
+    @property
+    def strand(self):
+        return None if self.strandCode is None else Strand.fromCode(self.strandCode)
+
+    @strand.setter
+    def strand(self, strand):
+        self.strandCode = None if strand is None else strand.getCode()
+
+    # relations (e.g. the transcripts of a gene) are collected in a list while they are added, and
+    # stored as a tuple by freeze() once the annotation is loaded; adding to a frozen relation turns
+    # it into a list again
+    @staticmethod
+    def addRelation(relation, obj):
+        if relation is None:
+            return [obj]
+        if type(relation) is tuple:
+            relation = list(relation)
+        relation.append(obj)
+        return relation
+
+    # as addRelation, but for relations that are sets: an insertion-ordered dict is used while they are
+    # added, so duplicates are skipped
+    @staticmethod
+    def addUniqueRelation(relation, obj):
+        if relation is None:
+            return {obj: None}
+        if type(relation) is tuple:
+            relation = dict.fromkeys(relation)
+        relation[obj] = None
+        return relation
+
+    @staticmethod
+    def freezeRelation(relation, unique=False):
+        if relation is None:
+            return None
+        if unique:
+            return tuple(dict.fromkeys(relation))
+        return tuple(relation)
+
+    def freeze(self):
+        pass
+
     def overlaps(self, other):
-        if self.chr != other.chr:
+        if self.chrCode != other.chrCode:
             return False
         if self.start > other.stop:
             return False
@@ -20,9 +74,9 @@ class Feature:
         return True
 
     def overlapsStrand(self, other):
-        ov = self.overlap(other)
+        ov = self.overlaps(other)
         if ov:
-            return self.strand == other.strand
+            return self.strandCode == other.strandCode
 
     def bpOverlap(self, other):
         ov = self.overlaps(other)
@@ -61,4 +115,25 @@ class Feature:
         return mind
     
     def coordToStr(self):
-        return f"{self.chr.getNumber()}:{self.start}-{self.stop}"
\ No newline at end of file
+        return f"{self.chrCode}:{self.start}-{self.stop}"
+
+    # array counterparts of overlaps, bpOverlap and absoluteMinimalDistance; arguments are numpy
+    # arrays (or scalars) of chromosome codes and coordinates, which are broadcast against each other
+
+    @staticmethod
+    def overlapsArray(chrA, startA, stopA, chrB, startB, stopB):
+        return (np.asarray(chrA) == np.asarray(chrB)) & (np.asarray(startA) <= np.asarray(stopB)) & (np.asarray(stopA) >= np.asarray(startB))
+
+    @staticmethod
+    def bpOverlapArray(chrA, startA, stopA, chrB, startB, stopB):
+        ov = Feature.overlapsArray(chrA, startA, stopA, chrB, startB, stopB)
+        return np.where(ov, np.minimum(stopA, stopB) - np.maximum(startA, startB), 0)
+
+    @staticmethod
+    def absoluteMinimalDistanceArray(startA, stopA, startB, stopB):
+        startA = np.asarray(startA)
+        stopA = np.asarray(stopA)
+        startB = np.asarray(startB)
+        stopB = np.asarray(stopB)
+        return np.minimum(np.minimum(np.abs(startA - startB), np.abs(startA - stopB)),
+                          np.minimum(np.abs(stopA - startB), np.abs(stopA - stopB)))
@@ -2,20 +2,20 @@ from enum import Enum
 from features.feature import Feature
 
 class Gene(Feature):
-    name = None
-    symbol = None
-    transcripts = None
-    type = None
+    __slots__ = ('name', 'symbol', 'transcripts', 'type')
 
     def __init__(self, chr, start, stop, strand, name, symbol):
         Feature.__init__(self,chr,start,stop,strand)
         self.name = name
         self.symbol = symbol
+        self.transcripts = None
+        self.type = None
     
     def addTranscript(self, transcript):
-        if self.transcripts is None:
-            self.transcripts = []
-        self.transcripts.append(transcript)
+        self.transcripts = Feature.addRelation(self.transcripts, transcript)
+
+    def freeze(self):
+        self.transcripts = Feature.freezeRelation(self.transcripts)
 
     def setType(self, type):
         self.type = type
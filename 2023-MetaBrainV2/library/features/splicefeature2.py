@@ -3,15 +3,15 @@ from features.chromosome import Chromosome
 from features.strand import Strand
 
 class SpliceFeature(Feature):
-    name = None
-    genes = None
-    transcripts = None
-    exons = None
-    clusterId = None
+    __slots__ = ('name', 'genes', 'transcripts', 'exons', 'clusterId')
 
     def __init__(self, chr, start, stop, strand, name):
         Feature.__init__(self,chr,start,stop,strand)
         self.name = name
+        self.genes = None
+        self.transcripts = None
+        self.exons = None
+        self.clusterId = None
 
     @classmethod
     def parseLeafCutter(self,str):
@@ -30,19 +30,19 @@ class SpliceFeature(Feature):
         self.clusterId = clu
         
     def addGene(self, gene):
-        if self.genes is None:
-            self.genes = set()
-        self.genes.add(gene)
+        self.genes = Feature.addUniqueRelation(self.genes, gene)
     
     def addTranscript(self, transcript):
-        if self.transcripts is None:
-            self.transcripts = set()
-        self.transcripts.add(transcript)
+        self.transcripts = Feature.addUniqueRelation(self.transcripts, transcript)
 
-    def addTranscript(self, exon):
-        if self.exons is None:
-            self.exons = set()
-        self.transcripts.add(exon)
+    def addExon(self, exon):
+        self.exons = Feature.addUniqueRelation(self.exons, exon)
+
+    # relations are sets (see Feature.addUniqueRelation); freeze() stores them as tuples
+    def freeze(self):
+        self.genes = Feature.freezeRelation(self.genes)
+        self.transcripts = Feature.freezeRelation(self.transcripts)
+        self.exons = Feature.freezeRelation(self.exons)
 
     def describe(self):
         return "SpliceSite: {}:{}-{} {}".format(self.chr,self.start,self.stop,self.name)
\ No newline at end of file
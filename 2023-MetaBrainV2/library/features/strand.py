@@ -7,16 +7,36 @@ class Strand(Enum):
 
     @classmethod
     def parse(self, chrstr):
-        chrstr = chrstr.lower()
-        if chrstr == "+" or chrstr == "1":
-            return Strand.POS
-        if chrstr == "-" or chrstr == "-1":
-            return Strand.NEG
-        return Strand.NA
+        strand = PARSECACHE.get(chrstr)
+        if strand is None:
+            strand = Strand.NA
+            lower = chrstr.lower()
+            if lower == "+" or lower == "1":
+                strand = Strand.POS
+            elif lower == "-" or lower == "-1":
+                strand = Strand.NEG
+            PARSECACHE[chrstr] = strand
+        return strand
+
+    @classmethod
+    def parseCode(self, chrstr):
+        return STRANDTOCODE[Strand.parse(chrstr)]
+
+    @classmethod
+    def fromCode(self, code):
+        return CODETOSTRAND[code]
+
+    def getCode(self):
+        return STRANDTOCODE[self]
     
     def toStr(str):
         if str == Strand.NA:
             return "NA"
         if str == Strand.POS:
             return "+"
-        return "-"    
\ No newline at end of file
+        return "-"    
+
+# integer codes, for compact storage in features and arrays
+STRANDTOCODE = {Strand.POS: 1, Strand.NEG: -1, Strand.NA: 0}
+CODETOSTRAND = {1: Strand.POS, -1: Strand.NEG, 0: Strand.NA}
+PARSECACHE = {}
@@ -2,20 +2,20 @@ from enum import Enum
 from features.feature import Feature
 
 class Transcript(Feature):
-    gene = None
-    name = None
-    exons = None
-    exonRanks = None
+    __slots__ = ('gene', 'name', 'exons', 'exonRanks')
 
     def __init__(self, chr, start, stop, strand, name, gene):
         Feature.__init__(self,chr,start,stop,strand)
         self.name = name
         self.gene = gene
+        self.exons = None
+        self.exonRanks = None
 
     def addExon(self, exon):
-        if self.exons is None:
-            self.exons = []
-        self.exons.append(exon)
+        self.exons = Feature.addRelation(self.exons, exon)
+
+    def freeze(self):
+        self.exons = Feature.freezeRelation(self.exons)
 
     def setExonRank(self, exon, rank):
         if self.exonRanks is None:
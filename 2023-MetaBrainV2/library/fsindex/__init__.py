@@ -0,0 +1 @@
+from .fsindex import DirectoryIndex, SampleMatcher
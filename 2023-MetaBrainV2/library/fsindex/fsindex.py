@@ -0,0 +1,176 @@
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Directory index for large sample trees on slow (shared) filesystems. Directories are listed with
+# os.scandir on a thread pool, one tree level at a time. The listing of every directory (subdirectory
+# names, file names with size and mtime) can be kept in a cache file together with the mtime of the
+# directory; a directory whose mtime did not change is not listed again on the next update, which
+# then costs one stat per directory. Directory mtimes change when entries are added, removed or
+# renamed, not when a file is rewritten in place, so cached file sizes/mtimes can be out of date for
+# such files. walk() yields the files in the order of a recursive os.listdir walk.
+
+FILE = "F"
+DIRECTORY = "D"
+MATCHED = -1
+
+
+class SampleMatcher:
+    # Aho-Corasick automaton over a list of substrings (e.g. sample names): scan(text) tells whether
+    # any of the substrings occurs in text in one pass over text. scan() can continue from the state
+    # returned by an earlier scan, so the state of a directory path can be reused for its files.
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [False]
+        for pattern in patterns:
+            state = 0
+            for c in pattern:
+                next = self.goto[state].get(c)
+                if next is None:
+                    next = len(self.goto)
+                    self.goto[state][c] = next
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(False)
+                state = next
+            self.out[state] = True
+        # breadth-first: failure links and outputs of the longest proper suffix that is a prefix
+        queue = list(self.goto[0].values())
+        i = 0
+        while i < len(queue):
+            state = queue[i]
+            i += 1
+            for c, next in self.goto[state].items():
+                queue.append(next)
+                f = self.fail[state]
+                while f > 0 and c not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(c, 0)
+                self.fail[next] = f if f != next else 0
+                self.out[next] = self.out[next] or self.out[self.fail[next]]
+
+    def scan(self, text, state=0):
+        # returns MATCHED when a substring occurs in text (or already occurred before state), the
+        # automaton state after text otherwise
+        if state == MATCHED or self.out[state]:
+            return MATCHED
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        for c in text:
+            while state > 0 and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                return MATCHED
+        return state
+
+    def contains(self, text, state=0):
+        return self.scan(text, state) == MATCHED
+
+
+def scanDirectory(path):
+    # entries of a directory: (name, FILE, size, mtime) or (name, DIRECTORY, 0, 0)
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((entry.name, FILE, stat.st_size, stat.st_mtime_ns))
+            elif entry.is_dir():
+                entries.append((entry.name, DIRECTORY, 0, 0))
+    return entries
+
+
+class DirectoryIndex:
+
+    def __init__(self, root, cachefile=None, threads=8):
+        self.root = root
+        self.cachefile = cachefile
+        self.threads = threads
+        self.dirs = {}
+        self.cache = {}
+        self.nrscanned = 0
+        self.nrreused = 0
+        if cachefile is not None and os.path.exists(cachefile):
+            self.cache = self.readCache(cachefile)
+
+    @staticmethod
+    def readCache(cachefile):
+        cache = {}
+        entries = None
+        with gzip.open(cachefile, 'rt') as fh:
+            for line in fh:
+                elems = line.rstrip("\n").split("\t")
+                if elems[0] == "#":
+                    entries = []
+                    cache[elems[1]] = (int(elems[2]), entries)
+                elif elems[1] == FILE:
+                    entries.append((elems[0], FILE, int(elems[2]), int(elems[3])))
+                else:
+                    entries.append((elems[0], DIRECTORY, 0, 0))
+        return cache
+
+    def writeCache(self, cachefile):
+        tmp = cachefile + ".tmp"
+        with gzip.open(tmp, 'wt') as fh:
+            for path, (mtime, entries) in self.dirs.items():
+                # names with tabs or newlines are not stored; those directories are listed every time
+                if "\t" in path or "\n" in path or any("\t" in e[0] or "\n" in e[0] for e in entries):
+                    continue
+                fh.write("#\t" + path + "\t" + str(mtime) + "\n")
+                for name, kind, size, fmtime in entries:
+                    fh.write(name + "\t" + kind + "\t" + str(size) + "\t" + str(fmtime) + "\n")
+        os.replace(tmp, cachefile)
+
+    def refresh(self, path):
+        # (mtime, entries) of a directory, from the cache when its mtime did not change; the mtime
+        # is taken before listing, so changes during the listing show up on the next update
+        stat = os.stat(path)
+        key = (stat.st_dev, stat.st_ino)
+        cached = self.cache.get(path)
+        if cached is not None and stat.st_mtime_ns == cached[0]:
+            return cached, True, key
+        return (stat.st_mtime_ns, scanDirectory(path)), False, key
+
+    def update(self):
+        # lists the tree below root, one level at a time; writes the cache when there is one
+        self.dirs = {}
+        self.nrscanned = 0
+        self.nrreused = 0
+        # (path, (st_dev, st_ino) of the parent directories), to stop at symlink loops
+        level = [(self.root, frozenset())]
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            while len(level) > 0:
+                results = executor.map(self.refresh, [path for path, _ in level])
+                nextlevel = []
+                for (path, parents), (listing, reused, key) in zip(level, results):
+                    if key in parents:
+                        continue
+                    self.dirs[path] = listing
+                    if reused:
+                        self.nrreused += 1
+                    else:
+                        self.nrscanned += 1
+                    for name, kind, _, _ in listing[1]:
+                        if kind == DIRECTORY:
+                            nextlevel.append((os.path.join(path, name), parents | {key}))
+                level = nextlevel
+        if self.cachefile is not None:
+            self.writeCache(self.cachefile)
+        return self.nrscanned, self.nrreused
+
+    def walk(self, path=None):
+        # (directory, name, size, mtime) of all files, depth first in listing order
+        if path is None:
+            path = self.root
+        listing = self.dirs.get(path)
+        if listing is None:
+            return
+        for name, kind, size, mtime in listing[1]:
+            if kind == FILE:
+                yield path, name, size, mtime
+            else:
+                yield from self.walk(os.path.join(path, name))
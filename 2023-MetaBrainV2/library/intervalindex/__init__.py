@@ -0,0 +1 @@
+from .intervalindex import IntervalIndex
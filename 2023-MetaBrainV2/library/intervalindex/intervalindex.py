@@ -0,0 +1,104 @@
+import numpy as np
+
+# Static interval index on sorted arrays, meant for batch overlap queries.
+# Intervals are half-open [start, stop), as in IntervalTree. Per chromosome, intervals are sorted
+# by start and augmented with the running maximum of their stop coordinates, so that the
+# candidates for a query [qstart, qstop) are a contiguous range that can be found with two binary
+# searches; the candidates are then filtered on stop > qstart. All queries are resolved together.
+# Chromosomes are integer codes (e.g. Chromosome.getNumber()).
+
+
+class IntervalIndex:
+
+    def __init__(self, chrs, starts, stops, chunksize=100000):
+        chrs = np.asarray(chrs)
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        if not (len(chrs) == len(starts) == len(stops)):
+            raise ValueError("chrs, starts and stops should have equal length")
+        self.size = len(starts)
+        self.chunksize = chunksize
+        # per chromosome: original interval index, sorted starts, stops and running max of stops
+        self.byChr = {}
+        order = np.lexsort((starts, chrs))
+        sortedchrs = chrs[order]
+        bounds = np.flatnonzero(sortedchrs[1:] != sortedchrs[:-1]) + 1
+        for sel in np.split(order, bounds):
+            if len(sel) == 0:
+                continue
+            chrstops = stops[sel]
+            self.byChr[chrs[sel[0]].item()] = (sel, starts[sel], chrstops, np.maximum.accumulate(chrstops))
+
+    def __len__(self):
+        return self.size
+
+    def chromosomes(self):
+        return list(self.byChr.keys())
+
+    def nrIntervals(self, chr):
+        entry = self.byChr.get(chr)
+        if entry is None:
+            return 0
+        return len(entry[0])
+
+    # overlapping interval indices for a single query; None if the chromosome is not indexed
+    def queryOne(self, chr, start, stop, wiggle=0):
+        entry = self.byChr.get(chr)
+        if entry is None:
+            return None
+        sel, starts, stops, maxstops = entry
+        qstart = max(start - wiggle, 0)
+        qstop = stop + wiggle
+        lo = np.searchsorted(maxstops, qstart, side="right")
+        hi = np.searchsorted(starts, qstop, side="left")
+        if hi <= lo:
+            return sel[0:0]
+        hits = np.arange(lo, hi)
+        return sel[hits[stops[hits] > qstart]]
+
+    # Batch query: chrs, starts, stops and wiggle are arrays (wiggle may also be a scalar).
+    # Returns CSR arrays (offsets, hits): the interval indices overlapping query i are
+    # hits[offsets[i]:offsets[i + 1]], sorted by interval start.
+    def query(self, chrs, starts, stops, wiggle=0):
+        chrs = np.asarray(chrs)
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        wiggle = np.broadcast_to(np.asarray(wiggle, dtype=np.int64), starts.shape)
+        qstarts = np.maximum(starts - wiggle, 0)
+        qstops = stops + wiggle
+        nrqueries = len(starts)
+
+        blocks = []
+        for chr in np.unique(chrs):
+            entry = self.byChr.get(chr.item())
+            if entry is None:
+                continue
+            sel, istarts, istops, maxstops = entry
+            qidx = np.flatnonzero(chrs == chr)
+            for c in range(0, len(qidx), self.chunksize):
+                chunk = qidx[c:c + self.chunksize]
+                qsta = qstarts[chunk]
+                lo = np.searchsorted(maxstops, qsta, side="right")
+                hi = np.searchsorted(istarts, qstops[chunk], side="left")
+                n = np.maximum(hi - lo, 0)
+                total = int(n.sum())
+                if total == 0:
+                    continue
+                # expand the candidate ranges [lo, hi) into flat (query, candidate) pairs
+                rowoffsets = np.cumsum(n) - n
+                rows = np.repeat(np.arange(len(chunk)), n)
+                cand = np.arange(total) - rowoffsets[rows] + lo[rows]
+                keep = istops[cand] > qsta[rows]
+                rows = rows[keep]
+                blocks.append((chunk[rows], sel[cand[keep]]))
+
+        if len(blocks) == 0:
+            return np.zeros(nrqueries + 1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        qall = np.concatenate([b[0] for b in blocks])
+        hall = np.concatenate([b[1] for b in blocks])
+        # blocks are per chromosome; a stable sort on query index keeps the start order within each query
+        order = np.argsort(qall, kind="stable")
+        counts = np.bincount(qall, minlength=nrqueries)
+        offsets = np.zeros(nrqueries + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, hall[order]
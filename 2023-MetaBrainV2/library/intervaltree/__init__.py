@@ -23,3 +23,8 @@ limitations under the License.
 """
 from .interval import Interval
 from .intervaltree import IntervalTree
+
+try:
+    from .intervalarray import IntervalArray
+except ImportError:  # numpy not available
+    pass
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+intervaltree: A mutable, self-balancing interval tree for Python 2 and 3.
+Queries may be by point, by range overlap, or by range envelopment.
+
+Static, array-backed counterpart of IntervalTree that can be written to
+disk and memory-mapped.
+"""
+import numpy as np
+
+from .interval import Interval
+
+DTYPE = np.dtype([
+    ('begin', np.int64),
+    ('end', np.int64),
+    ('maxend', np.int64),
+    ('data', np.int64),
+])
+
+
+class IntervalArray(object):
+    """
+    A read-only set of integer intervals, stored as one structured numpy
+    array sorted by begin, together with the running maximum of the
+    interval ends. Intervals are half-open ``[begin, end)``, as in
+    IntervalTree, and carry an integer data value (for example an index
+    into a list of genes).
+
+    Queries use binary search on the sorted columns, so they work
+    directly on a memory-mapped file, without building Node objects::
+
+        >>> arr = IntervalArray([10, 0], [20, 5], [1, 0])
+        >>> sorted(arr[4:12])
+        [Interval(0, 5, 0), Interval(10, 20, 1)]
+        >>> arr.save('genes.npy')
+        >>> sorted(IntervalArray.load('genes.npy').at(15))
+        [Interval(10, 20, 1)]
+    """
+    def __init__(self, begins=(), ends=(), data=None, _table=None):
+        """
+        Set up the array from parallel sequences of begins, ends and,
+        optionally, integer data (defaults to the position in the input).
+
+        Completes in O(n*log n) time.
+        """
+        if _table is not None:
+            self.table = _table
+            return
+        begins = np.asarray(begins, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if data is None:
+            data = np.arange(len(begins), dtype=np.int64)
+        data = np.asarray(data, dtype=np.int64)
+        if not (len(begins) == len(ends) == len(data)):
+            raise ValueError(
+                "IntervalArray: begins, ends and data should have equal length"
+            )
+        if np.any(ends <= begins):
+            raise ValueError(
+                "IntervalArray: Null intervals not allowed in IntervalArray"
+            )
+        order = np.lexsort((data, ends, begins))
+        table = np.empty(len(begins), dtype=DTYPE)
+        table['begin'] = begins[order]
+        table['end'] = ends[order]
+        table['data'] = data[order]
+        if len(table) > 0:
+            np.maximum.accumulate(table['end'], out=table['maxend'])
+        self.table = table
+
+    @classmethod
+    def from_intervals(cls, intervals, data_key=None):
+        """
+        Create an IntervalArray from Interval objects. Interval data
+        must be integers, unless data_key is given to map data to
+        integers.
+
+        Completes in O(n*log n) time.
+        :rtype: IntervalArray
+        """
+        intervals = list(intervals)
+        if data_key is None:
+            data = [iv.data for iv in intervals]
+        else:
+            data = [data_key(iv.data) for iv in intervals]
+        return cls([iv.begin for iv in intervals], [iv.end for iv in intervals], data)
+
+    def save(self, filename):
+        """
+        Writes the array to filename in .npy format.
+
+        Completes in O(n) time.
+        """
+        np.save(filename, self.table, allow_pickle=False)
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """
+        Loads an array written by save(). When mmap is True, the file is
+        memory-mapped read-only and only the pages touched by queries
+        are read.
+
+        Completes in O(1) time when memory-mapped, O(n) otherwise.
+        :rtype: IntervalArray
+        """
+        table = np.load(filename, mmap_mode='r' if mmap else None, allow_pickle=False)
+        if table.dtype != DTYPE:
+            raise ValueError(
+                "IntervalArray: {0} does not contain an IntervalArray".format(filename)
+            )
+        return cls(_table=table)
+
+    @property
+    def begins(self):
+        return self.table['begin']
+
+    @property
+    def ends(self):
+        return self.table['end']
+
+    @property
+    def data(self):
+        return self.table['data']
+
+    def overlap_indices(self, begin, end):
+        """
+        Returns the row indices of all intervals overlapping the range
+        [begin, end), in order of interval begin.
+
+        Completes in O(m + k + log n) time, where:
+          * n = size of the array
+          * m = number of matches
+          * k = number of intervals starting before end that do not match
+        :rtype: numpy array of int
+        """
+        if begin >= end:
+            return np.zeros(0, dtype=np.int64)
+        table = self.table
+        lo = np.searchsorted(table['maxend'], begin, side='right')
+        hi = np.searchsorted(table['begin'], end, side='left')
+        if hi <= lo:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.arange(lo, hi)
+        return rows[table['end'][lo:hi] > begin]
+
+    def overlap(self, begin, end=None):
+        """
+        Returns a set of all intervals overlapping the given range.
+        :rtype: set of Interval
+        """
+        if end is None:
+            iv = begin
+            return self.overlap(iv.begin, iv.end)
+        return self._to_intervals(self.overlap_indices(begin, end))
+
+    def at(self, p):
+        """
+        Returns the set of all intervals that contain p.
+        :rtype: set of Interval
+        """
+        return self._to_intervals(self.overlap_indices(p, p + 1))
+
+    def _to_intervals(self, rows):
+        sub = self.table[rows]
+        return set(
+            Interval(b, e, d) for b, e, d in
+            zip(sub['begin'].tolist(), sub['end'].tolist(), sub['data'].tolist())
+        )
+
+    def __getitem__(self, index):
+        """
+        Same as IntervalTree.__getitem__: a point query for a number, an
+        overlap query for a slice.
+        :rtype: set of Interval
+        """
+        try:
+            start, stop = index.start, index.stop
+            if start is None:
+                start = int(self.table['begin'][0]) if len(self) else 0
+                if stop is None:
+                    return self._to_intervals(np.arange(len(self)))
+            if stop is None:
+                stop = int(self.table['maxend'][-1]) if len(self) else 0
+            return self.overlap(start, stop)
+        except AttributeError:
+            return self.at(index)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __repr__(self):
+        return "IntervalArray({0} intervals)".format(len(self))
+
+    __str__ = __repr__
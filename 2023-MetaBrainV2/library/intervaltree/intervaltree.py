@@ -249,6 +249,63 @@ class IntervalTree(MutableSet):
         ivs = [Interval(*t) for t in tups]
         return IntervalTree(ivs)
 
+    @classmethod
+    def from_arrays(cls, begins, ends, data=None):
+        """
+        Bulk-load a new IntervalTree from parallel sequences of begins,
+        ends and, optionally, data (e.g. numpy arrays).
+
+        The intervals are sorted once, the tree is built from the sorted
+        list by median splits and the boundary table is filled in a
+        single pass, instead of inserting (and rebalancing) the
+        intervals one at a time.
+
+        Completes in O(n*log n) time.
+        :rtype: IntervalTree
+        """
+        if hasattr(begins, 'tolist'):
+            begins = begins.tolist()
+        if hasattr(ends, 'tolist'):
+            ends = ends.tolist()
+        if data is None:
+            data = [None] * len(begins)
+        elif hasattr(data, 'tolist'):
+            data = data.tolist()
+        if not (len(begins) == len(ends) == len(data)):
+            raise ValueError(
+                "IntervalTree: begins, ends and data should have equal length"
+            )
+        # sort on plain (begin, end) tuples; Interval.__lt__ is much slower.
+        # The tree only depends on begin and end, so ties need no ordering.
+        order = sorted(range(len(begins)), key=lambda i: (begins[i], ends[i]))
+        ivs = list(dict.fromkeys(Interval(begins[i], ends[i], data[i]) for i in order))
+        for iv in ivs:
+            if iv.is_null():
+                raise ValueError(
+                    "IntervalTree: Null Interval objects not allowed in IntervalTree:"
+                    " {0}".format(iv)
+                )
+        tree = cls.__new__(cls)
+        tree.all_intervals = set(ivs)
+        tree.top_node = Node.from_sorted_intervals(ivs)
+        tree._build_boundaries()
+        return tree
+
+    @classmethod
+    def from_array(cls, array, data=None):
+        """
+        Create a new IntervalTree from an IntervalArray. If data is
+        given, interval data is looked up as data[i] for each stored
+        data value i; otherwise the stored values are used as data.
+
+        Completes in O(n*log n) time.
+        :rtype: IntervalTree
+        """
+        payload = array.data.tolist()
+        if data is not None:
+            payload = [data[i] for i in payload]
+        return cls.from_arrays(array.begins, array.ends, payload)
+
     def __init__(self, intervals=None):
         """
         Set up a tree. If intervals is provided, add all the intervals
@@ -265,9 +322,7 @@ class IntervalTree(MutableSet):
                 )
         self.all_intervals = intervals
         self.top_node = Node.from_intervals(self.all_intervals)
-        self.boundary_table = SortedDict()
-        for iv in self.all_intervals:
-            self._add_boundaries(iv)
+        self._build_boundaries()
 
     def copy(self):
         """
@@ -279,6 +334,30 @@ class IntervalTree(MutableSet):
         """
         return IntervalTree(iv.copy() for iv in self)
 
+    def to_array(self, data_key=None):
+        """
+        Returns an IntervalArray with the intervals of this tree. Interval
+        data are stored as integers: either the data itself, or
+        data_key(data) when data_key is given.
+
+        Completes in O(n*log n) time.
+        :rtype: IntervalArray
+        """
+        from .intervalarray import IntervalArray  # needs numpy
+        return IntervalArray.from_intervals(self.all_intervals, data_key)
+
+    def _build_boundaries(self):
+        """
+        Fills the boundary table from scratch for all intervals in the
+        tree. Counting in a plain dict first means the SortedDict is
+        sorted once, rather than updated per boundary.
+        """
+        counts = {}
+        for iv in self.all_intervals:
+            counts[iv.begin] = counts.get(iv.begin, 0) + 1
+            counts[iv.end] = counts.get(iv.end, 0) + 1
+        self.boundary_table = SortedDict(counts)
+
     def _add_boundaries(self, interval):
         """
         Records the boundaries of the interval in the boundary table.
@@ -348,8 +427,13 @@ class IntervalTree(MutableSet):
         Given an iterable of intervals, add them to the tree.
 
         Completes in O(m*log(n+m), where m = number of intervals to
-        add.
+        add. When more intervals are added than the tree holds, the
+        tree is rebuilt in bulk instead.
         """
+        intervals = set(intervals)
+        if len(intervals) > len(self):
+            self.__init__(self.all_intervals | intervals)
+            return
         for iv in intervals:
             self.add(iv)
 
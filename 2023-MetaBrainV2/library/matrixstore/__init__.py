@@ -0,0 +1 @@
+from .matrixstore import MatrixStore, fileChecksum
@@ -0,0 +1,253 @@
+import gzip
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Append-only features x samples matrix on disk, for count matrices that grow when cohorts are
+# added. A store directory holds:
+#   features.txt     row ids; new features are appended at the end
+#   chunk-NNNNN.npy  column chunks (features x samples of one append), rows as far as the features
+#                    existed when the chunk was written; later rows count as missing
+#   manifest.txt     per sample: path, size, mtime, checksum, chunk, column and whether the column
+#                    is active; removed or replaced samples are masked (active 0), not deleted
+# Whether a sample file changed is decided on size and mtime; callers compare the checksum of a
+# changed file with the manifest to skip files that were only touched. compact() rewrites the active
+# columns into a single chunk; export() and exportBinary() write the matrix as text or npz. Features
+# without any value in the active (or exported) samples, e.g. genes that were only in a removed
+# sample, are left out of exports and dropped by compact(), as in a full rebuild of the matrix.
+
+MANIFEST_HEADER = ["sample", "path", "size", "mtime", "checksum", "chunk", "column", "active"]
+
+
+def fileChecksum(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def formatBlock(features, block, missing, compress):
+    lines = []
+    for feature, row in zip(features, block.tolist()):
+        if min(row) == missing:
+            lines.append(feature + "\t" + "\t".join(str(v) if v != missing else "nan" for v in row) + "\n")
+        else:
+            lines.append(feature + "\t" + "\t".join(map(str, row)) + "\n")
+    data = "".join(lines).encode()
+    if compress:
+        return gzip.compress(data, 6)
+    return data
+
+
+class MatrixStore:
+
+    def __init__(self, path, dtype=np.int32, missing=-1):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.missing = missing
+        self.features = []
+        self.featureIndex = {}
+        self.manifest = []
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(self.file("features.txt")):
+            with open(self.file("features.txt")) as fh:
+                self.addFeatures([line.rstrip("\n") for line in fh], write=False)
+        if os.path.exists(self.file("manifest.txt")):
+            with open(self.file("manifest.txt")) as fh:
+                fh.readline()
+                for line in fh:
+                    elems = line.rstrip("\n").split("\t")
+                    self.manifest.append({"sample": elems[0], "path": elems[1], "size": int(elems[2]),
+                                          "mtime": float(elems[3]), "checksum": elems[4], "chunk": int(elems[5]),
+                                          "column": int(elems[6]), "active": elems[7] == "1"})
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def chunkFile(self, chunk):
+        return self.file("chunk-{:05d}.npy".format(chunk))
+
+    def addFeatures(self, features, write=True):
+        # appends features that are not in the store yet; returns the row of each feature
+        new = []
+        for feature in features:
+            if feature not in self.featureIndex:
+                self.featureIndex[feature] = len(self.features)
+                self.features.append(feature)
+                new.append(feature)
+        if write and len(new) > 0:
+            with open(self.file("features.txt"), 'a') as fh:
+                fh.write("".join(feature + "\n" for feature in new))
+        return [self.featureIndex[feature] for feature in features]
+
+    def writeManifest(self):
+        tmp = self.file("manifest.txt.tmp")
+        with open(tmp, 'w') as fh:
+            fh.write("\t".join(MANIFEST_HEADER) + "\n")
+            for entry in self.manifest:
+                fh.write("\t".join([entry["sample"], entry["path"], str(entry["size"]), repr(entry["mtime"]),
+                                    entry["checksum"], str(entry["chunk"]), str(entry["column"]),
+                                    "1" if entry["active"] else "0"]) + "\n")
+        os.replace(tmp, self.file("manifest.txt"))
+
+    def active(self):
+        # active manifest entry per sample
+        return {entry["sample"]: entry for entry in self.manifest if entry["active"]}
+
+    def status(self, samples, paths):
+        # compares sample files with the manifest; returns the indices of samples that are new or
+        # whose file changed (size, mtime or path), and the active samples that are not in samples
+        current = self.active()
+        update = []
+        for i, (sample, path) in enumerate(zip(samples, paths)):
+            entry = current.get(sample)
+            stat = os.stat(path)
+            if entry is None or entry["path"] != os.path.abspath(path) or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                update.append(i)
+        removed = sorted(set(current.keys()) - set(samples))
+        return update, removed
+
+    def mask(self, samples):
+        samples = set(samples)
+        for entry in self.manifest:
+            if entry["sample"] in samples:
+                entry["active"] = False
+        self.writeManifest()
+
+    def touch(self, sample, path, checksum):
+        # records a new size/mtime for a sample whose file content did not change
+        entry = self.active().get(sample)
+        if entry is not None and entry["checksum"] == checksum:
+            stat = os.stat(path)
+            entry["size"] = stat.st_size
+            entry["mtime"] = stat.st_mtime
+            entry["path"] = os.path.abspath(path)
+            return True
+        return False
+
+    def append(self, samples, paths, checksums, values):
+        # values: len(self.features) x len(samples); replaces earlier columns of the same samples
+        values = np.asarray(values, dtype=self.dtype)
+        if values.shape != (len(self.features), len(samples)):
+            raise ValueError("Expected a {} x {} matrix, got {}".format(len(self.features), len(samples), values.shape))
+        chunk = max([entry["chunk"] for entry in self.manifest], default=-1) + 1
+        np.save(self.chunkFile(chunk), values)
+        replaced = set(samples)
+        for entry in self.manifest:
+            if entry["sample"] in replaced:
+                entry["active"] = False
+        for column, (sample, path, checksum) in enumerate(zip(samples, paths, checksums)):
+            stat = os.stat(path)
+            self.manifest.append({"sample": sample, "path": os.path.abspath(path), "size": stat.st_size,
+                                  "mtime": stat.st_mtime, "checksum": checksum, "chunk": chunk,
+                                  "column": column, "active": True})
+        self.writeManifest()
+
+    def read(self, rows, samples):
+        # the given rows for the active columns of samples, missing values where a chunk has no rows
+        rows = np.asarray(rows, dtype=np.int64)
+        current = self.active()
+        block = np.full((len(rows), len(samples)), self.missing, dtype=self.dtype)
+        byChunk = {}
+        for i, sample in enumerate(samples):
+            entry = current[sample]
+            byChunk.setdefault(entry["chunk"], ([], []))
+            byChunk[entry["chunk"]][0].append(i)
+            byChunk[entry["chunk"]][1].append(entry["column"])
+        for chunk, (outcols, cols) in byChunk.items():
+            data = np.load(self.chunkFile(chunk), mmap_mode='r')
+            valid = np.flatnonzero(rows < data.shape[0])
+            if len(valid) > 0:
+                block[np.ix_(valid, outcols)] = data[rows[valid]][:, cols]
+        return block
+
+    def present(self, rows, samples, blocksize=10000):
+        # the rows that have a value for at least one of samples
+        rows = np.asarray(rows, dtype=np.int64)
+        keep = np.zeros(len(rows), dtype=bool)
+        for r0 in range(0, len(rows), blocksize):
+            keep[r0:r0 + blocksize] = (self.read(rows[r0:r0 + blocksize], samples) != self.missing).any(axis=1)
+        return rows[keep]
+
+    def compact(self, blocksize=10000):
+        # rewrites the active columns into one chunk and removes the other chunks; features without
+        # a value in any active sample are removed
+        current = self.active()
+        samples = list(current.keys())
+        rows = self.present(np.arange(len(self.features)), samples, blocksize)
+        chunk = max([entry["chunk"] for entry in self.manifest], default=-1) + 1
+        data = np.lib.format.open_memmap(self.chunkFile(chunk), mode='w+', dtype=self.dtype, shape=(len(rows), len(samples)))
+        for r0 in range(0, len(rows), blocksize):
+            data[r0:r0 + blocksize] = self.read(rows[r0:r0 + blocksize], samples)
+        data.flush()
+        del data
+        if len(rows) < len(self.features):
+            features = [self.features[r] for r in rows.tolist()]
+            tmp = self.file("features.txt.tmp")
+            with open(tmp, 'w') as fh:
+                fh.write("".join(feature + "\n" for feature in features))
+            os.replace(tmp, self.file("features.txt"))
+            self.features = []
+            self.featureIndex = {}
+            self.addFeatures(features, write=False)
+        oldChunks = set(entry["chunk"] for entry in self.manifest)
+        self.manifest = []
+        for column, sample in enumerate(samples):
+            entry = dict(current[sample])
+            entry["chunk"] = chunk
+            entry["column"] = column
+            self.manifest.append(entry)
+        self.writeManifest()
+        for old in oldChunks:
+            if os.path.exists(self.chunkFile(old)):
+                os.remove(self.chunkFile(old))
+
+    def exportOrder(self, samples, sortFeatures):
+        if samples is None:
+            samples = list(self.active().keys())
+        rows = list(range(len(self.features)))
+        if sortFeatures:
+            rows = sorted(rows, key=lambda r: self.features[r])
+        return samples, np.array(rows, dtype=np.int64)
+
+    def export(self, outfile, samples=None, sortFeatures=False, header="-", threads=1, blocksize=None):
+        # writes the features x samples matrix as text (gzip when outfile ends with .gz); missing
+        # values are written as nan, features without any value in samples are left out; returns
+        # the number of features written
+        samples, rows = self.exportOrder(samples, sortFeatures)
+        compress = outfile.endswith(".gz")
+        if blocksize is None:
+            blocksize = max(1, 5000000 // max(1, len(samples)))
+        executor = ProcessPoolExecutor(max_workers=threads) if threads > 1 else None
+        nrows = 0
+        with open(outfile, 'wb') as fho:
+            line = header + "\t" + "\t".join(samples) + "\n"
+            fho.write(gzip.compress(line.encode(), 6) if compress else line.encode())
+            pending = []
+            blocks = list(range(0, len(rows), blocksize))
+            for b in range(len(blocks) + 1):
+                if b < len(blocks):
+                    sel = rows[blocks[b]:blocks[b] + blocksize]
+                    block = self.read(sel, samples)
+                    keep = (block != self.missing).any(axis=1)
+                    sel = sel[keep]
+                    nrows += len(sel)
+                    task = ([self.features[r] for r in sel.tolist()], block[keep], self.missing, compress)
+                    pending.append(executor.submit(formatBlock, *task) if executor is not None else formatBlock(*task))
+                while len(pending) > 0 and (b == len(blocks) or len(pending) >= 2 * threads):
+                    result = pending.pop(0)
+                    fho.write(result.result() if executor is not None else result)
+        if executor is not None:
+            executor.shutdown()
+        return nrows
+
+    def exportBinary(self, npzfile, samples=None, sortFeatures=False):
+        samples, rows = self.exportOrder(samples, sortFeatures)
+        values = self.read(rows, samples)
+        keep = (values != self.missing).any(axis=1)
+        rows = rows[keep]
+        values = values[keep]
+        np.savez(npzfile, counts=values, genes=np.array([self.features[r] for r in rows.tolist()]), samples=np.array(samples))
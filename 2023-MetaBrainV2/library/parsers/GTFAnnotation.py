@@ -7,7 +7,7 @@ from features.transcript import Transcript
 from features.strand import Strand
 from features.gene import Gene
 
-from intervaltree import Interval, IntervalTree
+from intervalindex import IntervalIndex
 
 
 class GTFAnnotation:
@@ -23,7 +23,7 @@ class GTFAnnotation:
 
     genesPerChr = {}
 
-    intervalTreeByChr = {}
+    geneIndex = None
 
     def __init__(self, gtffile):      
         self.parse(gtffile)
@@ -49,6 +49,8 @@ class GTFAnnotation:
         fh.close()
         for type in self.notparsedtypes:
             print("Unknown type of feature in file: "+type)
+        for feature in self.genes + self.transcripts + self.exons:
+            feature.freeze()
 
         # index by chr
         if self.genes is not None:
@@ -59,17 +61,15 @@ class GTFAnnotation:
                     arr = []
                 arr.append(gene)
                 self.genesPerChr[gene.chr] = arr
-                tree = self.intervalTreeByChr.get(gene.chr)
-                if tree is None:
-                    tree = IntervalTree()
-                tree[gene.start:gene.stop] = gene
-                self.intervalTreeByChr[gene.chr] = tree
+            # static overlap index; interval indices are indices into self.genes
+            self.geneIndex = IntervalIndex([gene.chr.getNumber() for gene in self.genes],
+                                           [gene.start for gene in self.genes],
+                                           [gene.stop for gene in self.genes])
         print()
         print("Loaded genes per chromosome:")
         for chr in self.genesPerChr.keys():
             arr = self.genesPerChr.get(chr)
-            tree = self.intervalTreeByChr.get(chr)
-            print(f"{chr}\t{len(arr)}\t{len(tree)}")
+            print(f"{chr}\t{len(arr)}\t{self.geneIndex.nrIntervals(chr.getNumber())}")
         print()
 
     def getOrCreateGene(self, chr,start,stop,strand,annotation):
@@ -149,21 +149,19 @@ class GTFAnnotation:
         return output
 
     def getGenesByRange(self, chr, start, stop, wiggle):
-        return None
+        idx = self.geneIndex.queryOne(chr.getNumber(), start, stop, wiggle)
+        if idx is None:
+            return None
+        return [self.genes[i] for i in idx]
 
     def getOverlappingGenes(self, feature, wiggle):
-        tree = self.intervalTreeByChr.get(feature.chr)
-        if tree is None:
-            return None
-        start = feature.start - wiggle
-        if start < 0:
-            start = 0
-        stop = feature.stop + wiggle    
-        intervals = tree[start:stop]
-        genes = []
-        for interval in intervals:
-            genes.append(interval.data)
-        return genes
+        return self.getGenesByRange(feature.chr, feature.start, feature.stop, wiggle)
+
+    # batch version of getOverlappingGenes: chrs (Chromosome.getNumber() codes), starts, stops and
+    # wiggle are arrays. Returns CSR arrays (offsets, geneIdx); the genes overlapping feature i are
+    # self.genes[j] for j in geneIdx[offsets[i]:offsets[i + 1]]
+    def getOverlappingGeneIdx(self, chrs, starts, stops, wiggle):
+        return self.geneIndex.query(chrs, starts, stops, wiggle)
 
     def parseln(self, line):
         elems = line.split("\t")
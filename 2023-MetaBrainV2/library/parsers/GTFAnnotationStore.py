@@ -0,0 +1,531 @@
+import gzip
+import hashlib
+import os
+
+import numpy as np
+
+from features.chromosome import Chromosome
+from features.strand import Strand
+from features.gene import Gene
+from features.transcript import Transcript
+from features.exon import Exon
+from intervalindex import IntervalIndex
+
+# Columnar alternative to GTFAnnotation: coordinates, chromosome and strand codes are kept in
+# numpy arrays, identifiers in string tables and gene -> transcript -> exon relations in CSR
+# offset arrays. Gene/Transcript/Exon objects are only created as thin views on request.
+# The parsed arrays are cached next to the GTF (or in cachefile) and keyed by the GTF checksum,
+# so re-loading an unchanged GTF does not require parsing it again.
+
+CACHEVERSION = 1
+
+class FeatureView:
+    # equality and hashing on (store, index), so views can be used in sets and compared with ==
+    def __init__(self, store, idx):
+        self.store = store
+        self.idx = idx
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.store is other.store and self.idx == other.idx
+
+    def __hash__(self):
+        return hash((type(self), id(self.store), self.idx))
+
+
+class GeneView(FeatureView, Gene):
+
+    @property
+    def chrCode(self):
+        return int(self.store.geneChr[self.idx])
+
+    @property
+    def chr(self):
+        return Chromosome.fromCode(self.chrCode)
+
+    @property
+    def start(self):
+        return int(self.store.geneStart[self.idx])
+
+    @property
+    def stop(self):
+        return int(self.store.geneStop[self.idx])
+
+    @property
+    def strandCode(self):
+        return int(self.store.geneStrand[self.idx])
+
+    @property
+    def strand(self):
+        return Strand.fromCode(self.strandCode)
+
+    @property
+    def name(self):
+        return self.store.geneIds[self.idx]
+
+    @property
+    def symbol(self):
+        symbol = self.store.geneSymbols[self.idx]
+        if symbol == "":
+            return None
+        return symbol
+
+    @property
+    def type(self):
+        code = int(self.store.geneType[self.idx])
+        if code < 0:
+            return None
+        return self.store.typeNames[code]
+
+    @property
+    def transcripts(self):
+        s = self.store
+        tids = s.geneTranscripts[s.geneTranscriptOffsets[self.idx]:s.geneTranscriptOffsets[self.idx + 1]]
+        if len(tids) == 0:
+            return None
+        return [TranscriptView(s, int(t)) for t in tids]
+
+
+class TranscriptView(FeatureView, Transcript):
+
+    @property
+    def chrCode(self):
+        return int(self.store.transcriptChr[self.idx])
+
+    @property
+    def chr(self):
+        return Chromosome.fromCode(self.chrCode)
+
+    @property
+    def start(self):
+        return int(self.store.transcriptStart[self.idx])
+
+    @property
+    def stop(self):
+        return int(self.store.transcriptStop[self.idx])
+
+    @property
+    def strandCode(self):
+        return int(self.store.transcriptStrand[self.idx])
+
+    @property
+    def strand(self):
+        return Strand.fromCode(self.strandCode)
+
+    @property
+    def name(self):
+        return self.store.transcriptIds[self.idx]
+
+    @property
+    def gene(self):
+        return GeneView(self.store, int(self.store.transcriptGene[self.idx]))
+
+    @property
+    def exons(self):
+        s = self.store
+        eids = s.transcriptExons[s.transcriptExonOffsets[self.idx]:s.transcriptExonOffsets[self.idx + 1]]
+        if len(eids) == 0:
+            return None
+        return [ExonView(s, int(e)) for e in eids]
+
+    def getExonRank(self, exon):
+        s = self.store
+        sta = s.transcriptExonOffsets[self.idx]
+        sto = s.transcriptExonOffsets[self.idx + 1]
+        hits = np.flatnonzero(s.transcriptExons[sta:sto] == exon.idx)
+        if len(hits) == 0:
+            return None
+        rank = int(s.transcriptExonRanks[sta + hits[0]])
+        if rank < 0:
+            return None
+        return rank
+
+
+class ExonView(FeatureView, Exon):
+
+    @property
+    def chrCode(self):
+        return int(self.store.exonChr[self.idx])
+
+    @property
+    def chr(self):
+        return Chromosome.fromCode(self.chrCode)
+
+    @property
+    def start(self):
+        return int(self.store.exonStart[self.idx])
+
+    @property
+    def stop(self):
+        return int(self.store.exonStop[self.idx])
+
+    @property
+    def strandCode(self):
+        return int(self.store.exonStrand[self.idx])
+
+    @property
+    def strand(self):
+        return Strand.fromCode(self.strandCode)
+
+    @property
+    def name(self):
+        return self.store.exonIds[self.idx]
+
+    @property
+    def gene(self):
+        return GeneView(self.store, int(self.store.exonGene[self.idx]))
+
+    @property
+    def transcripts(self):
+        s = self.store
+        tids = s.exonTranscripts[s.exonTranscriptOffsets[self.idx]:s.exonTranscriptOffsets[self.idx + 1]]
+        if len(tids) == 0:
+            return None
+        return set(TranscriptView(s, int(t)) for t in tids)
+
+
+class GTFAnnotationStore:
+
+    def __init__(self, gtffile, cachefile=None, usecache=True, verbose=True):
+        self.verbose = verbose
+        if cachefile is None:
+            cachefile = gtffile + ".store.npz"
+        self.cachefile = cachefile
+        self.notparsedtypes = set()
+        self.idToGeneIdx = None
+        self.idToTranscriptIdx = None
+        self.idToExonIdx = None
+
+        checksum = self.checksum(gtffile)
+        loaded = False
+        if usecache and os.path.exists(cachefile):
+            loaded = self.load(cachefile, checksum)
+        if not loaded:
+            self.parse(gtffile)
+            if usecache:
+                self.save(cachefile, checksum)
+        self.index()
+
+    def getfh(self, name):
+        if name.endswith(".gz"):
+            return gzip.open(name, 'rt')
+        else:
+            return open(name, 'r')
+
+    def checksum(self, file):
+        md5 = hashlib.md5()
+        with open(file, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                md5.update(block)
+        return md5.hexdigest()
+
+    # GTF parsing: follows the rules of GTFAnnotation.parseln, but fills python lists of primitives
+    # instead of objects; these are converted to arrays at the end.
+    def parse(self, gtffile):
+        print("Reading GTF: " + gtffile)
+        gIds = []
+        gSymbols = []
+        gTypes = []
+        gCoords = []
+        tIds = []
+        tGene = []
+        tCoords = []
+        eIds = []
+        eGene = []
+        eCoords = []
+        # transcript -> exon links and their exon rank (-1 when not set)
+        lTranscript = []
+        lExon = []
+        lRank = []
+        typeNames = []
+        idToGene = {}
+        idToTranscript = {}
+        idToExon = {}
+        typeToCode = {}
+
+        def getOrCreateGene(coords, annotation):
+            gid = annotation.get("gene_id")
+            if gid is None:
+                return None
+            gidx = idToGene.get(gid)
+            if gidx is None:
+                gidx = len(gIds)
+                gIds.append(gid)
+                symbol = annotation.get("gene_name")
+                gSymbols.append("" if symbol is None else symbol)
+                gtype = annotation.get("gene_type")
+                if gtype is None:
+                    gTypes.append(-1)
+                else:
+                    code = typeToCode.get(gtype)
+                    if code is None:
+                        code = len(typeNames)
+                        typeNames.append(gtype)
+                        typeToCode[gtype] = code
+                    gTypes.append(code)
+                gCoords.append(coords)
+                idToGene[gid] = gidx
+            return gidx
+
+        def getOrCreateTranscript(coords, annotation):
+            gidx = getOrCreateGene(coords, annotation)
+            if gidx is None:
+                return None
+            tid = annotation.get("transcript_id")
+            if tid is None:
+                return None
+            tidx = idToTranscript.get(tid)
+            if tidx is None:
+                tidx = len(tIds)
+                tIds.append(tid)
+                tGene.append(gidx)
+                tCoords.append(coords)
+                idToTranscript[tid] = tidx
+            return tidx
+
+        def createExon(eid, coords, annotation):
+            gidx = getOrCreateGene(coords, annotation)
+            if gidx is None:
+                return None
+            tidx = getOrCreateTranscript(coords, annotation)
+            if tidx is None:
+                return None
+            eidx = len(eIds)
+            eIds.append(eid)
+            eGene.append(gidx)
+            eCoords.append(coords)
+            idToExon[eid] = eidx
+            rank = -1
+            exonRank = annotation.get("exon_number")
+            if exonRank is not None:
+                try:
+                    rank = int(exonRank)
+                except:
+                    pass
+            lTranscript.append(tidx)
+            lExon.append(eidx)
+            lRank.append(rank)
+            return eidx
+
+        def linkExon(eidx, coords, annotation):
+            tidx = getOrCreateTranscript(coords, annotation)
+            lTranscript.append(tidx)
+            lExon.append(eidx)
+            lRank.append(-1)
+
+        fh = self.getfh(gtffile)
+        lctr = 0
+        for line in fh:
+            lctr += 1
+            if lctr % 100000 == 0:
+                print("{} lines parsed, {} genes, {} transcripts, {} exons".format(lctr, len(gIds), len(tIds), len(eIds)), end="\r")
+            if line.startswith("#"):
+                continue
+            elems = line.rstrip("\n").split("\t")
+            type = elems[2].lower()
+            if type != "gene" and type != "transcript" and type != "exon":
+                if type not in ("cds", "start_codon", "stop_codon", "utr", "selenocyteine"):
+                    self.notparsedtypes.add(type)
+                continue
+            coords = (Chromosome.parseCode(elems[0]), int(elems[3]), int(elems[4]), Strand.parseCode(elems[6]))
+            annotation = self.toDict(elems[8].strip(), "; ", " ")
+
+            if type == "gene":
+                gid = annotation.get("gene_id")
+                if gid is not None:
+                    if gid in idToGene:
+                        print(gid + " already exists")
+                    else:
+                        getOrCreateGene(coords, annotation)
+            elif type == "transcript":
+                tid = annotation.get("transcript_id")
+                if tid is not None:
+                    if tid in idToTranscript:
+                        print(tid + " already exists")
+                    else:
+                        getOrCreateTranscript(coords, annotation)
+            else:
+                eid = annotation.get("exon_id")
+                # Ensembl exon IDs on para-autosomal reqions do not have the _PAR_Y extension. Fix that here
+                gid = annotation.get("gene_id")
+                if gid is not None and gid.endswith("_PAR_Y"):
+                    eid = eid + "_PAR_Y"
+                if eid is not None:
+                    eidx = idToExon.get(eid)
+                    if eidx is None:
+                        createExon(eid, coords, annotation)
+                    elif eCoords[eidx] == coords:
+                        linkExon(eidx, coords, annotation)
+                    else:
+                        # exon with different coordinates (remapped/lifted over GTF); look for a previous fix
+                        itr = 1
+                        fixeid = eid + "_" + str(itr)
+                        found = False
+                        while fixeid in idToExon:
+                            if eCoords[idToExon[fixeid]] == coords:
+                                found = True
+                                break
+                            itr += 1
+                            fixeid = eid + "_" + str(itr)
+                        if found:
+                            linkExon(idToExon[fixeid], coords, annotation)
+                        else:
+                            createExon(fixeid, coords, annotation)
+        fh.close()
+        print("{} lines parsed, {} genes, {} transcripts, {} exons - Done".format(lctr, len(gIds), len(tIds), len(eIds)), end="\n")
+        for type in self.notparsedtypes:
+            print("Unknown type of feature in file: " + type)
+
+        self.geneIds = np.array(gIds, dtype=str)
+        self.geneSymbols = np.array(gSymbols, dtype=str)
+        self.geneType = np.array(gTypes, dtype=np.int16)
+        self.typeNames = np.array(typeNames, dtype=str)
+        self.geneChr, self.geneStart, self.geneStop, self.geneStrand = self.coordsToArrays(gCoords)
+        self.transcriptIds = np.array(tIds, dtype=str)
+        self.transcriptGene = np.array(tGene, dtype=np.int32)
+        self.transcriptChr, self.transcriptStart, self.transcriptStop, self.transcriptStrand = self.coordsToArrays(tCoords)
+        self.exonIds = np.array(eIds, dtype=str)
+        self.exonGene = np.array(eGene, dtype=np.int32)
+        self.exonChr, self.exonStart, self.exonStop, self.exonStrand = self.coordsToArrays(eCoords)
+
+        # CSR relations; stable sorts keep the order in which relations were seen in the GTF
+        self.geneTranscriptOffsets, self.geneTranscripts = self.toCSR(self.transcriptGene, np.arange(len(tIds), dtype=np.int32), len(gIds))
+        lTranscript = np.array(lTranscript, dtype=np.int32)
+        lExon = np.array(lExon, dtype=np.int32)
+        lRank = np.array(lRank, dtype=np.int32)
+        order = np.argsort(lTranscript, kind="stable")
+        self.transcriptExonOffsets = self.toOffsets(lTranscript[order], len(tIds))
+        self.transcriptExons = lExon[order]
+        self.transcriptExonRanks = lRank[order]
+        # exons keep a set of transcripts; drop duplicate exon-transcript pairs
+        pairs = np.unique(np.stack([lExon, lTranscript], axis=1), axis=0) if len(lExon) > 0 else np.zeros((0, 2), dtype=np.int32)
+        self.exonTranscriptOffsets = self.toOffsets(pairs[:, 0], len(eIds))
+        self.exonTranscripts = pairs[:, 1].astype(np.int32)
+
+    def coordsToArrays(self, coords):
+        arr = np.array(coords, dtype=np.int64).reshape(-1, 4)
+        return arr[:, 0].astype(np.int8), arr[:, 1].astype(np.int32), arr[:, 2].astype(np.int32), arr[:, 3].astype(np.int8)
+
+    def toOffsets(self, sortedkeys, n):
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sortedkeys, minlength=n), out=offsets[1:])
+        return offsets
+
+    def toCSR(self, keys, values, n):
+        order = np.argsort(keys, kind="stable")
+        return self.toOffsets(keys[order], n), values[order]
+
+    def toDict(self, annotation, sep1, sep2):
+        out = {}
+        for elem in annotation.split(sep1):
+            key, _, value = elem.partition(sep2)
+            out[key] = value.replace('"', "")
+        return out
+
+    ARRAYS = ["geneIds", "geneSymbols", "geneType", "typeNames", "geneChr", "geneStart", "geneStop", "geneStrand",
+              "transcriptIds", "transcriptGene", "transcriptChr", "transcriptStart", "transcriptStop", "transcriptStrand",
+              "exonIds", "exonGene", "exonChr", "exonStart", "exonStop", "exonStrand",
+              "geneTranscriptOffsets", "geneTranscripts",
+              "transcriptExonOffsets", "transcriptExons", "transcriptExonRanks",
+              "exonTranscriptOffsets", "exonTranscripts"]
+
+    def save(self, cachefile, checksum):
+        print("Writing GTF cache: " + cachefile)
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        arrays["checksum"] = np.array(checksum)
+        arrays["version"] = np.array(CACHEVERSION)
+        try:
+            with open(cachefile, 'wb') as fh:
+                np.savez(fh, **arrays)
+        except OSError as e:
+            print("Could not write GTF cache: " + str(e))
+
+    def load(self, cachefile, checksum):
+        try:
+            with np.load(cachefile, allow_pickle=False) as data:
+                if str(data["checksum"]) != checksum or int(data["version"]) != CACHEVERSION:
+                    print("GTF cache " + cachefile + " is outdated; re-parsing GTF")
+                    return False
+                for name in self.ARRAYS:
+                    setattr(self, name, data[name])
+        except (OSError, KeyError, ValueError) as e:
+            print("Could not read GTF cache: " + str(e))
+            return False
+        if self.verbose:
+            print("Loaded GTF from cache: " + cachefile)
+        return True
+
+    # per-chromosome gene index, sorted by start
+    def index(self):
+        self.genesPerChr = {}
+        order = np.lexsort((self.geneStart, self.geneChr))
+        chrs = self.geneChr[order]
+        bounds = np.flatnonzero(np.diff(chrs)) + 1
+        for sel in np.split(order, bounds):
+            if len(sel) > 0:
+                self.genesPerChr[Chromosome.fromCode(int(self.geneChr[sel[0]]))] = sel
+        if self.verbose:
+            print("{} genes, {} transcripts, {} exons".format(len(self.geneIds), len(self.transcriptIds), len(self.exonIds)))
+            print("Loaded genes per chromosome:")
+            for chr in self.genesPerChr.keys():
+                print(f"{chr}\t{len(self.genesPerChr.get(chr))}")
+            print()
+        self.geneIndex = IntervalIndex(self.geneChr, self.geneStart, self.geneStop)
+
+    @property
+    def genes(self):
+        return [GeneView(self, i) for i in range(len(self.geneIds))]
+
+    @property
+    def transcripts(self):
+        return [TranscriptView(self, i) for i in range(len(self.transcriptIds))]
+
+    @property
+    def exons(self):
+        return [ExonView(self, i) for i in range(len(self.exonIds))]
+
+    def getGene(self, gid):
+        if self.idToGeneIdx is None:
+            self.idToGeneIdx = {g: i for i, g in enumerate(self.geneIds.tolist())}
+        idx = self.idToGeneIdx.get(gid)
+        if idx is None:
+            return None
+        return GeneView(self, idx)
+
+    def getTranscript(self, tid):
+        if self.idToTranscriptIdx is None:
+            self.idToTranscriptIdx = {t: i for i, t in enumerate(self.transcriptIds.tolist())}
+        idx = self.idToTranscriptIdx.get(tid)
+        if idx is None:
+            return None
+        return TranscriptView(self, idx)
+
+    def getExon(self, eid):
+        if self.idToExonIdx is None:
+            self.idToExonIdx = {e: i for i, e in enumerate(self.exonIds.tolist())}
+        idx = self.idToExonIdx.get(eid)
+        if idx is None:
+            return None
+        return ExonView(self, idx)
+
+    def getGenesByChromosome(self):
+        output = {}
+        for chr in self.genesPerChr.keys():
+            output[chr] = [GeneView(self, int(i)) for i in self.genesPerChr.get(chr)]
+        return output
+
+    # gene indices overlapping chr:start-stop, extended by wiggle on both sides (half-open intervals)
+    def getGeneIdxByRange(self, chr, start, stop, wiggle):
+        return self.geneIndex.queryOne(chr.getNumber(), start, stop, wiggle)
+
+    def getGenesByRange(self, chr, start, stop, wiggle):
+        idx = self.getGeneIdxByRange(chr, start, stop, wiggle)
+        if idx is None:
+            return None
+        return [GeneView(self, int(i)) for i in idx]
+
+    def getOverlappingGenes(self, feature, wiggle):
+        return self.getGenesByRange(feature.chr, feature.start, feature.stop, wiggle)
+
+    # batch version of getOverlappingGenes, see GTFAnnotation.getOverlappingGeneIdx
+    def getOverlappingGeneIdx(self, chrs, starts, stops, wiggle):
+        return self.geneIndex.query(chrs, starts, stops, wiggle)
@@ -0,0 +1,95 @@
+import gzip
+import os
+import struct
+
+import numpy as np
+
+# Reads the linear index of a tabix (.tbi) index to estimate the number of records (e.g. VCF
+# variants) in a region without reading the indexed file. The linear index stores, per 16kb window
+# of a reference sequence, the virtual file offset of the first record overlapping that window; the
+# compressed bytes between consecutive windows are taken as proportional to the number of records
+# in the window. When the index has the htslib pseudo-bin with the number of mapped records per
+# reference, the byte estimates are scaled to that count; otherwise the estimates are in bytes.
+
+TBI_WINDOW = 16384
+PSEUDO_BIN = 37450
+
+
+class TabixIndex:
+
+    def __init__(self, file):
+        self.file = file
+        self.refs = {}
+        self.parse(file)
+
+    @staticmethod
+    def find(indexedfile):
+        # path of the tabix index for a bgzipped file, or None when there is none
+        if os.path.exists(indexedfile + ".tbi"):
+            return indexedfile + ".tbi"
+        return None
+
+    def parse(self, file):
+        with gzip.open(file, 'rb') as fh:
+            data = fh.read()
+        if data[0:4] != b"TBI\x01":
+            raise ValueError("Not a tabix index: " + file)
+        nref, = struct.unpack_from("<i", data, 4)
+        lnm, = struct.unpack_from("<i", data, 32)
+        names = data[36:36 + lnm].split(b"\x00")[:nref]
+        pos = 36 + lnm
+        for name in names:
+            nbin, = struct.unpack_from("<i", data, pos)
+            pos += 4
+            nmapped = None
+            lastoffset = 0
+            for _ in range(nbin):
+                bin, nchunk = struct.unpack_from("<Ii", data, pos)
+                pos += 8
+                chunks = np.frombuffer(data, dtype="<u8", count=2 * nchunk, offset=pos)
+                pos += 16 * nchunk
+                if bin == PSEUDO_BIN and nchunk == 2:
+                    lastoffset = int(chunks[1])
+                    nmapped = int(chunks[2])
+                elif nchunk > 0:
+                    lastoffset = max(lastoffset, int(chunks[1::2].max()))
+            nintv, = struct.unpack_from("<i", data, pos)
+            pos += 4
+            ioff = np.frombuffer(data, dtype="<u8", count=nintv, offset=pos).copy()
+            pos += 8 * nintv
+            self.refs[name.decode()] = (ioff, lastoffset, nmapped)
+
+    def getName(self, chr):
+        # reference name for a chromosome, with or without the chr prefix
+        for name in [str(chr), "chr" + str(chr), str(chr).replace("chr", "")]:
+            if name in self.refs:
+                return name
+        return None
+
+    def cumulativeCounts(self, name):
+        # estimated number of records before each 16kb window (length: nr windows + 1)
+        ioff, lastoffset, nmapped = self.refs[name]
+        coffsets = (ioff >> np.uint64(16)).astype(np.int64)
+        # windows without records have offset 0 in older indexes; carry the next window's offset back
+        coffsets = np.minimum.accumulate(np.where(coffsets > 0, coffsets, np.iinfo(np.int64).max)[::-1])[::-1]
+        end = max(lastoffset >> 16, int(coffsets[-1]) if len(coffsets) > 0 else 0)
+        coffsets = np.minimum(coffsets, end)
+        nbytes = np.diff(np.append(coffsets, end)).astype(np.float64)
+        counts = np.concatenate([[0.0], np.cumsum(nbytes)])
+        if nmapped is not None and counts[-1] > 0:
+            counts *= nmapped / counts[-1]
+        return counts
+
+    def estimateCounts(self, chr, starts, ends):
+        # estimated number of records between each start and end (arrays, 0-based or 1-based alike);
+        # None when the chromosome is not in the index
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        name = self.getName(chr)
+        if name is None:
+            return None
+        counts = self.cumulativeCounts(name)
+        nwindows = len(counts) - 1
+        w0 = np.clip(starts // TBI_WINDOW, 0, nwindows)
+        w1 = np.clip(ends // TBI_WINDOW + 1, 0, nwindows)
+        return np.maximum(counts[w1] - counts[w0], 0)
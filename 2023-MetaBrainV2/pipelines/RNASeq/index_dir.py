@@ -1,84 +1,106 @@
 import os
 import argparse
 import sys
+from pathlib import Path
+
+path = str(Path(__file__).parent.parent.parent.absolute().__str__() + "/library/")
+sys.path.insert(0, path)
+from fsindex import DirectoryIndex, SampleMatcher
 
 FASTQ_EXTENSIONS = ('fq', 'fastq', 'fq.gz', 'fastq.gz')
 
-def index_dir(path, samples):
-    '''Function that recursively loops through a directory and indexes all BAM and FASTQ'''
-    global output_dict
-    
-    # Loop through all entries in a directory. And entry could be a file or another directory
-    for entry in os.listdir(path):
-        entry_path = os.path.join(path, entry)
+def index_file(output_dict, entry, entry_path, in_samples):
+    '''Function that adds a BAM or FASTQ file to the output dict. in_samples() tells whether the path matches the sample list'''
+
+    # If the file is gzipped, remove the gz extension
+    if entry.split('.')[-1] == 'gz':
+        file = '.'.join(entry.split('.')[:-1])
+    else:
+        file = entry
+
+    # Get file name without extension
+    extension = file.split('.')[-1]
+    file_name = '.'.join(file.split('.')[:-1])
+
+    # If the file is a .bam file, add it to the output dict
+    if extension == 'bam' and in_samples():
+        output_dict[file_name] = entry_path
+
+    # If the file is a fastq file
+    if extension in FASTQ_EXTENSIONS:
 
-        # If the entry is a file
-        if os.path.isfile(entry_path):
+        # If the file name ends with '_1', it is assumed that it is one of two paired end files
+        if file_name.endswith('_1') or file_name.lower().endswith('_r1') or file_name.endswith('_R1_001') or file_name.lower().endswith('.r1'):
+            if file_name.lower().endswith('.r1'):
+                sample_name = file_name[:-3]
+            
+            if file_name.endswith('_1'):
+                sample_name = file_name[:-2]
+            
+            if file_name.lower().endswith('_r1'):
+                sample_name = file_name[:-3]
 
-            # If the file is gzipped, remove the gz extension
-            if entry.split('.')[-1] == 'gz':
-                file = '.'.join(entry.split('.')[:-1])
+            if file_name.endswith('_R1_001'):
+                sample_name = file_name[:-7]
+            
+            
+            if sample_name in output_dict and in_samples():
+                output_dict[sample_name]['1'] = entry_path
             else:
-                file = entry
+                output_dict[sample_name] = {'1': entry_path}
 
-            # Get file name without extension
-            extension = file.split('.')[-1]
-            file_name = '.'.join(file.split('.')[:-1])
 
-            # If the file is a .bam file, add it to the output dict
-            if extension == 'bam' and (samples is None or any(substring in entry_path for substring in samples)):
+        # If the file name ends with '_2', it is assumed that it is one of two paired end files
+        elif file_name.endswith('_2') or file_name.lower().endswith('_r2') or file_name.endswith('_R2_001') or file_name.lower().endswith('.r2'):
+            if file_name.lower().endswith('.r2'):
+                sample_name = file_name[:-3]
+            
+            if file_name.endswith('_2'):
+                sample_name = file_name[:-2]
+            
+            if file_name.lower().endswith('_r2'):
+                sample_name = file_name[:-3]
+            if file_name.endswith('_R2_001'):
+                sample_name = file_name[:-7]
+
+            if sample_name in output_dict and in_samples():
+                output_dict[sample_name]['2'] = entry_path
+            else:
+                output_dict[sample_name] = {'2': entry_path}
+        
+        # If the filename does not end with '_1'/'_r1 or '_2'/'_r2', it is assumed to be single end and added to the output dict
+        else:
+            if in_samples():
                 output_dict[file_name] = entry_path
 
-            # If the file is a fastq file
-            if extension in FASTQ_EXTENSIONS:
-
-                # If the file name ends with '_1', it is assumed that it is one of two paired end files
-                if file_name.endswith('_1') or file_name.lower().endswith('_r1') or file_name.endswith('_R1_001') or file_name.lower().endswith('.r1'):
-                    if file_name.lower().endswith('.r1'):
-                        sample_name = file_name[:-3]
-                    
-                    if file_name.endswith('_1'):
-                        sample_name = file_name[:-2]
-                    
-                    if file_name.lower().endswith('_r1'):
-                        sample_name = file_name[:-3]
-
-                    if file_name.endswith('_R1_001'):
-                        sample_name = file_name[:-7]
-                    
-                    
-                    if sample_name in output_dict and (samples is None or any(substring in entry_path for substring in samples)):
-                        output_dict[sample_name]['1'] = entry_path
-                    else:
-                        output_dict[sample_name] = {'1': entry_path}
-
-
-                # If the file name ends with '_2', it is assumed that it is one of two paired end files
-                elif file_name.endswith('_2') or file_name.lower().endswith('_r2') or file_name.endswith('_R2_001') or file_name.lower().endswith('.r2'):
-                    if file_name.lower().endswith('.r2'):
-                        sample_name = file_name[:-3]
-                    
-                    if file_name.endswith('_2'):
-                        sample_name = file_name[:-2]
-                    
-                    if file_name.lower().endswith('_r2'):
-                        sample_name = file_name[:-3]
-                    if file_name.endswith('_R2_001'):
-                        sample_name = file_name[:-7]
-
-                    if sample_name in output_dict and (samples is None or any(substring in entry_path for substring in samples)):
-                        output_dict[sample_name]['2'] = entry_path
-                    else:
-                        output_dict[sample_name] = {'2': entry_path}
-                
-                # If the filename does not end with '_1'/'_r1 or '_2'/'_r2', it is assumed to be single end and added to the output dict
-                else:
-                    if (samples is None or  any(substring in entry_path for substring in samples)):
-                        output_dict[file_name] = entry_path
-
-        # If the entry is a directory, recursively call the check_dir function again for that directory
-        if os.path.isdir(entry_path):
-            index_dir(entry_path, samples)
+
+def index_dir(path, samples, cache_file=None, threads=8):
+    '''Function that indexes all BAM and FASTQ files below a directory. Directories are listed concurrently; with a
+    cache file, only directories that changed since the previous run are listed again'''
+    index = DirectoryIndex(path, cache_file, threads)
+    nr_scanned, nr_reused = index.update()
+    print(f'{nr_scanned} directories listed, {nr_reused} directories unchanged since the previous index')
+
+    # A path matches the sample list when any of the sample names is a substring of it. The matcher state after the
+    # directory part of the path is kept per directory, so only the file name is scanned per file
+    matcher = SampleMatcher(samples) if samples is not None else None
+    dir_states = {}
+
+    output_dict = {}
+    for dir_path, entry, _, _ in index.walk():
+        entry_path = os.path.join(dir_path, entry)
+
+        def in_samples():
+            if matcher is None:
+                return True
+            state = dir_states.get(dir_path)
+            if state is None:
+                state = matcher.scan(entry_path[:len(entry_path) - len(entry)])
+                dir_states[dir_path] = state
+            return matcher.contains(entry, state)
+
+        index_file(output_dict, entry, entry_path, in_samples)
+    return output_dict
 
 
 def write_lines_to_file(output_dict, out_file):
@@ -92,37 +114,24 @@ def write_lines_to_file(output_dict, out_file):
         if type(v) == dict and '1' in v and '2' in v:
             output_list.append(k + ',' + v['1'] + ';' + v['2'])
         
-    # Write lines to file    
+    # Write lines to file, without a new line character after the last line
     f = open(f'{out_file}.txt', 'w')
-
-    for line in output_list:
-        f.write(line)
-
-        # Don't write a new line character after the last line
-        if output_list.index(line) != len(output_list) - 1:
-            f.write('\n')
-
+    f.write('\n'.join(output_list))
     f.close()
-
-def chunk_file(out_file, chunk_size):
-    fh = open(f'{out_file}.txt','r')
-    lines = fh.readlines()
-    fh.close()
-    ctr = 0 # line ctr
-    wctr = 0 # lines written counter
-    cctr = 1 # chunk counter
-    fho = open(f'{out_file}_{cctr}.txt','w')
-    while(ctr < len(lines)):
-        if ctr % chunk_size == 0 and wctr > 0: # if ctr == 0, this will start a new chunk, unless wctr > 0
-            fho.close()
-            cctr += 1
-            fho = open(f'{out_file}_{cctr}.txt','w')
-            wctr = 0
-        fho.write(lines[ctr])
-        wctr += 1
-        ctr += 1
-    if wctr > 0:
-       fho.close()
+    return output_list
+
+def chunk_file(output_list, out_file, chunk_size):
+    '''Function that splits the indexed lines into files of chunk_size lines'''
+    if len(output_list) == 0:
+        open(f'{out_file}_1.txt','w').close()
+    for cctr, start in enumerate(range(0, len(output_list), chunk_size), 1):
+        chunk = output_list[start:start + chunk_size]
+        fho = open(f'{out_file}_{cctr}.txt','w')
+        fho.write('\n'.join(chunk))
+        # Only the last line of the last chunk has no new line character
+        if start + chunk_size < len(output_list):
+            fho.write('\n')
+        fho.close()
 
 if __name__ == '__main__':
     # Create argument parsers object and add arguments
@@ -131,6 +140,9 @@ if __name__ == '__main__':
     parser.add_argument('--sample_file', help='''A text file containing a list of samples that need to be indexed. 
                         The sample names should be split in lines. If no sample list is provided, all samples will be indexed (OPTIONAL)''')
     parser.add_argument('--out', help='Prefix of the outfile.')
+    parser.add_argument('--cache', help='''Index file (.gz) with the directory listings of the previous run. Only directories that
+                        changed since then are listed again. Created when it does not exist (OPTIONAL)''')
+    parser.add_argument('--threads', type=int, default=8, help='Number of directories that are listed concurrently (default: 8)')
     args = parser.parse_args()
 
     # Check if the input directory is a valid directory
@@ -158,8 +170,7 @@ if __name__ == '__main__':
     if not out_file:
         raise ValueError('Please provide a prefix for the output file')
     
-    output_dict = {}
-    index_dir(input_directory, samples)
-    write_lines_to_file(output_dict, out_file)
+    output_dict = index_dir(input_directory, samples, args.cache, args.threads)
+    output_list = write_lines_to_file(output_dict, out_file)
     chunk_size = 300
-    chunk_file(out_file,chunk_size)
+    chunk_file(output_list, out_file, chunk_size)
@@ -1,48 +1,42 @@
 import os
 import argparse
 import sys
+from pathlib import Path
 
+path = str(Path(__file__).parent.parent.parent.absolute().__str__() + "/library/")
+sys.path.insert(0, path)
+from fsindex import DirectoryIndex
 
-def index_dir(path, file_substring = None):
-    global output_list
-    
-    # Loop through all entries in a directory. An entry could be a file or another directory
-    for entry in os.listdir(path):
-        entry_path = os.path.join(path, entry)
 
-        # If the entry is a file
-        if os.path.isfile(entry_path):
+def index_dir(path, file_substring = None, cache_file = None, threads = 8):
+    '''Function that indexes all (gzipped) VCF files below a directory. Directories are listed concurrently; with a
+    cache file, only directories that changed since the previous run are listed again'''
+    index = DirectoryIndex(path, cache_file, threads)
+    nr_scanned, nr_reused = index.update()
+    print(f'{nr_scanned} directories listed, {nr_reused} directories unchanged since the previous index')
 
-            # Check if path is a (gzipped) vcf file
-            if entry_path.endswith(('.vcf', '.vcf.gz')):
+    output_list = []
+    for dir_path, entry, _, _ in index.walk():
+        entry_path = os.path.join(dir_path, entry)
 
-                # If the substring parameter is set, check if the file contains the specified substring
-                # print(file_substring)
-                if file_substring is not None:
-                    if file_substring in entry_path:
-                        output_list.append(entry_path)
-                # Add path to output list if no substring parameter is set
-                else:
-                    output_list.append(entry_path)
-            
+        # Check if path is a (gzipped) vcf file
+        if entry_path.endswith(('.vcf', '.vcf.gz')):
 
-        # If the entry is a directory, recursively call the check_dir function again for that directory
-        if os.path.isdir(entry_path):
-            index_dir(entry_path, file_substring)
+            # If the substring parameter is set, check if the file contains the specified substring
+            if file_substring is not None:
+                if file_substring in entry_path:
+                    output_list.append(entry_path)
+            # Add path to output list if no substring parameter is set
+            else:
+                output_list.append(entry_path)
+    return output_list
 
 
 def write_lines_to_file(output_list, out_prefix):
         
-    # Write lines to file    
+    # Write lines to file, without a new line character after the last line
     f = open(f'{out_prefix}.txt', "w")
-
-    for line in output_list:
-        f.write(line)
-
-        # Don't write a new line character after the last line
-        if output_list.index(line) != len(output_list) - 1:
-            f.write('\n')
-
+    f.write('\n'.join(output_list))
     f.close()
 
 
@@ -52,6 +46,9 @@ if __name__ == '__main__':
     parser.add_argument("--input_dir", help="The directory that needs to be indexed (REQUIRED)")
     parser.add_argument("--file_substring", help="Substring that should be present in all files to select (OPTIONAL)")
     parser.add_argument("--out", help="Prefix of the output file (REQUIRED)")
+    parser.add_argument("--cache", help="""Index file (.gz) with the directory listings of the previous run. Only directories that
+                        changed since then are listed again. Created when it does not exist (OPTIONAL)""")
+    parser.add_argument("--threads", type=int, default=8, help="Number of directories that are listed concurrently (default: 8)")
     args = parser.parse_args()
 
     # Check if the input directory is a valid directory
@@ -72,7 +69,6 @@ if __name__ == '__main__':
         raise ValueError('Please provide a prefix for the output file')
 
 
-    output_list = []
-    index_dir(input_directory, file_substring)
+    output_list = index_dir(input_directory, file_substring, args.cache, args.threads)
     write_lines_to_file(output_list, out_prefix)
         
\ No newline at end of file
@@ -7,6 +7,9 @@ import tempfile
 import os
 import gzip
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 def main(options,libl):
     
@@ -16,7 +19,6 @@ def main(options,libl):
 
     sort_junctions(libl, options)
     merge_junctions(options)
-    get_numers(options)
 
 def getrfh(fname):
     if fname[-3:] == ".gz":
@@ -30,69 +32,195 @@ def getwfh(fname):
     else:
         return open(fname,'w')        
 
+def parse_junc_file(lib, useStrand, checkchrom, maxIntronLen):
+    ''' Parses a regtools junction file into per (chrom,strand) sorted start, end and count arrays.
+    Intron length is not filtered here, so that sort_junctions can reuse the arrays; instead, the
+    number of lines passing maxIntronLen and the order in which (chrom,strand) first passes it are
+    returned for pooling. '''
+
+    chromLst = ["chr%d"%x for x in range(1,23)]+['chrX','chrY']+["%d"%x for x in range(1,23)]+['X','Y']
+    by_chrom = {}
+    pooledOrder = []
+    pooledSeen = set()
+    lctr = 0
+    for ln in getrfh(lib):
+
+        lnsplit=ln.split()
+        if len(lnsplit)<6:
+            sys.stderr.write("Error in %s \n" % lib)
+            continue
+        chrom, A, B, dot, counts, strand, rA,rb, rgb, blockCount, blockSize, blockStarts = lnsplit
+        if int(blockCount) > 2:
+            print( ln )
+            continue
+        if not useStrand:
+            strand = "NA"
+        if checkchrom and (chrom not in chromLst): continue
+        Aoff, Boff = blockSize.split(",")
+        A, B = int(A)+int(Aoff), int(B)-int(Boff)+1
+        key = (chrom,strand)
+        try: arrs = by_chrom[key]
+        except KeyError:
+            arrs = ([], [], [])
+            by_chrom[key] = arrs
+        arrs[0].append(A)
+        arrs[1].append(B)
+        arrs[2].append(int(counts))
+        if B-A > maxIntronLen: continue
+        if key not in pooledSeen:
+            pooledSeen.add(key)
+            pooledOrder.append(key)
+        lctr += 1
+
+    junctions = {}
+    for key in by_chrom:
+        starts, ends, counts = by_chrom[key]
+        junctions[key] = group_sum(np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), np.array(counts, dtype=np.int64))
+    return junctions, pooledOrder, lctr
+
+def group_sum(starts, ends, counts):
+    ''' Sorts junctions on (start, end) and sums the counts of identical junctions '''
+    if len(starts) == 0:
+        return starts, ends, counts
+    order = np.lexsort((ends, starts))
+    starts, ends, counts = starts[order], ends[order], counts[order]
+    first = np.flatnonzero(np.r_[True, (starts[1:] != starts[:-1]) | (ends[1:] != ends[:-1])])
+    return starts[first], ends[first], np.add.reduceat(counts, first)
+
+def junc_arrays_file(lib, options):
+    return "%s/%s.%s.junc.npz"%(options.rundir, lib.split('/')[-1], options.outprefix.split("/")[-1])
+
+def junc_arrays_options(options):
+    ''' The parse options the arrays depend on; stored with the arrays so that they are only reused
+    with the same options '''
+    return np.array([bool(options.strand), bool(options.checkchrom)])
+
+def save_junc_arrays(fname, junctions, parseOptions):
+    keys = list(junctions.keys())
+    sizes = [len(junctions[key][0]) for key in keys]
+    offsets = np.zeros(len(keys)+1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    empty = np.zeros(0, dtype=np.int64)
+    with open(fname, 'wb') as fh:
+        np.savez(fh,
+                 chroms=np.array([key[0] for key in keys], dtype=str),
+                 strands=np.array([key[1] for key in keys], dtype=str),
+                 options=parseOptions,
+                 offsets=offsets,
+                 starts=np.concatenate([junctions[key][0] for key in keys] + [empty]),
+                 ends=np.concatenate([junctions[key][1] for key in keys] + [empty]),
+                 counts=np.concatenate([junctions[key][2] for key in keys] + [empty]))
+
+def load_junc_arrays(fname, parseOptions):
+    ''' The arrays stored in fname, or None when they were made with other parse options '''
+    junctions = {}
+    with np.load(fname, allow_pickle=False) as data:
+        if "options" not in data or not np.array_equal(data["options"], parseOptions):
+            return None
+        offsets = data["offsets"]
+        starts, ends, counts = data["starts"], data["ends"], data["counts"]
+        for i, (chrom, strand) in enumerate(zip(data["chroms"].tolist(), data["strands"].tolist())):
+            junctions[(chrom,strand)] = (starts[offsets[i]:offsets[i+1]], ends[offsets[i]:offsets[i+1]], counts[offsets[i]:offsets[i+1]])
+    return junctions
+
+def map_junc_file(lib, options):
+    ''' Map step of pool_junc_reads: parse one library and store its arrays for sort_junctions '''
+    if options.verbose:
+        sys.stderr.write("scanning %s...\n"%lib)
+    junctions, pooledOrder, lctr = parse_junc_file(lib, options.strand, options.checkchrom, int(options.maxintronlen))
+    save_junc_arrays(junc_arrays_file(lib, options), junctions, junc_arrays_options(options))
+    maxIntronLen = int(options.maxintronlen)
+    pooled = {}
+    for key in pooledOrder:
+        starts, ends, counts = junctions[key]
+        keep = (ends - starts) <= maxIntronLen
+        pooled[key] = (starts[keep], ends[keep], counts[keep])
+    return pooled, lctr
+
+class JunctionPool:
+    ''' Reduce step of pool_junc_reads: accumulates sorted junction arrays per (chrom,strand) and
+    merges them with a group-by-sum once the buffered arrays outgrow the merged ones '''
+
+    def __init__(self):
+        self.merged = {}
+        self.buffered = {}
+        self.nrbuffered = {}
+
+    def add(self, key, starts, ends, counts):
+        if key not in self.merged:
+            empty = np.zeros(0, dtype=np.int64)
+            self.merged[key] = (empty, empty, empty)
+            self.buffered[key] = []
+            self.nrbuffered[key] = 0
+        self.buffered[key].append((starts, ends, counts))
+        self.nrbuffered[key] += len(starts)
+        if self.nrbuffered[key] > max(1000000, len(self.merged[key][0])):
+            self.compact(key)
+
+    def compact(self, key):
+        chunks = [self.merged[key]] + self.buffered[key]
+        self.merged[key] = group_sum(np.concatenate([c[0] for c in chunks]),
+                                     np.concatenate([c[1] for c in chunks]),
+                                     np.concatenate([c[2] for c in chunks]))
+        self.buffered[key] = []
+        self.nrbuffered[key] = 0
+
+    def get(self, key):
+        if self.nrbuffered[key] > 0:
+            self.compact(key)
+        return self.merged[key]
+
+    def keys(self):
+        return self.merged.keys()
+
 def pool_junc_reads(flist, options):
 
     outPrefix = options.outprefix
     rundir = options.rundir
-    maxIntronLen = int(options.maxintronlen)
-    checkchrom = options.checkchrom
-    useStrand = options.strand
+    nrprocs = int(options.nrprocs)
 
     outFile = "%s/%s_pooled.gz"%(rundir,outPrefix)
-    
-    chromLst = ["chr%d"%x for x in range(1,23)]+['chrX','chrY']+["%d"%x for x in range(1,23)]+['X','Y']
-    by_chrom = {}
+
+    libs = []
     for libl in flist:
-        
         lib = libl.strip()
-        if not os.path.isfile(lib):
-            continue
+        if os.path.isfile(lib):
+            libs.append(lib)
 
-        if options.verbose:
-            sys.stderr.write("scanning %s...\n"%lib)
-        lctr = 0
-        for ln in getrfh(lib):
-            
-            lnsplit=ln.split()
-            if len(lnsplit)<6: 
-                sys.stderr.write("Error in %s \n" % lib)
-                continue
-            chrom, A, B, dot, counts, strand, rA,rb, rgb, blockCount, blockSize, blockStarts = lnsplit
-            if int(blockCount) > 2:
-                print( ln )
-                continue
-            if not useStrand:
-                strand = "NA"            
-            if checkchrom and (chrom not in chromLst): continue
-            Aoff, Boff = blockSize.split(",")
-            A, B = int(A)+int(Aoff), int(B)-int(Boff)+1
-    
-            if B-A > int(maxIntronLen): continue
-            try: by_chrom[(chrom,strand)][(A,B)] = int(counts) + by_chrom[(chrom,strand)][(A,B)]
-            except: 
-                try: by_chrom[(chrom,strand)][(A,B)] = int(counts)
-                except: by_chrom[(chrom,strand)] = {(A,B):int(counts)}
-            lctr += 1
+    by_chrom = JunctionPool()
+    if nrprocs > 1:
+        executor = ProcessPoolExecutor(max_workers=nrprocs)
+        results = executor.map(map_junc_file, libs, [options]*len(libs))
+    else:
+        executor = None
+        results = map(map_junc_file, libs, [options]*len(libs))
+    for pooled, lctr in results:
+        for key in pooled:
+            by_chrom.add(key, *pooled[key])
         print("Lines parsed: {}".format(lctr))
+    if executor is not None:
+        executor.shutdown()
+
     fout = getwfh(outFile)
     Ncluster = 0
     sys.stderr.write("Parsing...\n")
-    for chrom in by_chrom:
-        read_ks = [k for k,v in by_chrom[chrom].items() if v >= 3] # a junction must have at least 3 reads
-        read_ks.sort()
-        
-        if len(read_ks)==0: continue
+    for chrom in by_chrom.keys():
+        starts, ends, counts = by_chrom.get(chrom)
+        keep = counts >= 3 # a junction must have at least 3 reads
+        starts, ends, counts = starts[keep], ends[keep], counts[keep]
+
+        if len(starts)==0: continue
 
         sys.stderr.write("%s:%s.."%chrom)
-        clu = cluster_intervals(read_ks)[0]
-        for cl in clu:
-    
-            if len(cl) > 0: # 1 if cluster has more than one intron  
-                buf = '%s:%s '%chrom
-                for interval, count in [(x, by_chrom[chrom][x]) for x in cl]:
-                    buf += "%d:%d" % interval + ":%d"%count+ " "
-                fout.write(buf+'\n')
-                Ncluster += 1
+        order = np.lexsort((ends, starts))
+        starts, ends, counts = starts[order], ends[order], counts[order]
+        bounds = cluster_bounds(starts, ends)
+        for i in range(len(bounds) - 1):
+            cl = slice(bounds[i], bounds[i+1])
+            buf = '%s:%s '%chrom
+            buf += "".join(["%d:%d:%d " % x for x in zip(starts[cl].tolist(), ends[cl].tolist(), counts[cl].tolist())])
+            fout.write(buf+'\n')
+            Ncluster += 1
     sys.stderr.write("\nWrote %d clusters..\n"%Ncluster)
     fout.close()
 
@@ -158,7 +286,24 @@ def sort_junctions(libl, options):
         fout.write("chrom %s\n"%libN.split("/")[-1].split(".junc")[0])
 
         for lib in merges[libN]:
-        
+
+            # reuse the arrays stored by pool_junc_reads when they are newer than the junction file
+            # and were made with the same -s/-k options
+            arrayFile = junc_arrays_file(lib, options)
+            junctions = None
+            if os.path.isfile(arrayFile) and os.path.getmtime(arrayFile) >= os.path.getmtime(lib):
+                junctions = load_junc_arrays(arrayFile, junc_arrays_options(options))
+            if junctions is not None:
+                for chrom, (starts, ends, counts) in junctions.items():
+                    if chrom not in by_chrom:
+                        by_chrom[chrom] = {}
+                    for intron, count in zip(zip(starts.tolist(), ends.tolist()), counts.tolist()):
+                        if intron in by_chrom[chrom]:
+                            by_chrom[chrom][intron] += count
+                        else:
+                            by_chrom[chrom][intron] = count
+                continue
+
             for ln in getrfh(lib):
 
                 lnsplit=ln.split()
@@ -229,34 +374,28 @@ def refine_clusters(options):
     Ncl = 0
     lnctr = 0
     for ln in getrfh(inFile):
-        clu = []
-        totN = 0
-        chrom = ln.split()[0]
-        for ex in ln.split()[1:]:
-            A, B, N = ex.split(":")
-            clu.append(((int(A),int(B)), int(N)))
-            totN += int(N)
+        lnsplit = ln.split()
+        chrom = lnsplit[0]
+        clu = np.array([ex.split(":") for ex in lnsplit[1:]], dtype=np.int64).reshape(-1, 3)
+        starts, ends, counts = clu[:, 0], clu[:, 1], clu[:, 2]
         
-        if totN < minclureads: continue
+        if counts.sum() < minclureads: continue
 
         if options.const:
             if len(clu) == 1:
                 buf = '%s ' % chrom
-                for interval, count in clu:
-                    buf += "%d:%d" % interval + ":%d"%(count)+ " "
+                buf += "%d:%d:%d " % (starts[0], ends[0], counts[0])
                 Ncl += 1
                 fout.write(buf+'\n')
         
-        for cl in refine_linked(clu):
-            rc = refine_cluster(cl,minratio, minreads)
+        for g in link_groups(starts, ends):
+            rc = refine_cluster_arrays(starts[g], ends[g], counts[g], minratio, minreads)
             
-            if len(rc) > 0:
-                for clu in rc:
-                    buf = '%s ' % chrom
-                    for interval, count in clu:
-                        buf += "%d:%d" % interval + ":%d"%(count)+ " "
-                    Ncl += 1
-                    fout.write(buf+'\n')
+            for cs, ce, cc in rc:
+                buf = '%s ' % chrom
+                buf += "".join(["%d:%d:%d " % x for x in zip(cs.tolist(), ce.tolist(), cc.tolist())])
+                Ncl += 1
+                fout.write(buf+'\n')
         lnctr+=1
         print(f"{lnctr} lines parsed ",end='\r')
     print(f"{lnctr} lines parsed ",end='\n')
@@ -266,10 +405,13 @@ def refine_clusters(options):
 
 
 def merge_junctions(options):    
-    ''' function to merge junctions '''
+    ''' function to merge junctions: the count column of each sorted library is decoded once into
+    a (numerator/denominator, sample, intron) matrix on disk, which is then written out in row
+    blocks to the perind counts and perind_numers files '''
 
     outPrefix = options.outprefix
     rundir = options.rundir
+    nrprocs = int(options.nrprocs)
     
     fnameout = "%s/%s"%(rundir,outPrefix)
 
@@ -280,95 +422,219 @@ def merge_junctions(options):
         lsts.append(ln.strip())
     if options.verbose:
         sys.stderr.write("merging %d junction files...\n"%(len(lsts)))
-    
-    # Change 300 if max open file is < 300
-    N = min([300, max([100, int(len(lsts)**(0.5))])])
 
-    tmpfiles = []
-    while len(lsts) > 1:    
-        clst = []
-        
-        for i in range(0,int( (len(lsts)/N)+1) ):
-            lst = lsts[N*i:N*(i+1)]
-            if len(lst) > 0:
-                clst.append(lst)
-        lsts = []
-    
-        for lst in clst:
-            if len(lst) == 0: continue
-            tmpfile = tempfile.mktemp()
-            os.mkdir(tmpfile)
-            foutname = tmpfile+"/tmpmerge.gz"
-            fout = getwfh(foutname)
-            
-            merge_files(lst, fout, options)
-            lsts.append(foutname)
-            tmpfiles.append(foutname)
-            fout.close()
-            
     if not options.const:
-        shutil.move(lsts[0], fnameout+"_perind.counts.gz")
+        countsName = fnameout+"_perind.counts.gz"
+        numersName = fnameout+"_perind_numers.counts.gz"
     else:
-        shutil.move(lsts[0], fnameout+"_perind.constcounts.gz")
-
-def merge_files(fnames, fout, options):
-
-    fopen = []
-    for fname in fnames:
-        fopen.append(getrfh(fname))
-
-    finished = False
-    N = 0
-    while not finished:
-        N += 1
-        if N % 50000 == 0: 
+        countsName = fnameout+"_perind.constcounts.gz"
+        numersName = fnameout+"_perind_numers.constcounts.gz"
+
+    # the first library defines the intron names and the number of rows; all libraries are
+    # written by sort_junctions from the same refined clusters, so their rows line up
+    name, introns, values = read_sorted_counts(lsts[0], True)
+    shape = (2, len(lsts), len(introns))
+    # the matrix and the pool are cleaned up when decoding or writing fails
+    tmpdir = tempfile.mkdtemp(dir=rundir)
+    executor = None
+    try:
+        matFile = tmpdir+"/counts.mat"
+        mat = np.memmap(matFile, dtype=np.int32, mode='w+', shape=shape)
+        mat[:, 0, :] = values.T
+        mat.flush()
+        del mat
+
+        if nrprocs > 1:
+            executor = ProcessPoolExecutor(max_workers=nrprocs)
+            mapper = executor.map
+        else:
+            mapper = map
+
+        names = [name]
+        for i, name in enumerate(mapper(decode_sorted_counts, lsts[1:], range(1, len(lsts)), [matFile]*(len(lsts)-1), [shape]*(len(lsts)-1))):
+            names.append(name)
+            if (i+2) % 500 == 0:
+                sys.stderr.write("%d files decoded\n"%(i+2))
+
+        # row blocks of about 5M values, formatted and compressed in parallel, written in order
+        blockSize = max(1, 5000000 // len(lsts))
+        blocks = [(r, min(r + blockSize, len(introns))) for r in range(0, len(introns), blockSize)]
+        foutCounts = open(countsName, 'wb')
+        foutNumers = open(numersName, 'wb')
+        foutCounts.write(gzip.compress(("chrom "+" ".join(names)+"\n").encode(), 5))
+        foutNumers.write(gzip.compress((" ".join(names)+"\n").encode(), 5))
+        for countsBlock, numersBlock in mapper(format_count_block, [matFile]*len(blocks), [shape]*len(blocks),
+                                               blocks, [introns[r0:r1] for r0, r1 in blocks]):
+            foutCounts.write(countsBlock)
+            foutNumers.write(numersBlock)
             sys.stderr.write(".")
-        buf = []
-        for f in fopen:
-            ln = f.readline().split()
-            if len(ln) == 0: 
-                finished = True
+        sys.stderr.write(" done.\n")
+        foutCounts.close()
+        foutNumers.close()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        shutil.rmtree(tmpdir)
+
+def read_sorted_counts(fname, withIntrons=False):
+    ''' Reads a library written by sort_junctions; returns the sample name, the intron names
+    (None unless withIntrons) and an (introns x 2) array of numerators and denominators '''
+    fh = getrfh(fname)
+    lines = fh.read().splitlines()
+    fh.close()
+    name = lines[0].split()[1]
+    lines = lines[1:]
+    values = np.array(" ".join([ln.rpartition(" ")[2] for ln in lines]).replace("/", " ").split(), dtype=np.int64).reshape(-1, 2)
+    if len(values) > 0 and values.max() > np.iinfo(np.int32).max:
+        raise ValueError("%s: read count does not fit in 32 bits"%fname)
+    introns = None
+    if withIntrons:
+        introns = [ln.partition(" ")[0] for ln in lines]
+    return name, introns, values
+
+def decode_sorted_counts(fname, col, matFile, shape):
+    ''' Decodes one sorted library into column col of the count matrix '''
+    name, introns, values = read_sorted_counts(fname)
+    if len(values) != shape[2]:
+        raise ValueError("%s has %d introns, expected %d"%(fname, len(values), shape[2]))
+    mat = np.memmap(matFile, dtype=np.int32, mode='r+', shape=shape)
+    mat[:, col, :] = values.T
+    mat.flush()
+    del mat
+    return name
+
+def format_count_block(matFile, shape, block, introns):
+    ''' Formats rows [r0, r1) of the count matrix as gzip members for the counts and numers files '''
+    r0, r1 = block
+    mat = np.memmap(matFile, dtype=np.int32, mode='r', shape=shape)
+    numers = np.ascontiguousarray(mat[0, :, r0:r1].T).tolist()
+    denoms = np.ascontiguousarray(mat[1, :, r0:r1].T).tolist()
+    del mat
+    nrsamples = shape[1]
+    countsFmt = "%s" + " %d/%d"*nrsamples + "\n"
+    numersFmt = "%s" + " %d"*nrsamples + "\n"
+    countsBuf, numersBuf = [], []
+    for intron, numer, denom in zip(introns, numers, denoms):
+        interleaved = [intron]*(2*nrsamples+1)
+        interleaved[1::2] = numer
+        interleaved[2::2] = denom
+        countsBuf.append(countsFmt % tuple(interleaved))
+        numersBuf.append(numersFmt % tuple([intron] + numer))
+    return gzip.compress("".join(countsBuf).encode(), 5), gzip.compress("".join(numersBuf).encode(), 5)
+
+
+def cluster_bounds(starts, ends):
+    ''' Overlap clusters of intervals sorted on (start, end): a new cluster starts where the start
+    lies beyond the largest end seen so far. Returns the first index of each cluster, plus len. '''
+    if len(starts) == 0:
+        return np.zeros(1, dtype=np.int64)
+    maxend = np.maximum.accumulate(ends)
+    breaks = np.flatnonzero(starts[1:] > maxend[:-1]) + 1
+    return np.concatenate(([0], breaks, [len(starts)]))
+
+def site_components(starts, ends):
+    ''' Connected components of introns that share a splice site (start or end coordinate),
+    by union-find on splice site ids with min-label propagation and pointer jumping. '''
+    sites, inv = np.unique(np.concatenate((starts, ends)), return_inverse=True)
+    a, b = inv[:len(starts)], inv[len(starts):]
+    labels = np.arange(len(sites))
+    while True:
+        m = np.minimum(labels[a], labels[b])
+        new = labels.copy()
+        np.minimum.at(new, a, m)
+        np.minimum.at(new, b, m)
+        while True:
+            jumped = new[new]
+            if np.array_equal(jumped, new):
                 break
-            chrom = ln[0]
-            data = ln[1:]
-            if len(buf) == 0:
-                buf.append(chrom)
-            buf += data
-        if len(buf) > 0:
-            if buf[0] == "chrom":
-                if options.verbose:
-                    sys.stderr.write("merging %d files"%(len(buf)-1))
-            fout.write(" ".join(buf)+'\n')
-        else:
-            break
-
-    sys.stderr.write(" done.\n")
-    for fin in fopen:
-        fin.close()
+            new = jumped
+        if np.array_equal(new, labels):
+            return labels[a]
+        labels = new
+
+def link_groups(starts, ends):
+    ''' Array version of refine_linked: groups introns (in the given order) that are linked through
+    shared splice sites. Groups are returned as index arrays in the order refine_linked produces
+    them: ordered by their first intron, and within a group in the order of the repeated passes. '''
+    n = len(starts)
+    if n == 0:
+        return []
+    comp = site_components(starts, ends)
+    order = np.argsort(comp, kind="stable")
+    bounds = np.flatnonzero(np.r_[True, comp[order][1:] != comp[order][:-1]])
+    members = np.split(order, bounds[1:])
+    members.sort(key=lambda m: m[0])
+
+    startl = starts.tolist()
+    endl = ends.tolist()
+    groups = []
+    for m in members:
+        if len(m) <= 2:
+            groups.append(m)
+            continue
+        m = m.tolist()
+        seed = m[0]
+        grouporder = [seed]
+        splicesites = {startl[seed], endl[seed]}
+        remaining = m[1:]
+        while len(remaining) > 0:
+            rest = []
+            for i in remaining:
+                if startl[i] in splicesites or endl[i] in splicesites:
+                    grouporder.append(i)
+                    splicesites.add(startl[i])
+                    splicesites.add(endl[i])
+                else:
+                    rest.append(i)
+            if len(rest) == len(remaining):
+                break
+            remaining = rest
+        groups.append(np.array(grouporder, dtype=np.int64))
+    return groups
+
+def refine_cluster_arrays(starts, ends, counts, cutoff, readcutoff):
+    ''' Iterative version of refine_cluster on start, end and count arrays. Returns a list of
+    (starts, ends, counts) clusters in the order refine_cluster returns them. '''
+    out = []
+    stack = [(starts, ends, counts)]
+    while len(stack) > 0:
+        starts, ends, counts = stack.pop()
+        totN = counts.sum()
+        keep = (counts / float(totN) >= cutoff) & (counts >= readcutoff)
+        reCLU = not keep.all()
+        if not keep.any():
+            continue
 
+        # This makes sure that after trimming, the clusters are still good
+        order = np.lexsort((ends[keep], starts[keep]))
+        ks, ke, kc = starts[keep][order], ends[keep][order], counts[keep][order]
+        bounds = cluster_bounds(ks, ke)
+        A = []
+        for i in range(len(bounds) - 1):
+            sel = np.arange(bounds[i], bounds[i+1])
+            for g in link_groups(ks[sel], ke[sel]):
+                A.append(sel[g])
+
+        if len(A) == 1:
+            if len(A[0]) > 1:
+                if reCLU:
+                    stack.append((ks[A[0]], ke[A[0]], kc[A[0]]))
+                else:
+                    out.append((ks[A[0]], ke[A[0]], kc[A[0]]))
+            continue
+        # push in reverse, so that sub-clusters are handled (and output) in order
+        for c in reversed(A):
+            if len(c) > 1:
+                stack.append((ks[c], ke[c], kc[c]))
+    return out
 
 def cluster_intervals(E):
     ''' Clusters intervals together. '''
     E.sort()
-    current = E[0]
-    Eclusters, cluster = [], []
-
-    i = 0
-    while i < len(E):
-
-        if overlaps(E[i], current):
-            cluster.append(E[i])
-        else:
-            Eclusters.append(cluster)
-            cluster = [E[i]]
-        current = (E[i][0], max([current[1], E[i][1]]))
-        i += 1
-
-    if len(cluster) > 0:
-        
-        Eclusters.append(cluster)
-
-    
+    starts = np.array([e[0] for e in E], dtype=np.int64)
+    ends = np.array([e[1] for e in E], dtype=np.int64)
+    bounds = cluster_bounds(starts, ends)
+    Eclusters = [E[bounds[i]:bounds[i+1]] for i in range(len(bounds) - 1)]
     return Eclusters, E
 
 def overlaps(A,B):
@@ -381,111 +647,26 @@ def overlaps(A,B):
     else: return True
 
 def refine_linked(clusters):
-
-    unassigned = [x for x in clusters[1:]]
-    current = [clusters[0]]
-    splicesites = set([current[0][0][0],current[0][0][1]])
-    newClusters = []
-    while len(unassigned) > 0:
-        finished = False
-    
-        while not finished:
-            finished = True
-            torm = []
-            for intron in unassigned:
-                inter, count = intron
-                start, end = inter
-                if start in splicesites or end in splicesites:
-                    current.append(intron)
-                    splicesites.add(start)
-                    splicesites.add(end)
-                    finished = False
-                    torm.append(intron)
-            for intron in torm:
-                unassigned.remove(intron)
-        newClusters.append(current)
-        current = []
-        if len(unassigned) > 0:
-            current = [unassigned[0]]
-            splicesites = set([current[0][0][0],current[0][0][1]])
-            unassigned = unassigned[1:]
-    return newClusters
+    starts = np.array([x[0][0] for x in clusters], dtype=np.int64)
+    ends = np.array([x[0][1] for x in clusters], dtype=np.int64)
+    groups = link_groups(starts, ends)
+    # the original loop never stored a last group that consisted of a single intron
+    if len(groups) > 0 and len(groups[-1]) == 1:
+        groups = groups[:-1]
+    return [[clusters[i] for i in g.tolist()] for g in groups]
 
 
 def refine_cluster(clu, cutoff, readcutoff):
     ''' for each exon in the cluster compute the ratio of reads, if smaller than cutoff,
     remove and recluster '''
-    
-    remove = []
-    dic = {}
-    intervals = []
-
-    reCLU = False
-    totN = 0
-
-    for inter, count in clu:
-        totN += count
-    for inter, count in clu:
-        if (count/float(totN) >= cutoff and count >= readcutoff):
-            intervals.append(inter)
-            dic[inter] = count
-        else:
-            reCLU = True
-    if len(intervals) == 0: return []
-    
-    # This makes sure that after trimming, the clusters are still good
-    Atmp, B = cluster_intervals(intervals)
-    A = []
-    for cl in Atmp:
-        for c in refine_linked([(x,0) for x in cl]):
-            if len(c) > 0:
-                A.append([x[0] for x in c])
-    
-    if len(A) == 1:
-        rc = [(x, dic[x]) for x in A[0]]
-        if len(rc) > 1:
-            if reCLU:
-                return refine_cluster([(x, dic[x]) for x in A[0]], cutoff, readcutoff)
-            else:
-                return [[(x, dic[x]) for x in A[0]]]
-        else:
-            return []
-    NCs = []
-    for c in A:
-        if len(c) > 1:
-            NC = refine_cluster([(x, dic[x]) for x in c], cutoff, readcutoff)
-            NCs += NC
-    
-    return NCs
-
-
-def get_numers(options):
-    outPrefix = options.outprefix
-    rundir = options.rundir
-
-    if not options.const:                                                                                                                                                                                                                                                                                                                           
-        fname = "%s/%s_perind.counts.gz"%(rundir,outPrefix)                                                                                                                                                                                                                                                                                        
-        fnameout = "%s/%s_perind_numers.counts.gz"%(rundir,outPrefix)
-    else:
-        fname = "%s/%s_perind.constcounts.gz"%(rundir,outPrefix)
-        fnameout = "%s/%s_perind_numers.constcounts.gz"%(rundir,outPrefix)
-    
-    input_file=getrfh(fname)
-    fout = getwfh(fnameout)
-    first_line=True
-    
-    for l in input_file:
-        if first_line:
-            fout.write(" ".join(l.strip().split(" ")[1:])+'\n') # print the sample names
-            first_line=False
-        else:
-            l=l.strip()
-            words=l.split(" ")
-            
-            fout.write(words[0]+ " "+ " ".join( [ g.split("/")[0] for g in words[1:] ] ) +'\n')
+    starts = np.array([x[0][0] for x in clu], dtype=np.int64)
+    ends = np.array([x[0][1] for x in clu], dtype=np.int64)
+    counts = np.array([x[1] for x in clu], dtype=np.int64)
+    out = []
+    for cs, ce, cc in refine_cluster_arrays(starts, ends, counts, cutoff, readcutoff):
+        out.append([((a, b), c) for a, b, c in zip(cs.tolist(), ce.tolist(), cc.tolist())])
+    return out
 
-    input_file.close()
-    fout.close()
 
 if __name__ == "__main__":
 
@@ -529,6 +710,9 @@ if __name__ == "__main__":
 
     parser.add_option("-s", "--strand", dest="strand", default = True,
                       help="use strand info (default=True)")
+
+    parser.add_option("-t", "--nrprocs", dest="nrprocs", default = 1,
+                      help="number of processes used to parse junction files when pooling and to merge the sorted libraries (default 1)")
     
     (options, args) = parser.parse_args()
 
@@ -9,8 +9,9 @@ path = str(Path(__file__).parent.parent.parent.parent.absolute().__str__() + "/l
 print("library path: " + path)
 sys.path.insert(0, path)
 
-from parsers.GTFAnnotation import GTFAnnotation
+from parsers.GTFAnnotationStore import GTFAnnotationStore
 from features.splicefeature2 import SpliceFeature
+from annotation.junctionannotator import JunctionAnnotator
 
 maxdist = 10000
 
@@ -28,11 +29,14 @@ class bcolors:
 
 
 if len(sys.argv) < 4:
-    print("Usage: gtf[.gz] splicefile outfile")
+    print("Usage: gtf[.gz] splicefile outfile [nrprocs: default=1]")
     sys.exit()
 gtffile = sys.argv[1]
 splicefile = sys.argv[2]
 outfile = sys.argv[3]
+nrprocs = 1
+if len(sys.argv) > 4:
+    nrprocs = int(sys.argv[4])
 
 
 # gtffile = "/groups/umcg-biogen/tmp02/annotation/Gencode/v32-b38/gencode.v32.annotation.gtf.gz"
@@ -81,7 +85,7 @@ for line in fh:
 print("{} lines parsed, {} loaded, {} clusters".format(lctr, len(junctions), len(clusters)), end='\n')
 fh.close()
 
-annotation = GTFAnnotation(gtffile)
+annotation = GTFAnnotationStore(gtffile)
 # genesByChr = annotation.getGenesByChromosome()
 
 # annotate genes within each cluster
@@ -94,126 +98,30 @@ fho4.write("Platform\tFeatureId\tFeatureChr\tFeatureChrStart\tGene\tGeneSymbol\t
 jctr = 0
 
 wiggle = 1000000 # look for genes within 1mb of the junction
-outputStrFull = ["-"]*18
-outputStrNearestGene = [""]*12
-nrJunctionsOverlapGenes = 0
-nrJunctionsOverlapExons = 0
-nrJunctionsOverlapTranscripts = 0
-for junction in junctions:
-    #genes = genesByChr.get(junction.chr)
-    genes = annotation.getOverlappingGenes(junction, wiggle)
-    nearestGene = None
-    nearestGeneDist = 1e10
-    overlapsExon = False
-    overlapsGene = False
-    overlapsTranscript = False
-    if genes is not None:
-        for gene in genes:
-            dist = gene.absoluteMinimalDistance(junction)
-            if gene.overlaps(junction):
-                geneCoords = gene.coordToStr()
-                
-                outputStrFull[0] = "LeafCutter"
-                outputStrFull[1] = junction.name
-                outputStrFull[2] = str(junction.chr.getNumber())
-                outputStrFull[3] = str(junction.start)
-                outputStrFull[4] = str(junction.stop)
-                outputStrFull[5] = gene.name
-                outputStrFull[6] = gene.symbol
-                outputStrFull[7] = geneCoords
-                outputStrFull[8] = gene.strand.toStr()
-                outputStrFull[9] = gene.type
-                outputStrFull[10] = str(dist)
-                transcripts = gene.transcripts
-                overlapsGene = True
-                fho4.write("\t".join(outputStrFull)+"\n")
-                for transcript in transcripts:
-                    toverlap = transcript.overlaps(junction)
-                    if toverlap:
-                        tdist = transcript.absoluteMinimalDistance(junction)
-                        tcoords = transcript.coordToStr()
-
-                        outputStrFull[11] = transcript.name
-                        outputStrFull[12] = tcoords
-                        outputStrFull[13] = str(tdist)
-                        outputStrFull[14] = "-"
-                        outputStrFull[15] = "-"
-                        outputStrFull[16] = "-"
-                        outputStrFull[17] = "-"
-                        fho4.write("\t".join(outputStrFull)+"\n")
-                        exons = transcript.exons
-                        overlapsTranscript = True
-                        for exon in exons:
-                            eoverlap = exon.overlaps(junction)
-                            if eoverlap:
-                                overlapsExon = True
-                                ecoords = exon.coordToStr()
-                                edist = exon.absoluteMinimalDistance(junction)
-                                rank = transcript.getExonRank(exon)
-                                if rank is None:
-                                    rank = "-"
-                                outputStrFull[14] = exon.name
-                                outputStrFull[15] = str(rank)
-                                outputStrFull[16] = ecoords
-                                outputStrFull[17] = str(edist)
-                                fho4.write("\t".join(outputStrFull)+"\n")
 
-            if nearestGene is None:
-                nearestGene = gene
-                nearestGeneDist = dist
-                # print("new nearest gene: {}\t{}\t{}".format(junction.name,gene.name,dist))
-            else:
-                if dist < nearestGeneDist:
-                    nearestGeneDist = dist
-                    nearestGene = gene
-                    # print("new nearest gene: {}\t{}\t{}".format(junction.name,gene.name,dist))
-        gene = nearestGene
-    if nearestGene is not None:
-        nearestGeneCoords = nearestGene.coordToStr()
-        
-        
-        outputStrNearestGene[0] = "LeafCutterNearestGene"
-        outputStrNearestGene[1] = junction.name
-        outputStrNearestGene[2] = str(junction.chr.getNumber())
-        outputStrNearestGene[3] = str(junction.start)
-        outputStrNearestGene[4] = str(junction.stop)
-        outputStrNearestGene[5] = nearestGene.name
-        outputStrNearestGene[6] = gene.symbol
-        outputStrNearestGene[7] = nearestGeneCoords
-        outputStrNearestGene[8] = nearestGene.strand.toStr()
-        outputStrNearestGene[9] = nearestGene.type
-        outputStrNearestGene[10] = str(nearestGeneDist)
-        outputStrNearestGene[11] = str(nearestGene.overlaps(junction))
-        fho.write("\t".join(outputStrNearestGene)+"\n")
-   
+annotator = JunctionAnnotator(annotation, gtffile, wiggle, nrprocs)
+fullLines, nearestLines, overlapsGene, overlapsTranscript, overlapsExon = annotator.annotate(
+    [junction.name for junction in junctions],
+    [junction.chrCode for junction in junctions],
+    [junction.start for junction in junctions],
+    [junction.stop for junction in junctions])
+
+for jidx, junction in enumerate(junctions):
+    fho4.write(fullLines[jidx])
+    if nearestLines[jidx] is not None:
+        fho.write(nearestLines[jidx])
     else:
         print(bcolors.FAIL + "No gene for " + junction.name + " - " + str(junction.chr.getNumber()) + bcolors.ENDC)
-        outputStrNearestGene[0] = "LeafCutterNearestGene"
-        outputStrNearestGene[1] = "-"
-        outputStrNearestGene[2] = str(junction.chr.getNumber())
-        outputStrNearestGene[3] = str(junction.start)
-        outputStrNearestGene[4] = str(junction.stop)
-        outputStrNearestGene[5] = "-"
-        outputStrNearestGene[6] = "-"
-        outputStrNearestGene[7] = "-"
-        outputStrNearestGene[8] = "-"
-        outputStrNearestGene[9] = "-"
-        outputStrNearestGene[10] = "False"
-        fho.write("\t".join(outputStrNearestGene)+"\n")
-   
+        fho.write(f"LeafCutterNearestGene\t-\t{junction.chrCode}\t{junction.start}\t{junction.stop}\t-\t-\t-\t-\t-\tFalse\tFalse\n")
+
     fho2.write(junction.name + "\t" + junction.clusterId + "\n")
     fho3.write(junction.name + "\n")
     jctr += 1
-
-    if overlapsGene:
-        nrJunctionsOverlapGenes+=1
-    if overlapsTranscript:
-        nrJunctionsOverlapTranscripts+=1
-    if overlapsExon:
-        nrJunctionsOverlapExons += 1
-    if jctr % 1000 == 0:
-        print(f"{jctr} / {len(junctions)} junctions written, overlap: {nrJunctionsOverlapGenes} gene {nrJunctionsOverlapTranscripts} transcript {nrJunctionsOverlapExons} exon", end='\r')
-        # break
+    if jctr % 100000 == 0:
+        print(f"{jctr} / {len(junctions)} junctions written", end='\r')
+nrJunctionsOverlapGenes = int(overlapsGene.sum())
+nrJunctionsOverlapTranscripts = int(overlapsTranscript.sum())
+nrJunctionsOverlapExons = int(overlapsExon.sum())
 print(f"{jctr} / {len(junctions)} junctions written, overlap: {nrJunctionsOverlapGenes} gene {nrJunctionsOverlapTranscripts} transcript {nrJunctionsOverlapExons} exon", end='\n')
 fho4.close()
 fho3.close()
@@ -7,7 +7,7 @@ print("library path: " + path)
 sys.path.insert(0, path)
 
 from features.splicefeature2 import SpliceFeature
-from intervaltree import Interval, IntervalTree
+from intervalindex import IntervalIndex
 
 if len(sys.argv) < 4:
     print("Usage: junctions1file junctions2file outputfile")
@@ -57,45 +57,31 @@ def getJunctions(file):
     print(f"{len(junctions)} junctions loaded")
     return junctions
 
-def toIntervalTree(junctions):
-    print(f"Parsing {len(junctions)} junctions into intervaltree")
-    intervalTreeByChr = {}
-    chrs = set()
-    for junction in junctions:
-        tree = intervalTreeByChr.get(junction.chr)
-        if tree is None:
-            tree = IntervalTree()
-        tree[junction.start:junction.stop] = junction
-        chrs.add(junction.chr)
-        intervalTreeByChr[junction.chr] = tree
-    
+def toIntervalIndex(junctions):
+    print(f"Indexing {len(junctions)} junctions")
+    index = IntervalIndex([junction.chr.getNumber() for junction in junctions],
+                          [junction.start for junction in junctions],
+                          [junction.stop for junction in junctions])
+
     print("Loaded junctions per chromosome:")
-    for chr in chrs:
-        arr = intervalTreeByChr.get(chr)
-        print(f"{chr}\t{len(arr)}")
-    return intervalTreeByChr
-
-def getOverlappingJunctions(feature, wiggle, tree):
-    if tree is None:
-        return None
-    start = feature.start - wiggle
-    if start < 0:
-        start = 0
-    stop = feature.stop + wiggle    
-    intervals = tree[start:stop]
-    junctions = []
-    for interval in intervals:
-        junctions.append(interval.data)
-    return junctions
+    for chr in index.chromosomes():
+        print(f"{chr}\t{index.nrIntervals(chr)}")
+    return index
 
 
 
 junctions1 = getJunctions(infile1)
 junctions2 = getJunctions(infile2)
-treesByChr = toIntervalTree(junctions2)
+index2 = toIntervalIndex(junctions2)
 
 wiggle = 25 # 10 basepairs wiggle
 
+# overlapping junctions2 for all junctions1 in one query
+overlapOffsets, overlapIdx = index2.query([junction.chr.getNumber() for junction in junctions1],
+                                          [junction.start for junction in junctions1],
+                                          [junction.stop for junction in junctions1],
+                                          wiggle)
+
 nrWithOverlap = 0
 nrWithtoutOverlap = 0
 nrWithSingleOverlap = 0
@@ -104,16 +90,15 @@ nrTotal = 0
 exactmatch = 0
 fho = getfh(outfile,'w')
 fho.write("Junction1\tBestMatch\tBestMatchSumDistance\tBestMatchStartDistance\tBestMatchStopDistance\tNrOptions\tOtherOptions(sumDistance)\n")
-for junction1 in junctions1:
+for j1idx, junction1 in enumerate(junctions1):
     chr = junction1.chr
-    tree = treesByChr.get(chr)
     bestMatch = None
     bestMatchdSum = 100000000000
 
-    if tree is not None: 
+    if index2.nrIntervals(chr.getNumber()) > 0:
         allOptions = []
         junctionToDist = {}
-        overlap = getOverlappingJunctions(junction1, wiggle, tree)
+        overlap = [junctions2[i] for i in overlapIdx[overlapOffsets[j1idx]:overlapOffsets[j1idx + 1]]]
         if len(overlap) == 0:
             nrWithtoutOverlap += 1
         else:
@@ -10,7 +10,13 @@ import seaborn as sns
 import matplotlib
 import matplotlib.pyplot as plt
 
-from sklearn.decomposition import PCA
+from pathlib import Path
+
+path = str(Path(__file__).parent.parent.parent.parent.absolute().__str__() + "/library/")
+sys.path.insert(0, path)
+from decomposition import PCA
+from correlation import pairwiseCorrelation
+from concurrent.futures import ProcessPoolExecutor
 
 import statsmodels.api as sm
 from statsmodels.tools.sm_exceptions import PerfectSeparationError
@@ -23,7 +29,7 @@ matplotlib.use('Agg')
 
 if len(sys.argv) < 5:
 	print("Indir should have gzipped leafcutter clustering output files.")
-	print("Usage: indir datasetlist.txt mergeQQ[true/false] outputprefix")
+	print("Usage: indir datasetlist.txt mergeQQ[true/false] outputprefix [nrthreads: default=1]")
 	sys.exit()
 
 
@@ -44,6 +50,9 @@ else:
 
 
 outputprefix = sys.argv[4]
+nrthreads = 1
+if len(sys.argv) > 5:
+	nrthreads = int(sys.argv[5])
 
 
 print("Merge splicing files over datasets.")
@@ -51,6 +60,7 @@ print(f"indir: {indir}")
 print(f"datasetlist: {datasetlist}")
 print(f"mergeqq: {mergeqq}")
 print(f"outputprefix: {outputprefix}")
+print(f"nrthreads: {nrthreads}")
 
 
 datasets = []
@@ -67,102 +77,89 @@ def getfh(file):
         return gzip.open(file, 'rt')
     return open(file)
 
-def var(vals, mean):
-	variance = 0.0
-	for v in vals:
-		variance += (v - mean) * (v-mean)
-	variance /= (len(vals)-1)
-	return variance
-
-def ztransformvals(vals):
-	tmp = []
-	mean = 0
-	for v in vals:
-		f = float(v)
-		mean += f
-		tmp.append(f)
-	mean /= len(vals)
-	variance = var(tmp, mean)
-	stdev = math.sqrt(variance)
-	for i in range(0,len(vals)):
-		v = (tmp[i] - mean)/stdev
-		vals[i] = str(v)
-	return vals
-
-# concatenate and z-transform
-#for dataset in datasets:
-def concatenateAndZtransformDataset(indir, tmpoutfile, dataset):
+def phenotypeFile(indir, dataset, chr):
+	file = indir+"/"+dataset+"/"+dataset+".phen_chr"+str(chr)
+	if not os.path.exists(file):
+		file = indir+"/"+dataset+"/"+dataset+".phen_chr"+str(chr)+".gz"
+	if mergeqq:
+		file = indir+'/'+dataset+"/"+dataset+".qqnorm_chr"+str(chr)
+		if not os.path.exists(file):
+			file = indir+'/'+dataset+"/"+dataset+".qqnorm_chr"+str(chr)+".gz"
+	if not os.path.exists(file):
+		print("Could not find file (or non-gzipped version of): "+file+" for dataset "+dataset)
+		sys.exit(-1)
+	return file
+
+# z-transform each row of a block of values: (v - mean) / sd, with the sample variance (n - 1)
+def ztransformBlock(vals):
+	mean = vals.mean(axis=1, keepdims=True)
+	stdev = np.sqrt(((vals - mean) ** 2).sum(axis=1, keepdims=True) / (vals.shape[1] - 1))
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return (vals - mean) / stdev
+
+# concatenate the chromosomes of a dataset and z-transform each splice event. Returns the event ids,
+# the chromosome of each event, the samples, the z-scores (events x samples, float32) and the values
+# of each event as they were in the file (tab separated text), for the merge over datasets.
+def concatenateAndZtransformDataset(indir, dataset, blocksize=1000):
 	print("Concatenating and Z-transforming dataset: "+indir+"/"+dataset)
-	fho = gzip.open(tmpoutfile,'wt')
 	print(f"mergeqq: {mergeqq}")
+	ids = []
+	chrs = []
+	blocks = []
+	raw = []
+	samples = None
 	for chr in range(1,23):
-		file = indir+"/"+dataset+"/"+dataset+".phen_chr"+str(chr)
-		
-		if not os.path.exists(file):
-			file = indir+"/"+dataset+"/"+dataset+".phen_chr"+str(chr)+".gz"
-		if mergeqq:
-			file = indir+'/'+dataset+"/"+dataset+".qqnorm_chr"+str(chr)
-			if not os.path.exists(file):
-				file = indir+'/'+dataset+"/"+dataset+".qqnorm_chr"+str(chr)+".gz"
-		if not os.path.exists(file):
-			print("Could not find file (or non-gzipped version of): "+file+" for dataset "+dataset)
-			sys.exit(-1)
+		file = phenotypeFile(indir, dataset, chr)
 		print(file)
 		fh = getfh(file)
 		if chr == 1:
 			header = fh.readline().strip().split()
-			header = "\t".join(header[4:len(header)])
-			fho.write("SpliceEvent\t"+header+"\n")
+			samples = header[4:len(header)]
 		else:
 			fh.readline()
 		lctr = 0
+		rows = []
 		for line in fh:
 			elems = line.strip().split()
-			id = elems[3]
-			vals = elems[4:len(elems)]
-			vals = ztransformvals(vals)
-			fho.write(id+"\t"+"\t".join(vals)+"\n")
+			ids.append(elems[3])
+			rows.append(elems[4:len(elems)])
+			raw.append("\t".join(elems[4:len(elems)]))
+			if len(rows) == blocksize:
+				blocks.append(ztransformBlock(np.array(rows, dtype=np.float64)).astype(np.float32))
+				rows = []
 			lctr += 1
 			if lctr % 1000 == 0:
 				print(f"{lctr} lines parsed",end='\r')
+		if len(rows) > 0:
+			blocks.append(ztransformBlock(np.array(rows, dtype=np.float64)).astype(np.float32))
+		fh.close()
+		chrs.extend([chr] * lctr)
 		print(f"{lctr} lines parsed",end='\n')
-	fho.close()
-	return tmpoutfile
-
-# 
-def pca(file, nrcomponents, outprefix):
+	if len(blocks) > 0:
+		values = np.concatenate(blocks)
+	else:
+		values = np.zeros((0, len(samples)), dtype=np.float32)
+	return ids, np.array(chrs), samples, values, raw
+
+# PCA over the sample correlation matrix (pairwise complete, undefined correlations set to 0);
+# writes the components to outprefix_PCs.txt and returns them as a samples x components array
+def pca(values, samples, nrcomponents, outprefix):
 	print("PCA")
-	print("parsing "+file)
-	df = pd.read_csv(file, sep='\t',index_col=0)
-	print("Read matrix: {} x {}".format(df.shape[0], df.shape[1]))
-	print(df)
-	#df.set_index('-')
+	print("Matrix: {} x {}".format(values.shape[0], values.shape[1]))
 	print("Correlating..")
-	cormat = df.corr()
-	cormat = cormat.fillna(0)
-
-	print(cormat)
+	cormat = pairwiseCorrelation(values, undefined=0.0)
 
 	print("Performing decomposition.")
-	pca = PCA(n_components=nrcomponents)
+	pca = PCA(n_components=nrcomponents, dtype=np.float32)
 	pca.fit(cormat)
 	components = pca.components_
-	explVar = pca.explained_variance_ratio_
-	#			print(explVar)
-	pcadf = pd.DataFrame(components)
-	pcadf.columns = cormat.columns
-	#			pcadf.index.name = 'Component'
-	pcadf = pcadf.transpose()
+	pcadf = pd.DataFrame(components.T, index=samples)
 	colnames = []
 	for comp in range(1,nrcomponents+1):
 		colnames.append("PC"+str(comp))
 	pcadf.columns = colnames
-	#			print(pcadf)
-
-	#pcadfmelt = pcadf.melt()
-	#			print(pcadfmelt)
 	pcadf.to_csv(outprefix+"_PCs.txt", sep='\t')
-	return outprefix+"_PCs.txt"
+	return components.T
 	# fig, ax = plt.subplots()
 	# sns.scatterplot(data=pcadf, x="PC1", y="PC2")
 	# fig.savefig(outprefix+"_PC1and2.png")
@@ -209,217 +206,124 @@ def pca(file, nrcomponents, outprefix):
 #         i = i + 1
 #     return tmp
 
-def regressPCs(spliceFile, pcaFile, nPCs, outfileResiduals):
-	print("Regressing PCs...: "+spliceFile)
-	dfSplice = pd.read_csv(spliceFile, sep='\t', index_col=0)
-	dfSplice = dfSplice.transpose() # ??
-	dfSplice.index.name = 'Sample'
-	print("splice size:", dfSplice.shape[0])
-
-	# Load pca matrix, samples on rows, nPCs on cols
-	useCols = [i for i in range(nPCs + 1)]
-	dfPCA = pd.read_csv(pcaFile, sep='\t', index_col=0, usecols=useCols)
-	print("pca size:", dfPCA.shape[0])
-	dfPCA.index.name = 'Sample'
-	dfPCA = dfPCA.reindex(dfSplice.index)
-	dfCov = dfPCA
-
-	sampleMap = {}
-	sampleList = []
-	sampleCount = 0
-	for sample in dfSplice.index:
-		sampleMap[sample] = sampleCount
-		sampleList.append(sample)
-		sampleCount = sampleCount + 1
-
-	# iterate splice events
+# OLS residuals of each splice event (row of values) on the PCs plus a constant, using the samples
+# without missing values (as statsmodels OLS, via the pseudo-inverse). Events without missing values
+# share one pseudo-inverse. Returns float64 residuals (NaN for missing samples) and whether a
+# residual could be computed for each event.
+def regressPCs(values, pcs):
+	print("Regressing PCs...")
+	nevents, nsamples = values.shape
+	X = np.column_stack([np.ones(nsamples), pcs.astype(np.float64)])
+	present = ~np.isnan(values)
+	complete = present.all(axis=1)
+	written = np.zeros(nevents, dtype=bool)
+	residuals = np.full((nevents, nsamples), np.nan)
+
 	fCount = 0
 	lCount = 0
 	eCount = 0
 	wCount = 0
-
-	outfhResiduals = gzip.open(outfileResiduals, 'wt')
-	outfhResiduals.write("-\t" + "\t".join(sampleList) + "\n")
-	for event in dfSplice:
-		psi = dfSplice[[event]]
-		nonna = psi.dropna(how='any')
-		if nonna.empty:
-			continue
-		shape = nonna.shape
-		outputResiduals = [np.nan] * len(psi)
-
-		logitY = nonna[event]
-		logitY = np.array(logitY)
-		covars = dfCov.reindex(nonna.index)
-		# covars = checkColinearity(covars)
-		X = covars.to_numpy()
-		X = sm.add_constant(X)
-
+	sel = np.flatnonzero(complete)
+	if len(sel) > 0:
+		Y = values[sel].astype(np.float64)
+		residuals[sel] = Y - (Y @ np.linalg.pinv(X).T) @ X.T
+		written[sel] = True
+		wCount += len(sel)
+		eCount += len(sel)
+	for e in np.flatnonzero(~complete & present.any(axis=1)).tolist():
+		mask = present[e]
+		y = values[e, mask].astype(np.float64)
+		Xe = X[mask]
 		try:
-			ols = sm.OLS(logitY, X)
-			olsResults = ols.fit(disp=0)
-			residuals = olsResults.resid
-			idx = nonna.index
-			for i in range(0, len(residuals)):
-				actidx = sampleMap.get(idx[i])
-				outputResiduals[actidx] = residuals[i]
-			strout = "\t".join(str(v) for v in outputResiduals)
-			outln = event + "\t"+strout+"\n"
-			outfhResiduals.write(outln)
+			residuals[e, mask] = y - Xe @ (np.linalg.pinv(Xe) @ y)
+			written[e] = True
 			wCount = wCount + 1
-		except PerfectSeparationError:
-			fCount = fCount + 1
 		except LinAlgError:
 			lCount = lCount + 1
-
 		eCount = eCount + 1
 		if eCount % 50 == 0:
-			print("{} lines processed, {} failed, {} linalg errors, {} written".format(eCount, fCount, lCount, wCount))
+			print("{} lines processed, {} failed, {} linalg errors, {} written".format(eCount, fCount, lCount, wCount), end='\r')
+	print("{} lines processed, {} failed, {} linalg errors, {} written".format(eCount, fCount, lCount, wCount))
+	return residuals, written
+
+def writeMatrix(file, header, ids, values, rows, blocksize=1000):
+	fho = gzip.open(file, 'wt')
+	fho.write(header)
+	for b in range(0, len(rows), blocksize):
+		block = rows[b:b + blocksize]
+		strs = values[block].astype(str)
+		fho.write("".join(ids[i] + "\t" + "\t".join(line) + "\n" for i, line in zip(block.tolist(), strs.tolist())))
+	fho.close()
 
-	outfhResiduals.close()
-	print("Done")
+# z-transform -> PCA -> regress chain for one dataset, on the in-memory z-scores; the z-scores, PCs and
+# residuals (also split per chromosome) are written at the end. Returns the event ids, chromosomes,
+# samples and original values, which are merged over datasets without reading the files again.
+def processDataset(dataset, nrcomponents=15):
+	ids, chrs, samples, values, raw = concatenateAndZtransformDataset(indir, dataset)
+	pcaoutput = outputprefix+"/"+dataset+".phen.pca"
+	pcs = pca(values, samples, nrcomponents, pcaoutput)
+	residuals, written = regressPCs(values, pcs)
 
-def mergeAllDatasetsPerChromosome():
+	ztransformedoutput = outputprefix+"/"+dataset+".phen.ztransform.gz"
+	writeMatrix(ztransformedoutput, "SpliceEvent\t" + "\t".join(samples) + "\n", ids, values, np.arange(len(ids)))
+	residualoutput = outputprefix+"/"+dataset+".phen.pca."+str(nrcomponents)+"PCsRemoved.txt.gz"
+	header = "-\t" + "\t".join(samples) + "\n"
+	writeMatrix(residualoutput, header, ids, residuals, np.flatnonzero(written))
+	# split back into one file per chromosome
+	splitoutputprefix = outputprefix+"/"+dataset+".phen.pca."+str(nrcomponents)+"PCsRemoved-chrCHR.txt.gz"
+	for chr in range(1,23):
+		writeMatrix(splitoutputprefix.replace("CHR",str(chr)), header, ids, residuals, np.flatnonzero(written & (chrs == chr)))
+	return dataset, ids, chrs, samples, raw
+
+# merges the original values of the datasets per chromosome (samples of all datasets as columns, nan
+# for events that are not in a dataset) into one file per chromosome and one file with all chromosomes.
+# results: per dataset (ids, chrs, samples, values as text), as returned by processDataset
+def mergeAllDatasets(results):
+	qqstr = "qqnorm" if mergeqq else "noqqnorm"
+	alloutfile = f"{outputprefix}-{qqstr}.txt.gz"
+	allsamples = []
+	for dataset in datasets:
+		allsamples.extend(results[dataset][2])
+	header = "id\t" + "\t".join(allsamples) + "\n"
+	missing = {dataset: "\t".join(["nan"] * len(results[dataset][2])) for dataset in datasets}
+	print(f"concatenating into: {alloutfile}")
+	fhoall = gzip.open(alloutfile,'wt')
+	fhoall.write(header)
 	for chr in range(1,23):
 		print(f"{chr}")
 		alldata = {}
-		allids = set()
-		allsamples = []
-		nsamples = {}
-		
+		allids = {}
 		for dataset in datasets:
-			file = indir+"/"+dataset+"/"+dataset+".phen_chr"+str(chr)
-			if not os.path.exists(file):
-				file = indir+"/"+dataset+"/"+dataset+".phen_chr"+str(chr)+".gz"
-			
-			if mergeqq:
-				file = indir+'/'+dataset+"/"+dataset+".qqnorm_chr"+str(chr)
-				if not os.path.exists(file):
-					file = indir+'/'+dataset+"/"+dataset+".qqnorm_chr"+str(chr)+".gz"
-			
-			if not os.path.exists(file):
-				print("Could not find file (or non-gzipped version of): "+file+" for dataset "+dataset)
-				sys.exit(-1)
-
-			print(file)
-			fh = getfh(file)
-			header = fh.readline().strip().split()
-			dsnsamples = 0
-
-			for i in range(4,len(header)):
-				sample = header[i]
-				allsamples.append(sample)
-				dsnsamples += 1
+			ids, chrs, samples, raw = results[dataset]
 			data = {}
-			lctr = 0
-			for line in fh:
-				elems = line.strip().split()
-				id = elems[3]
-				allids.add(id)
-				vals = elems[4:len(elems)]
-				# if ztransform:
-				# 	ztransformvals(vals)
-				data[id] = vals
-				lctr += 1
-				if lctr % 1000 == 0:
-					print(f"{lctr} lines",end='\r')
-			print(f"{lctr} lines",end='\n')
+			for i in np.flatnonzero(chrs == chr).tolist():
+				data[ids[i]] = raw[i]
+				allids[ids[i]] = None
 			alldata[dataset] = data
-			nsamples[dataset] = dsnsamples
-			print(f"{len(alldata[dataset])} lines -- {dsnsamples} samples")
-			fh.close()
+			print(f"{dataset}: {len(data)} lines -- {len(samples)} samples")
 		print("Merge...")
-
-		
-		tmpoutfile = f"{outputprefix}-noqqnorm-chr{chr}.txt.gz"
-		if mergeqq:
-			tmpoutfile = f"{outputprefix}-qqnorm-chr{chr}.txt.gz"
+		tmpoutfile = f"{outputprefix}-{qqstr}-chr{chr}.txt.gz"
 		fho = gzip.open(tmpoutfile,'wt')
-		header = "id"
-		sampleset = "\t".join(allsamples)
-		header = header + "\t" + sampleset
-		fho.write(header+"\n")
-		idctr = 0
+		fho.write(header)
+		lines = []
 		for id in allids:
-			outp = [np.nan] * len(allsamples)
-			sctr = 0
-			for dataset in datasets:
-				n = nsamples.get(dataset)
-				data = alldata.get(dataset)
-				vals = data.get(id)
-				if vals is None:
-					# replace outp
-					sctr += n
-				else:
-					# replace outp
-					for val in vals:
-						outp[sctr] = val
-						sctr += 1
-			outln = id +"\t" +"\t".join(str(x) for x in outp) +"\n"
-			fho.write(outln)
-			idctr += 1
-			if idctr % 1000 == 0:
-				print(f"{idctr} lines written",end='\r')
-		print(f"{idctr} lines written",end='\n')
+			lines.append(id + "\t" + "\t".join(alldata[dataset].get(id, missing[dataset]) for dataset in datasets) + "\n")
+			if len(lines) == 1000:
+				fho.write("".join(lines))
+				fhoall.write("".join(lines))
+				lines = []
+		fho.write("".join(lines))
+		fhoall.write("".join(lines))
 		fho.close()
-
-def concatenateAllMergedChromosomes():
-	tmpoutfile = f"{outputprefix}-noqqnorm.txt.gz"
-	if mergeqq:
-		tmpoutfile = f"{outputprefix}-qqnorm.txt.gz"
-	print(f"concatenating into: {tmpoutfile}")
-	fho = gzip.open(tmpoutfile,'wt')
-
-	for chr in range(1,23):
-		infile = f"{outputprefix}-noqqnorm-chr{chr}.txt.gz"
-		if mergeqq:
-			infile = f"{outputprefix}-qqnorm-chr{chr}.txt.gz"
-		print(f"Reading: {infile}" )
-		fh = getfh(infile)
-		header = fh.readline()
-		if chr == 1:
-			fho.write(header)
-		for line in fh:
-			fho.write(line)
-	fho.close()
-
-def splitByChr(inputfile, outputprefix):
-	chrwriters = []
-	fh = gzip.open(inputfile,'rt')
-	header = fh.readline()
-	for chr in range(1,23):
-		outputfile = outputprefix.replace("CHR",str(chr))
-		handle = gzip.open(outputfile,'wt')
-		handle.write(header)
-		chrwriters.append(handle)
-	
-	for line in fh:
-		elems = line.split("\t",2)
-		id = elems[1]
-		chr = int(id.split(":")) # assume ID is split by 
-		chrwriters[chr].write(line)
-
-	for chr in range(1,23):
-		chrwriters[chr].close()
-
-
-datasetstmp = []
-datasetstmp.append(datasets[0])
-datasets = datasetstmp
-
-for dataset in datasets:
-	# concatenate and z-transform
-	ztransformedoutput = outputprefix+"/"+dataset+".phen.ztransform.gz"
-	concatenateAndZtransformDataset(indir, ztransformedoutput, dataset)
-	# determine 15 PCs (in stead of PEER factors)
-	pcaoutput = outputprefix+"/"+dataset+".phen.pca"
-	pcaoutput = pca(ztransformedoutput, 15, pcaoutput)
-	# correct for components
-	residualoutput = outputprefix+"/"+dataset+".phen.pca.15PCsRemoved.txt.gz"
-	regressPCs(ztransformedoutput,pcaoutput,15,residualoutput)
-	# split back into one file per chromosome
-	splitoutputprefix = outputprefix+"/"+dataset+".phen.pca.15PCsRemoved-chrCHR.txt.gz"
-	splitByChr(residualoutput,splitoutputprefix)
-
-mergeAllDatasetsPerChromosome()
-concatenateAllMergedChromosomes()
+		print(f"{len(allids)} lines written",end='\n')
+	fhoall.close()
+
+# datasets are processed concurrently, each in a single process
+results = {}
+with ProcessPoolExecutor(max_workers=max(1, min(nrthreads, len(datasets)))) as executor:
+	for future in [executor.submit(processDataset, dataset) for dataset in datasets]:
+		dataset, ids, chrs, samples, raw = future.result()
+		results[dataset] = (ids, chrs, samples, raw)
+		print("Done: " + dataset)
+
+mergeAllDatasets(results)
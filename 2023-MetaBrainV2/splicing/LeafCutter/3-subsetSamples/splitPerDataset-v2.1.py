@@ -1,4 +1,5 @@
 import gzip
+import re
 import sys
 import os
 import numpy
@@ -36,6 +37,7 @@ parser.add_argument("--writeExtraFiles",help="Write additional output matrices (
 parser.add_argument("--removeNonStandardChr",help="Remove non-autosomal and non-X or non-Y splice events",action='store_true')
 parser.add_argument("--removeNonAutosomal",help="Remove non-autosomal splice events",action='store_true')
 parser.add_argument("--usePseudoCount",help="Use pseudocount in PSI calculation",action='store_true')
+parser.add_argument("--blockSize",help="Number of events processed at once",default=1000)
 
 args = vars(parser.parse_args())
 
@@ -60,6 +62,7 @@ writeExtraFiles = args["writeExtraFiles"]
 removeNonAutosomal = args["removeNonAutosomal"]
 removeNonStandardChr = args["removeNonStandardChr"]
 usePseudoCount = args["usePseudoCount"]
+blockSize = int(args["blockSize"])
 
 if imputeAverage and imputeAveragePerDataset:
 	print("Error: cannot average impute over all samples and per dataset at the same time!")
@@ -68,57 +71,121 @@ if imputeAverage and imputeAveragePerDataset:
 pprint(args)
 
 # main functions
-def calcPsi(num, denom):
-	# returns list: readct, psi unfiltered, psi filtered
+# Events are processed in blocks of lines: the num/denom cells of a block are parsed into float
+# matrices (rows are events, columns the included samples) and PSI values, means and variances are
+# computed on those. The values written are identical to computing them one event at a time:
+# sums are accumulated in column order (numpy.cumsum) like the original loops, and cells that the
+# original code set to an int 0 (rather than a float) are tracked so they are still written as 0.
+def readBlocks(fh, size):
+	lines = []
+	for line in fh:
+		lines.append(line)
+		if len(lines) == size:
+			yield lines
+			lines = []
+	if len(lines) > 0:
+		yield lines
+
+def keepRow(rowid):
+	spliceId = rowid.split(":")
+	chr = spliceId[0].replace("chr","").lower()
+	sexchr = False
+	autosomal = False
+	if chr == "x" or chr == "y":
+		sexchr = True
+	else:
+		try:
+			chr = int(chr)
+			if chr > 0 and chr < 23:
+				autosomal = True
+		except:
+			pass
+	if removeNonAutosomal and not autosomal:
+		return False
+	if removeNonStandardChr and not (autosomal or sexchr):
+		return False
+	return True
+
+def parseCell(elem):
+	# counts that can not be parsed are taken as 0 reads, as calcPsi did
+	num, denom = elem.split("/")
 	try:
-		num = float(num)
-		denom = float(denom)
-		psi = 0
-		if denom < 1:
-			return [denom, numpy.nan, numpy.nan]
-		elif denom < minEventCt:
-			if usePseudoCount:
-				psi = (num+0.5)/(denom+0.5)
-			else:
-				psi = num/denom
-			return [denom, psi, numpy.nan]	
-		elif num < 1:
-			return [denom, 0, 0]
-		else:
-			if usePseudoCount:
-				psi = (num+0.5)/(denom+0.5)
-			else:
-				psi = num/denom
-			return [denom, psi, psi]
+		return float(num), float(denom)
 	except:
-		return [0, numpy.nan, numpy.nan]
-
-def meanAndVar(vals):
-	sum = 0
-	ct = 0
-	for v in vals:
-		if not numpy.isnan(v):
-			sum += v
-			ct += 1
-	if ct > 1:
-		sum /= ct
-		varV = var(vals,sum)
-		return [sum, varV]
-	else:
-		return [0,0]
-
-def var(x, meanx):
-        var = 0
-        nonnan = 0
-        for v in x:
-                if not numpy.isnan(v):
-                        var +=  (v - meanx) * (v-meanx)
-                        nonnan += 1
-        if nonnan > 1:
-                var /= (nonnan-1)
-        else:
-                var = 0
-        return var
+		return 0.0, 0.0
+
+cellPattern = re.compile("([^ /]+/[^ /]+)( [^ /]+/[^ /]+)*")
+
+def parseBlock(lines):
+	# returns the row ids, included count strings and num/denom matrices of the events to process
+	rowids = []
+	cells = []
+	for line in lines:
+		elems = line.strip().split(" ")
+		rowid = elems[0] # always append first column
+		if not keepRow(rowid):
+			continue
+		rowids.append(rowid)
+		if allColumns:
+			cells.append(elems[1:])
+		else:
+			cells.append([elems[i] for i in includedColumns])
+	values = None
+	text = " ".join([" ".join(c) for c in cells])
+	if cellPattern.fullmatch(text) is not None:
+		try:
+			values = numpy.array(text.replace("/", " ").split(), dtype=numpy.float64)
+		except ValueError:
+			values = None
+	if values is None:
+		values = numpy.array([[parseCell(elem) for elem in c] for c in cells], dtype=numpy.float64)
+	values = values.reshape(len(rowids), len(includedColumns), 2)
+	return rowids, cells, values[:, :, 0], values[:, :, 1]
+
+def calcPsiBlock(num, denom):
+	# returns matrices: readct, psi unfiltered, psi unfiltered is int 0, psi filtered, psi filtered is int 0
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		if usePseudoCount:
+			psi = (num+0.5)/(denom+0.5)
+		else:
+			psi = num/denom
+	noReads = denom < 1
+	lowReads = ~noReads & (denom < minEventCt)
+	zero = ~noReads & ~lowReads & (num < 1)
+	psiUnfiltered = numpy.where(noReads, numpy.nan, numpy.where(zero, 0, psi))
+	psiFiltered = numpy.where(noReads | lowReads, numpy.nan, numpy.where(zero, 0, psi))
+	return denom, psiUnfiltered, zero.copy(), psiFiltered, zero.copy()
+
+def seqSum(values):
+	# row sums, added in column order
+	if values.shape[1] == 0:
+		return numpy.zeros(values.shape[0])
+	return numpy.cumsum(values, axis=1)[:, -1]
+
+def meanAndVarBlock(values):
+	# per row mean and variance over non-NaN values; 0 (int) with less than 2 values
+	nan = numpy.isnan(values)
+	ct = (~nan).sum(axis=1)
+	multiple = ct > 1
+	with numpy.errstate(invalid='ignore'):
+		mean = numpy.where(multiple, seqSum(numpy.where(nan, 0, values)) / numpy.maximum(ct, 1), 0)
+		dev = numpy.where(nan, 0, values - mean[:, None])
+		variance = numpy.where(multiple, seqSum(dev * dev) / numpy.maximum(ct - 1, 1), 0)
+	return mean, ~multiple, variance
+
+def setCols(matrix, cols, mask, values):
+	sub = matrix[:, cols]
+	sub[mask] = values[mask] if numpy.ndim(values) > 0 else values
+	matrix[:, cols] = sub
+
+def toPy(values, isInt):
+	return [0 if i else v for v, i in zip(values.tolist(), isInt.tolist())]
+
+def toStr(values, isInt):
+	strs = [str(v) for v in values.tolist()]
+	for i in numpy.flatnonzero(isInt).tolist():
+		strs[i] = "0"
+	return strs
 
 def f(v):
 	return str(round(v,3))
@@ -304,199 +371,120 @@ print()
 lineCtr = 0
 written = 0
 
-debug = 0
-debugQueryId = "chr21:16181687:16231056:clu_184_?"
-debugQueryId = "NeverGonnaGiveYouUp"
-
-valuesPsiFiltered = [0] * len(includedColumns)
-valuesPsiUnfiltered = [0] * len(includedColumns)
-valuesCtsStr = [0] * len(includedColumns)
-valuesCtsUnfiltered = [0] * len(includedColumns)
+datasetCols = [numpy.array(relativeColIdsForDataset.get(dataset)) for dataset in includedDatasets]
+allColumns = includedColumns == list(range(1, len(header)))
 
-for line in fh:
-	elems = line.strip().split(" ")
-	ctr = 0
-	rowid = elems[0] # always append first column
-	spliceId = rowid.split(":")
-	chr = spliceId[0].replace("chr","").lower()
-	sexchr = False
-	autosomal = False
-	if chr == "x" or chr == "y":
-		sexchr = True
-	else:
-		try:
-			chr = int(chr)
-			if chr > 0 and chr < 23:
-				autosomal = True
-		except:
-			pass
-	skip = False
-	
-	if removeNonAutosomal and not autosomal:
-		skip = True
-	if removeNonStandardChr and not (autosomal or sexchr):
-		skip = True
+for lines in readBlocks(fh, blockSize):
+	rowids, cells, num, denom = parseBlock(lines)
+	lineCtr += len(lines)
+	nrRows = len(rowids)
+	if nrRows > 0:
+		readCt, psiUnfiltered, intUnfiltered, psiFiltered, intFiltered = calcPsiBlock(num, denom)
+		overallNonNan = (~numpy.isnan(psiFiltered)).sum(axis=1)
+		ctsZero = numpy.zeros(psiFiltered.shape, dtype=bool)
 
-	if rowid == debugQueryId:
-		debug = 1
-		print()
-	
-	if not skip:
-
-		valuesPerDataset = {}
-		overallNonNan = 0
-
-		# only parse included columns 
-		colctr = 0
-		for i in includedColumns:
-			elem = elems[i]
-			valuesCtsStr[colctr] = elem
-			num, denom = elem.split("/")
-			readCt, psiUnfilter, psiFilter = calcPsi(num,denom)
-			if not numpy.isnan(psiFilter):
-				overallNonNan += 1
-			valuesPsiFiltered[colctr] = psiFilter  # PSI with minimum read ct filter applied
-			valuesCtsUnfiltered[colctr] = readCt   # Cts without minimum read ct filter applied
-			valuesPsiUnfiltered[colctr] = psiUnfilter # PSI without minimum read ct filter applied
-			colctr += 1
-			
 		# write unfiltered results
 		if writeExtraFiles:
-			fhoCtsUnfiltered.write(rowid+"\t"+"\t".join(valuesCtsStr) +"\n") # write unfiltered count input for this subset of samples
-			fhoPsiUnfiltered.write(rowid+"\t"+"\t".join( [str(x) for x in valuesPsiUnfiltered] ) +"\n") # 
+			for r in range(nrRows):
+				fhoCtsUnfiltered.write(rowids[r]+"\t"+"\t".join(cells[r]) +"\n") # write unfiltered count input for this subset of samples
+				fhoPsiUnfiltered.write(rowids[r]+"\t"+"\t".join(toStr(psiUnfiltered[r], intUnfiltered[r])) +"\n") #
 
-		# apply dataset specific filters
-		okdatasets = 0
-		logln = ""
+		# apply dataset specific filters, for all rows in the block at once
+		okdatasets = numpy.zeros(nrRows, dtype=int)
 		dsOkList = []
-		totalNonNan = 0
-		
-		for dataset in includedDatasets:
-			dsNrNonNan = 0
-			dsLowReadCt = 0
-			dsMeanPsi   = 0
-			dsMeanCt = 0
-			dsOK   = False
-			dsPsiVals = []
-			dsVariancePsi = 0
-
-			relativeColsForDs = relativeColIdsForDataset.get(dataset)
-			if relativeColsForDs is None:
-				print("ERROR: no column selection for "+dataset)
-				sys.exit(-1)
-
-			for i in relativeColsForDs:
-				v = valuesPsiFiltered[i]
-				c = valuesCtsUnfiltered[i]
-				if c < minEventCt:
-					dsLowReadCt += 1
-				dsPsiVals.append(v)
-				if not numpy.isnan(v):
-					dsMeanPsi += v
-					dsNrNonNan  += 1
-					totalNonNan += 1
-					dsMeanCt  += c
-				else:
-					valuesCtsStr[i] = "0/0"
+		dsLog = []
+		for d in range(len(includedDatasets)):
+			cols = datasetCols[d]
+			dsPsiVals = psiFiltered[:, cols]
+			dsNan = numpy.isnan(dsPsiVals)
+			dsLowReadCt = (readCt[:, cols] < minEventCt).sum(axis=1)
+			dsNrNonNan = (~dsNan).sum(axis=1)
+			ctsZero[:, cols] |= dsNan
+
 			dsNonNanThreshold = minNonNanPerDataset
 			if minNonNanPerDataset < 1:
-				dsNonNanThreshold = minNonNanPerDataset * len(dsPsiVals)
-			
-			if dsNrNonNan >= dsNonNanThreshold:
-				# dsMeanPsi = 0
-				if dsNrNonNan > 1:
-					dsMeanPsi /= dsNrNonNan
-					dsVariancePsi = var(dsPsiVals, dsMeanPsi)
-				else:
-					dsVariancePsi = 0
-
-				# ala leafcutter: impute then calculate stdev
-				if imputeAveragePerDataset:
-					dsPsiVals = []
-					for i in relativeColsForDs:
-						if numpy.isnan(valuesPsiFiltered[i]):
-							valuesPsiFiltered[i] = dsMeanPsi
-						dsPsiVals.append(valuesPsiFiltered[i])
-				if dsMeanPsi >= minAvgPsi and dsMeanPsi <= maxAvgPsi and dsVariancePsi > minStDevPsi:
-					# values for dataset pass QC
-					okdatasets += 1
-					dsOK = True
-			else:
-				dsMeanPsi = 0
-
-			if not dsOK:
+				dsNonNanThreshold = minNonNanPerDataset * len(cols)
+			above = dsNrNonNan >= dsNonNanThreshold
+
+			# the mean is only divided when there are more than 1 values, and remains an int
+			# when all values are (int) zeros and there is at most 1 value
+			dsSum = seqSum(numpy.where(dsNan, 0, dsPsiVals))
+			multiple = dsNrNonNan > 1
+			dsMeanPsi = numpy.where(multiple, dsSum / numpy.maximum(dsNrNonNan, 1), dsSum)
+			dsMeanInt = ~multiple & (intFiltered[:, cols] | dsNan).all(axis=1)
+			with numpy.errstate(invalid='ignore'):
+				dsDev = numpy.where(dsNan, 0, dsPsiVals - dsMeanPsi[:, None])
+				dsVariancePsi = numpy.where(above & multiple, seqSum(dsDev * dsDev) / numpy.maximum(dsNrNonNan - 1, 1), 0)
+			dsVarianceInt = ~(above & multiple)
+			dsMeanPsi = numpy.where(above, dsMeanPsi, 0)
+			dsMeanInt = numpy.where(above, dsMeanInt, True)
+
+			# ala leafcutter: impute then calculate stdev
+			if imputeAveragePerDataset:
+				impute = dsNan & above[:, None]
+				setCols(psiFiltered, cols, impute, numpy.broadcast_to(dsMeanPsi[:, None], impute.shape))
+				setCols(intFiltered, cols, impute, numpy.broadcast_to(dsMeanInt[:, None], impute.shape))
+
+			# values for dataset pass QC
+			dsOK = above & (dsMeanPsi >= minAvgPsi) & (dsMeanPsi <= maxAvgPsi) & (dsVariancePsi > minStDevPsi)
+			okdatasets += dsOK
+
+			if not imputeAverageMissingDatasets:
 				# wipe values for dataset to NaN, but not when we're imputing missing values in bad datasets
-				if not imputeAverageMissingDatasets:
-					for i in relativeColsForDs:
-						valuesPsiFiltered[i] = numpy.nan
-						valuesCtsStr[i] = "0/0"
-			# elif imputeAveragePerDataset: # this requires the dataset to pass QC
-			# 	for i in relativeColsForDs:
-			# 		if numpy.isnan(valuesPsiFiltered[i]):
-			# 			valuesPsiFiltered[i] = dsMeanPsi
+				wipe = numpy.broadcast_to(~dsOK[:, None], dsNan.shape)
+				setCols(psiFiltered, cols, wipe, numpy.nan)
+				setCols(intFiltered, cols, wipe, False)
+				ctsZero[:, cols] |= wipe
 			dsOkList.append(dsOK)
 			if writeExtraFiles:
-				logln += "\t"+f(dsMeanPsi)
-				logln += "\t"+f(dsVariancePsi)
-				logln += "\t"+str(len(dsPsiVals))
-				logln += "\t"+str(dsLowReadCt)
-				logln += "\t"+str(dsNrNonNan)
-				logln += "\t"+str(dsOK)
-			if debug == 1:
-				print("{}\t{}\t{}\t{}\t{}\t{}".format(dataset, dsNrNonNan,dsLowReadCt,dsMeanPsi,dsVariancePsi,dsMeanCt))
-		#	print(dataset+"\t"+str(nonNan)+"\t"+str(dsok))
-			
-		
-		#print(rowid+"\t"+str(meanPsiFiltered)+"\t"+str(totalNonNan))
-
-		#print("Preimpute: ")
-		#print(rowid+"\t"+"\t".join([str(x) for x in valuesPsiFiltered]) + "\n")
-		#print("------")
+				dsLog.append((toPy(dsMeanPsi, dsMeanInt), toPy(dsVariancePsi, dsVarianceInt), len(cols), dsLowReadCt.tolist(), dsNrNonNan.tolist(), dsOK.tolist()))
+
 		# replace missing values with overall average, only for datasets that passed QC
 		if imputeAverage:
-			meanPsiFiltered, varPsiFiltered = meanAndVar(valuesPsiFiltered)
-			for d in range(0,len(includedDatasets)):
-				if dsOkList[d] or imputeAverageMissingDatasets:
-					dataset = includedDatasets[d]
-					relativeColsForDs = relativeColIdsForDataset.get(dataset)
-					for i in relativeColsForDs:
-						if numpy.isnan(valuesPsiFiltered[i]):
-							valuesPsiFiltered[i] = meanPsiFiltered
-						#	print(rowid+"\t"+dataset+"\t"+str(valuesPsiFiltered[i]))
-
+			meanPsiFiltered, meanInt, varPsiFiltered = meanAndVarBlock(psiFiltered)
+			for d in range(len(includedDatasets)):
+				cols = datasetCols[d]
+				impute = numpy.isnan(psiFiltered[:, cols])
+				if not imputeAverageMissingDatasets:
+					impute &= dsOkList[d][:, None]
+				setCols(psiFiltered, cols, impute, numpy.broadcast_to(meanPsiFiltered[:, None], impute.shape))
+				setCols(intFiltered, cols, impute, numpy.broadcast_to(meanInt[:, None], impute.shape))
 
 		# write if result passes filters
-		eventWritten = False
-		if okdatasets >= minnrdatasets:
-			fhoPsiFiltered.write(rowid+"\t"+"\t".join([str(x) for x in valuesPsiFiltered]) + "\n")
-		#	print("Postimpute")
-		#	print("----------")
-		#	print(rowid+"\t"+"\t".join([str(x) for x in valuesPsiFiltered]) + "\n")
+		eventWritten = (okdatasets >= minnrdatasets).tolist()
+		for r in numpy.flatnonzero(eventWritten).tolist():
+			fhoPsiFiltered.write(rowids[r]+"\t"+"\t".join(toStr(psiFiltered[r], intFiltered[r])) + "\n")
 			if writeExtraFiles:
-				fhoCtsFiltered.write(rowid+"\t"+"\t".join([str(x) for x in valuesCtsStr]) + "\n")
+				fhoCtsFiltered.write(rowids[r]+"\t"+"\t".join([x if not z else "0/0" for x, z in zip(cells[r], ctsZero[r].tolist())]) + "\n")
 			written += 1
-			eventWritten = True
 
-		#sys.exit(-1)
-		if writeExtraFiles:
-			meanPsiUnfiltered, varPsiUnfiltered = meanAndVar(valuesPsiUnfiltered)
-			meanCtsUnfiltered, varCtsUnfiltered = meanAndVar(valuesCtsUnfiltered)
-			meanPsiFiltered, varPsiFiltered = meanAndVar(valuesPsiFiltered)
-			loglnStart =  rowid  +"\t"+str(eventWritten)   +"\t"+ str(okdatasets) +"\t"+ str(overallNonNan)
-			loglnStart += "\t"+f(meanPsiUnfiltered)  +"\t"+ f(varPsiUnfiltered)			
-			loglnStart += "\t"+f(meanCtsUnfiltered)  +"\t"+ f(varCtsUnfiltered)			
-			loglnStart += "\t"+f(meanPsiFiltered)    +"\t"+ f(varPsiFiltered)			
-			fhoLog.write(loglnStart+"\t"+logln+"\n")
-
-	lineCtr += 1
-
-	if lineCtr % 100 == 0:
-		perc = (written/lineCtr) * 100
-		print("{} lines parsed, {} written - {}%.".format(lineCtr, written, f(perc)), end='\r', flush=True)
 		if writeExtraFiles:
-			fhoLog.flush()		
-	if debug == 1:
-		exit()
+			meanAndVarPsiUnfiltered = meanAndVarBlock(psiUnfiltered)
+			meanAndVarCtsUnfiltered = meanAndVarBlock(readCt)
+			meanAndVarPsiFiltered = meanAndVarBlock(psiFiltered)
+			logCols = []
+			for mean, meanInt, variance in [meanAndVarPsiUnfiltered, meanAndVarCtsUnfiltered, meanAndVarPsiFiltered]:
+				logCols.append(toPy(mean, meanInt))
+				logCols.append(toPy(variance, meanInt))
+			okdatasets = okdatasets.tolist()
+			overallNonNan = overallNonNan.tolist()
+			for r in range(nrRows):
+				loglnStart =  rowids[r]  +"\t"+str(eventWritten[r])   +"\t"+ str(okdatasets[r]) +"\t"+ str(overallNonNan[r])
+				loglnStart += "\t"+"\t".join([f(c[r]) for c in logCols])
+				logln = ""
+				for dsMean, dsVar, dsN, dsLowReadCt, dsNrNonNan, dsOK in dsLog:
+					logln += "\t"+f(dsMean[r])
+					logln += "\t"+f(dsVar[r])
+					logln += "\t"+str(dsN)
+					logln += "\t"+str(dsLowReadCt[r])
+					logln += "\t"+str(dsNrNonNan[r])
+					logln += "\t"+str(dsOK[r])
+				fhoLog.write(loglnStart+"\t"+logln+"\n")
+
+	perc = (written/lineCtr) * 100
+	print("{} lines parsed, {} written - {}%.".format(lineCtr, written, f(perc)), end='\r', flush=True)
+	if writeExtraFiles:
+		fhoLog.flush()
 perc = (written/lineCtr) * 100
 print("{} lines parsed, {} written - {}%.".format(lineCtr, written, f(perc)), end='\n')
 
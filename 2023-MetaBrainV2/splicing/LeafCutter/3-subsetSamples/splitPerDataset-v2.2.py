@@ -1,4 +1,5 @@
 import gzip
+import re
 import sys
 import os
 import numpy
@@ -30,6 +31,7 @@ parser.add_argument("--removeNonStandardChr",help="Remove non-autosomal and non-
 parser.add_argument("--removeNonAutosomal",help="Remove non-autosomal splice events",action='store_true')
 parser.add_argument("--usePseudoCount",help="Use pseudocount in PSI calculation",action='store_true')
 parser.add_argument("--centerAndScale",help="Center by mean, scale by stdev",action='store_true')
+parser.add_argument("--blockSize",help="Number of events processed at once",default=1000)
 
 args = vars(parser.parse_args())
 
@@ -57,6 +59,7 @@ removeNonAutosomal = args["removeNonAutosomal"]
 removeNonStandardChr = args["removeNonStandardChr"]
 usePseudoCount = args["usePseudoCount"]
 centerAndScale = args["centerAndScale"]
+blockSize = int(args["blockSize"])
 
 # if imputeAverage and imputeAveragePerDataset:
 #     print("Error: cannot average impute over all samples and per dataset at the same time!")
@@ -65,17 +68,34 @@ centerAndScale = args["centerAndScale"]
 pprint(args)
 
 # main functions
-def calcPsi(num, denom):
-    # returns list: readct, psi unfiltered, psi filtered
-    if denom < 1 or denom < minNrOfReads:
-        return numpy.nan
-    psi = 0
-    if usePseudoCount:
-        psi = (num+0.5)/(denom+0.5)
-    else:
-        psi = (num)/(denom)
+def calcPsiBlock(num, denom):
+    # returns the psi matrix; NaN where there are too few reads
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        if usePseudoCount:
+            psi = (num+0.5)/(denom+0.5)
+        else:
+            psi = (num)/(denom)
+    psi[(denom < 1) | (denom < minNrOfReads)] = numpy.nan
     return psi
 
+def seqSum(values):
+    # row sums, added in column order like the per-value loops (numpy.sum adds pairwise, which
+    # may differ in the last bits)
+    if values.shape[1] == 0:
+        return numpy.zeros(values.shape[0])
+    return numpy.cumsum(values, axis=1)[:, -1]
+
+def meanAndVarBlock(values):
+    # meanAndVar for each row of a matrix
+    nan = numpy.isnan(values)
+    ct = (~nan).sum(axis=1)
+    multiple = ct > 1
+    with numpy.errstate(invalid='ignore'):
+        mean = numpy.where(multiple, seqSum(numpy.where(nan, 0, values)) / numpy.maximum(ct, 1), 0)
+        dev = numpy.where(nan, 0, values - mean[:, None])
+        variance = numpy.where(multiple, seqSum(dev * dev) / numpy.maximum(ct - 1, 1), 0)
+    return mean, variance
+
 def meanAndVar(vals):
     sum = 0
     ct = 0
@@ -162,69 +182,7 @@ def loadETD(etdfile):
     fh.close()
     return samplesPerDataset, sampleToDataset, selectedSamples
 
-def fill(arr, val):
-    for i in range(0,len(arr)):
-        arr[i] = val
-
-def processDataset(d, colsPerDataset, minNrObservationsPerDataset, elems):
-    cols = colsPerDataset[d]
-    dataset = availableDatasets[d]
-    dsMinNrObs = minNrObservationsPerDataset[d]
-    psivals = [numpy.nan] * len(cols)
-    fill(psivals, numpy.nan)
-
-    passqc = False
-    mean = 0
-    variance = 0
-    stdev = 0
-    nrNotMissing = 0
-    
-    
-    for i in range(0,len(cols)):
-        col = cols[i]
-        num, denom = elems[col].split("/")
-        num = float(num)
-        denom = float(denom)
-        psi = calcPsi(num, denom)
-        psivals[i] = psi
-        if not numpy.isnan(psi):
-            nrNotMissing += 1
-            mean += psi
-    if nrNotMissing > 0:
-        mean /= nrNotMissing
-    # Minimal number of non-NaN samples per dataset (if specified < 1, will be interpreted as proportion of total)
-    # leafcutter: skip if more than 40% missing, or skip if less than 60% not missing
-    # 
-    if nrNotMissing < dsMinNrObs:
-        fill(psivals, numpy.nan)
-    else:
-        if imputeAveragePerDataset and nrNotMissing < len(cols):
-            for i in range(0,len(cols)):
-                if numpy.isnan(psivals[i]):
-                    psivals[i] = mean
-        
-        mean, variance = meanAndVar(psivals)
-        #stdev = math.sqrt(variance)
-        stdev = numpy.std(psivals)
-        
-        #if mean < minAvgPsi or mean > maxAvgPsi or stdev < minStDevPsi:
-        if stdev < minStDevPsi:
-            # wipe values if not passing thresholds
-            fill(psivals, numpy.nan)
-        else:
-            passqc = True
-            if centerAndScale:
-                psivals = scaleMeanStDev(psivals,mean,stdev)
-    if debug:
-        print(f"{dataset}\t{len(psivals)}\t{nrNotMissing}\t{mean}\t{stdev}\t{passqc}")
-    psivalstr = "\t".join( str(x) for x in psivals )
-    return d, psivals, psivalstr, passqc
-
-def processLine(line, colsPerDataset, minNrObservationsPerDataset):
-    
-    elems = line.strip().split(" ")
-    ctr = 0
-    rowid = elems[0] # always append first column
+def keepRow(rowid):
     spliceId = rowid.split(":")
     chr = spliceId[0].replace("chr","").lower()
     sexchr = False
@@ -240,23 +198,81 @@ def processLine(line, colsPerDataset, minNrObservationsPerDataset):
             pass
 
     if removeNonAutosomal and not autosomal:
-        return [False, None]
+        return False
     if removeNonStandardChr and not (autosomal or sexchr):
-        return [False, None]
+        return False
+    return True
+
+cellPattern = re.compile("([^ /]+/[^ /]+)( [^ /]+/[^ /]+)*")
 
-    outln = rowid
-    nrDatasetsPassingQC = 0
-    
+def processDataset(psivals, dsMinNrObs):
+    # psivals: events x samples of one dataset; returns the processed values, which of them are an
+    # (int) 0 that is written as 0 rather than 0.0, and per event whether it passes QC
+    missing = numpy.isnan(psivals)
+    nrNotMissing = (~missing).sum(axis=1)
+    mean = seqSum(numpy.where(missing, 0, psivals)) / numpy.maximum(nrNotMissing, 1)
+    intZero = numpy.zeros(psivals.shape, dtype=bool)
+
+    # Minimal number of non-NaN samples per dataset (if specified < 1, will be interpreted as proportion of total)
+    # leafcutter: skip if more than 40% missing, or skip if less than 60% not missing
+    present = nrNotMissing >= dsMinNrObs
+    if imputeAveragePerDataset:
+        impute = missing & present[:, None]
+        psivals[impute] = numpy.broadcast_to(mean[:, None], psivals.shape)[impute]
+        intZero = impute & (nrNotMissing == 0)[:, None]
+
+    mean, variance = meanAndVarBlock(psivals)
+    #stdev = math.sqrt(variance)
+    stdev = numpy.std(psivals, axis=1)
+
+    #if mean < minAvgPsi or mean > maxAvgPsi or stdev < minStDevPsi:
+    passqc = present & ~(stdev < minStDevPsi)
+    if centerAndScale:
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            scaled = (psivals - mean[:, None]) / stdev[:, None]
+        psivals = numpy.where(passqc[:, None], scaled, psivals)
+        intZero &= ~passqc[:, None]
+    # wipe values if not passing thresholds
+    psivals[~passqc] = numpy.nan
+    intZero[~passqc] = False
+    return psivals, intZero, passqc
+
+def processBlock(lines, colsPerDataset, minNrObservationsPerDataset):
+    # processes a block of lines at once; returns the number of lines and the lines to write
+    rowids = []
+    cells = []
+    for line in lines:
+        elems = line.strip().split(" ")
+        rowid = elems[0] # always append first column
+        if keepRow(rowid):
+            rowids.append(rowid)
+            cells.append(" ".join([elems[col] for col in allColumns]))
+    if len(rowids) == 0:
+        return len(lines), []
+
+    text = " ".join(cells)
+    if cellPattern.fullmatch(text) is None:
+        raise ValueError("Malformed num/denom value in block starting with "+rowids[0])
+    values = numpy.array(text.replace("/", " ").split(), dtype=numpy.float64).reshape(len(rowids), len(allColumns), 2)
+    psi = calcPsiBlock(values[:, :, 0], values[:, :, 1])
+
+    intZero = numpy.zeros(psi.shape, dtype=bool)
+    nrDatasetsPassingQC = numpy.zeros(len(rowids), dtype=int)
+    offset = 0
     for d in range(0, len(availableDatasets)):
-        
-        d2, psivals, psivalstr, passqc = processDataset(d, colsPerDataset, minNrObservationsPerDataset, elems)
-        if passqc:
-            nrDatasetsPassingQC+=1
-        outln += "\t"+psivalstr    
+        cols = slice(offset, offset + len(colsPerDataset[d]))
+        offset += len(colsPerDataset[d])
+        psi[:, cols], intZero[:, cols], passqc = processDataset(numpy.ascontiguousarray(psi[:, cols]), minNrObservationsPerDataset[d])
+        nrDatasetsPassingQC += passqc
+
+    outlns = []
+    for r in numpy.flatnonzero(nrDatasetsPassingQC >= minnrdatasets).tolist():
+        psivalstr = [str(x) for x in psi[r].tolist()]
+        for i in numpy.flatnonzero(intZero[r]).tolist():
+            psivalstr[i] = "0"
+        outlns.append(rowids[r]+"\t"+"\t".join(psivalstr))
+    return len(lines), outlns
 
-    if nrDatasetsPassingQC < minnrdatasets:
-        return [False, None]
-    return [True, outln]
 
 cramMap = None
 if cramfile is not None:
@@ -341,34 +357,33 @@ fhoPsiFiltered.write(outHeader)
 lctr = 0
 written = 0
 
+allColumns = [col for cols in colsPerDataset for col in cols]
+
+# blocks of lines are processed on the pool; results are written in input order
 pool = ProcessPoolExecutor(max_workers=threads)
-nrJobs = 1000
-futures = [None] * nrJobs
-jobctr = 0
+futures = []
+def writeResult(future):
+    global lctr, written
+    nrLines, outlns = future.result()
+    for outln in outlns:
+        fhoPsiFiltered.write(outln+"\n")
+    written += len(outlns)
+    lctr += nrLines
+    perc = (written / lctr)*100
+    print(f"{lctr} lines parsed, {written} written, {f(perc)} %",end='\r')
+
+lines = []
 for line in fh:
-
-
-    futures[jobctr] = pool.submit(processLine,line, colsPerDataset, minNrObservationsPerDataset)
-    jobctr += 1
-    if jobctr == nrJobs:
-        for future in futures:
-            write, outln = future.result()
-            if write:
-                fhoPsiFiltered.write(outln+"\n")
-                written += 1
-        jobctr = 0
-        # print(availableDatasets[d]+"\t"+str(mean)+"\t"+str(stdev)+"\t"+str(len(cols)) +"\t"+str(nrNotMissing) +"\t"+str(nrDatasetsPassingQC) +"\t"+str(dsMinNrObs)) 
-    
-    lctr += 1
-    if lctr % 1000 == 0:
-        perc = (written / lctr)*100
-        print(f"{lctr} lines parsed, {written} written, {f(perc)} %",end='\r')
-if jobctr > 0:
-    for i in range(0, jobctr):
-        write, outln = futures[i].result()
-        if write:
-            fhoPsiFiltered.write(outln+"\n")
-            written += 1
+    lines.append(line)
+    if len(lines) == blockSize:
+        futures.append(pool.submit(processBlock, lines, colsPerDataset, minNrObservationsPerDataset))
+        lines = []
+        if len(futures) == 2 * threads:
+            writeResult(futures.pop(0))
+if len(lines) > 0:
+    futures.append(pool.submit(processBlock, lines, colsPerDataset, minNrObservationsPerDataset))
+for future in futures:
+    writeResult(future)
 
 perc = (written / lctr)*100
 print(f"{lctr} lines parsed, {written} written, {f(perc)} %",end='\n')
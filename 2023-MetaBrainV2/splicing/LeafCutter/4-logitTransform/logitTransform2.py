@@ -12,31 +12,43 @@ if len(sys.argv) < 3:
 psiFile = sys.argv[1]
 outfileLogit = sys.argv[2]
 
-def logit(v):
-    if numpy.isnan(v):
-        return numpy.nan
-    if v < 1e-16:
-        v = 1e-16
-    if v > (1 - 1e-16):
-        v = 1 - 1e-16
-    v = math.log(v / (1-v))
-    return v
+def parseValue(elem):
+	try:
+		return float(elem)
+	except:
+		# print("error parsing: "+elem)
+		return numpy.nan
 
-def processLine(line):
-	elems = line.strip().split("\t")
-	outln = elems[0]
-	ectr = 0
-	for elem in elems:
-		if ectr > 0:
-			try:
-				v = float(elem)
-				v = logit(v)
-				outln +="\t"+str(v)
-			except:
-				# print("error parsing: "+elem)
-				outln+="\t"+str(numpy.nan)
-		ectr+=1
-	return outln
+def logitBlock(values):
+	# clipped logit of a float array. The log itself is math.log mapped over the values: numpy.log
+	# differs from it in the last bit for some values, and the output should not change.
+	p = numpy.clip(values, 1e-16, 1 - 1e-16)
+	return list(map(math.log, (p / (1 - p)).tolist()))
+
+def processBlock(lines):
+	# transforms a block of lines at once; returns the output lines
+	rowids = []
+	lengths = []
+	tokens = []
+	for line in lines:
+		elems = line.strip().split("\t")
+		rowids.append(elems[0])
+		lengths.append(len(elems) - 1)
+		tokens += elems[1:]
+	try:
+		values = numpy.array(tokens, dtype=numpy.float64)
+	except ValueError:
+		values = numpy.array([parseValue(elem) for elem in tokens], dtype=numpy.float64)
+	strs = list(map(str, logitBlock(values)))
+	outlns = []
+	offset = 0
+	for rowid, length in zip(rowids, lengths):
+		if length > 0:
+			outlns.append(rowid+"\t"+"\t".join(strs[offset:offset + length]))
+		else:
+			outlns.append(rowid)
+		offset += length
+	return outlns
 
 fh = gzip.open(psiFile,'rt')
 fho = gzip.open(outfileLogit,'wt',5)
@@ -45,31 +57,33 @@ header[0] = "-"
 fho.write("\t".join(header))
 lctr = 0
 
+# blocks of lines are transformed on the pool; results are written in input order
 threads = 10
+blockSize = 1000
 pool = ProcessPoolExecutor(max_workers=threads)
-nrJobs = 5000
-futures = [None] * nrJobs
-print(f"{len(futures)} nr futures")
-jobctr = 0
+futures = []
+def writeResult(future):
+	for outln in future.result():
+		fho.write(outln+"\n")
+
+lines = []
 for line in fh:
-	futures[jobctr] = pool.submit(processLine, line)
-	jobctr += 1
-	
-	if jobctr == nrJobs:
-		for future in futures:
-			outln = future.result()
-			fho.write(outln+"\n")
-		jobctr = 0
+	lines.append(line)
+	if len(lines) == blockSize:
+		futures.append(pool.submit(processBlock, lines))
+		lines = []
+		if len(futures) == 2 * threads:
+			writeResult(futures.pop(0))
 	lctr += 1
 	if lctr % 1000 == 0:
 		print("{} lines parsed ".format(lctr), end='\r', flush=True)
 
-if jobctr > 0:
-    for i in range(0, jobctr):
-        outln = futures[i].result()
-        fho.write(outln+"\n")
+if len(lines) > 0:
+	futures.append(pool.submit(processBlock, lines))
+for future in futures:
+	writeResult(future)
 print("{} lines parsed - done".format(lctr), end='\n')
 
 fho.close()
 fh.close()
-
+pool.shutdown()
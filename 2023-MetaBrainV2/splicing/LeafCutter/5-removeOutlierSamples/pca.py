@@ -4,17 +4,21 @@ import pandas as pd
 import seaborn as sns
 import matplotlib
 import matplotlib.pyplot as plt
-import scipy.stats
 import numpy
-import multiprocessing
-from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
 from sklearn.decomposition import PCA
 
+path = str(Path(__file__).parent.parent.parent.parent.absolute().__str__() + "/library/")
+sys.path.insert(0, path)
+
+from correlation import pairwiseCorrelation, saveCorrelationMatrix
+
 matplotlib.use('Agg')
 
 if len(sys.argv) < 3:
     print("Usage: infile outprefix npcs [threads:1] [subsample:1.0]")
+    print("Writes the correlation matrix to outprefix_corrmat.npz, which can be used as infile for pcaFromCorrMat.py")
     sys.exit(0)
 
 file = sys.argv[1]
@@ -28,32 +32,6 @@ if len(sys.argv) > 4:
     subsample = float(sys.argv[5])
 
 
-def corr(x, y):
-    xtmp = []
-    ytmp = []
-
-    for i in range(0,len(x)):
-        if not numpy.isnan(x[i]) and not numpy.isnan(y[i]):
-            xtmp.append(x[i])
-            ytmp.append(y[i])
-
-    if len(xtmp) == 0:
-        return 0
-    result = scipy.stats.pearsonr(xtmp,ytmp)
-    return result.statistic
-
-def processI(i, df):
-    x = df.iloc[:, i].values
-    corrs = [0] *  len(df.columns)
-    for j in range(i+1,len(df.columns)):
-        y = df.iloc[:, j].values
-    
-        r = corr(x,y)
-        # print(f"{i}\t{j}\t{r}")
-        corrs[j] = r
-    return corrs
-
-
 print("parsing "+file)
 sys.stdout.flush()
 # pandas weirdness..
@@ -76,31 +54,11 @@ print(f"Correlating.. {len(df.columns)} x {len(df.columns)}")
 # cormat = df.corr()
 # cormat = cormat.fillna(0)
 
-
-pool = ProcessPoolExecutor(max_workers=threads)
-
-futures = [None] * len(df.columns)
-for i in range(0,len(df.columns)):
-    futures[i] = pool.submit(processI,i,df)
-
-returned = 0
-cormat = [0] * len(df.columns)
-for i in range(0,len(df.columns)):
-    result = futures[i].result()
-    cormat[i] = result
-    # print(result)
-    # sys.exit()
-    returned+=1
-    print(f"{returned} / {len(df.columns)}]",end='\r')
-    sys.stdout.flush()
-print(f"{returned} / {len(df.columns)}]",end='\n')
+# pairwise complete correlations (pairs without a defined correlation are set to 0)
+cormat = pairwiseCorrelation(df.values, tilesize=1000, threads=threads)
+saveCorrelationMatrix(outprefix+"_corrmat.npz", cormat, list(df.columns))
+print(f"Correlation matrix written to {outprefix}_corrmat.npz")
 sys.stdout.flush()
-print()
-
-for i in range(0,len(df.columns)):
-    cormat[i][i] = 1
-    for j in range(i+1,len(df.columns)):
-        cormat[j][i] = cormat[i][j]
 
 cormat = pd.DataFrame(cormat,columns=df.columns,index=df.columns)
 print(cormat)
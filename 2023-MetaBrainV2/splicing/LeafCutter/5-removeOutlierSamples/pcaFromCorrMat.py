@@ -9,8 +9,15 @@ import numpy
 import multiprocessing
 from concurrent.futures import ProcessPoolExecutor
 
+from pathlib import Path
+
 from sklearn.decomposition import PCA
 
+path = str(Path(__file__).parent.parent.parent.parent.absolute().__str__() + "/library/")
+sys.path.insert(0, path)
+
+from correlation import loadCorrelationMatrix
+
 matplotlib.use('Agg')
 
 if len(sys.argv) < 3:
@@ -62,7 +69,12 @@ sys.stdout.flush()
 # fh.close()
 
 # df = pd.read_csv(file, sep='\t',header = None,skiprows=[0])
-df = pd.read_csv(file, sep='\t',index_col=0)
+if file.endswith(".npz"):
+    # correlation matrix written by pca.py
+    cor, names = loadCorrelationMatrix(file)
+    df = pd.DataFrame(cor, columns=names, index=names)
+else:
+    df = pd.read_csv(file, sep='\t',index_col=0)
 print("Read matrix: {} x {}".format(df.shape[0], df.shape[1]))
 
 
@@ -3,12 +3,21 @@ import gzip
 import pandas as pd
 import numpy as np
 import statsmodels.api as sm
-from statsmodels.tools.sm_exceptions import PerfectSeparationError
-from numpy.linalg import LinAlgError
+import time
 
 import cProfile
 import pstats
 profiler = cProfile.Profile()
+profiler.enable()
+
+# time spent per stage, reported at the end together with the profile
+stageTimes = {}
+stageStart = time.time()
+def endStage(stage):
+    global stageStart
+    now = time.time()
+    stageTimes[stage] = stageTimes.get(stage, 0) + (now - stageStart)
+    stageStart = now
 
 if len(sys.argv) < 4:
     print("Usage: splicefile covfile pcafile [number_of_columns_to_use_in_pcafile] outfile_residuals.txt.gz")
@@ -47,21 +56,9 @@ dfCov = pd.concat([dfCov, dfPCA], axis=1)
 print("merged size", dfCov.shape[0])
 print("nr of cov after merge:", dfCov.shape[1])
 print(dfCov)
+endStage("load")
 
-
-sampleMap = {}
-sampleList = []
-sampleCount = 0
-for sample in dfSplice.index:
-    sampleMap[sample] = sampleCount
-    sampleList.append(sample)
-    sampleCount = sampleCount + 1
-
-# iterate splice events
-fCount = 0
-lCount = 0
-eCount = 0
-wCount = 0
+sampleList = list(dfSplice.index)
 
 
 def checkColinearity(covariates):
@@ -102,47 +99,71 @@ def checkColinearity(covariates):
     return tmp
 
 
+def covariateBasis(covariates):
+    # orthonormal basis Q of a constant plus the covariates (as sm.add_constant + OLS), factorised
+    # once per group of events; the OLS residuals of the columns of Y are Y - Q Q'Y
+    X = np.column_stack([np.ones(len(covariates)), covariates])
+    Q, _ = np.linalg.qr(X)
+    return Q
+
+
+def residualize(Y, Q):
+    return Y - Q @ (Q.T @ Y)
+
+
 outfhResiduals = gzip.open(outfileResiduals, 'wt')
 outfhResiduals.write("-\t" + "\t".join(sampleList) + "\n")
 
 dfCov = checkColinearity(dfCov)
 print(dfCov.shape)
+endStage("covariate collinearity")
+
+# group the splice events by their pattern of non-missing samples: all events in a group share
+# their covariate matrix, which is pruned with checkColinearity (the same rule as per event before)
+# and factorised once per group
+values = dfSplice.to_numpy(dtype=np.float64, copy=True)
+present = ~np.isnan(values)
+patterns, patternOfEvent = np.unique(np.packbits(present, axis=0), axis=1, return_inverse=True)
+patternOfEvent = patternOfEvent.reshape(-1)
+eventsPerPattern = np.split(np.argsort(patternOfEvent, kind="stable"), np.cumsum(np.bincount(patternOfEvent))[:-1])
+print("{} events, {} patterns of non-missing samples".format(values.shape[1], len(eventsPerPattern)), flush=True)
+endStage("group events")
 
-for event in dfSplice:
-    psi = dfSplice[[event]]
-    nonna = psi.dropna(how='any')
-    if nonna.empty:
+eCount = 0
+lastReported = 0
+chunkSize = 10000
+for events in eventsPerPattern:
+    rows = np.flatnonzero(present[:, events[0]])
+    eCount += len(events)
+    if len(rows) == 0:
         continue
-    shape = nonna.shape
-    outputResiduals = [np.nan] * len(psi)
-
-    logitY = round(nonna[event])
-    logitY = np.array(logitY)
-    covars = dfCov.reindex(nonna.index)
-    covars = checkColinearity(covars)
-    X = covars.to_numpy()
-    X = sm.add_constant(X)
-
-    try:
-        ols = sm.OLS(logitY, X)
-        olsResults = ols.fit(disp=0)
-        residuals = olsResults.resid
-        idx = nonna.index
-        for i in range(0, len(residuals)):
-            actidx = sampleMap.get(idx[i])
-            outputResiduals[actidx] = residuals[i]
-        strout = "\t".join(str(v) for v in outputResiduals)
-        outln = event + "\t"+strout+"\n"
-        outfhResiduals.write(outln)
-        wCount = wCount + 1
-    except PerfectSeparationError:
-        fCount = fCount + 1
-    except LinAlgError:
-        lCount = lCount + 1
-
-    eCount = eCount + 1
-    if eCount % 50 == 0:
-        print("{} lines processed, {} failed, {} linalg errors, {} written".format(eCount, fCount, lCount, wCount))
+    covariates = checkColinearity(dfCov.iloc[rows]).to_numpy(dtype=np.float64)
+    Q = covariateBasis(covariates)
+    endStage("factorise covariates")
+    for c in range(0, len(events), chunkSize):
+        chunk = events[c:c + chunkSize]
+        # as before, the values are rounded before fitting
+        Y = np.round(values[np.ix_(rows, chunk)])
+        values[np.ix_(rows, chunk)] = residualize(Y, Q)
+    endStage("residuals")
+    if eCount - lastReported >= 1000:
+        print("{} events processed".format(eCount), flush=True)
+        lastReported = eCount
 
+wCount = 0
+for e, event in enumerate(dfSplice.columns):
+    if not present[:, e].any():
+        continue
+    strout = "\t".join(map(str, values[:, e].tolist()))
+    outfhResiduals.write(event + "\t" + strout + "\n")
+    wCount = wCount + 1
 outfhResiduals.close()
+endStage("write")
+print("{} events processed, {} written".format(eCount, wCount))
+
+profiler.disable()
+print("Time per stage:")
+for stage in stageTimes:
+    print("{}\t{:.2f}s".format(stage, stageTimes[stage]))
+pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
 print("Done")
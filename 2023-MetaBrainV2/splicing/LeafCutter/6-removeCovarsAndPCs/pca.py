@@ -4,7 +4,11 @@ import seaborn as sns
 import matplotlib
 import matplotlib.pyplot as plt
 
-from sklearn.decomposition import PCA
+from pathlib import Path
+
+path = str(Path(__file__).parent.parent.parent.parent.absolute().__str__() + "/library/")
+sys.path.insert(0, path)
+from decomposition import PCA
 
 matplotlib.use('Agg')
 
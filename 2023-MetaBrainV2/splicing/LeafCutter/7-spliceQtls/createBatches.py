@@ -3,6 +3,15 @@ import sys
 import os
 import glob
 import argparse
+import heapq
+import math
+from pathlib import Path
+
+import numpy as np
+
+path = str(Path(__file__).parent.parent.parent.parent.absolute().__str__() + "/library/")
+sys.path.insert(0, path)
+from parsers.TabixIndex import TabixIndex
 
 
 def gzopen(file):
@@ -39,6 +48,16 @@ parser.add_argument("--template", dest="template",
 parser.add_argument("--nrgenes", dest="nrgenes",
 	help="Nr Genes per batch", default=200)
 
+parser.add_argument("--plan", dest="plan",
+	help="balanced: distribute genes/groups over batches by predicted cost (cis-window variants); sequential: fill batches with nrgenes genes in annotation order",
+	choices=["balanced", "sequential"], default="balanced")
+
+parser.add_argument("--ciswindow", dest="ciswindow",
+	help="Cis window used to predict the cost of a gene", default=1000000)
+
+parser.add_argument("--testspersecond", dest="testspersecond",
+	help="Measured number of variant-gene tests per second, to predict runtimes in seconds")
+
 parser.add_argument("--outdir", dest="out",
 	help="Output directory", required=True)
 
@@ -68,6 +87,11 @@ annotation = args["annotation"]
 groupsfile = args["groupsfile"]
 template = args["template"]
 nrgenes = int(args["nrgenes"])
+plan = args["plan"]
+ciswindow = int(args["ciswindow"])
+testspersecond = args["testspersecond"]
+if testspersecond is not None:
+	testspersecond = float(testspersecond)
 out = args["out"]
 
 os.makedirs(out, exist_ok=True)
@@ -156,6 +180,7 @@ print("Annotation: " + annotation)
 fh = gzopen(annotation)
 fh.readline()
 genesPerChr = {}
+coordsPerChr = {}
 annotread = 0
 for line in fh:
     elems = line.strip().split("\t")
@@ -167,8 +192,10 @@ for line in fh:
             chrgenes = genesPerChr.get(chr)
             if chrgenes is None:
                 chrgenes = []
+                coordsPerChr[chr] = []
             chrgenes.append(gene)
             genesPerChr[chr] = chrgenes
+            coordsPerChr[chr].append((pos, int(elems[5])))
             annotread = annotread + 1
 fh.close()
 print("Annotation read for {} genes/features".format(annotread))
@@ -204,132 +231,175 @@ for chr in genesPerChr.keys():
 	chrs.append(chr)
 chrs.sort()
 
-#for chr in genesPerChr.keys():
-for chr in chrs:
-	print("Writing batches for chr: "+str(chr))
+# number of variants in the cis window of each gene, estimated from the tabix index of the VCF
+# without reading it, and the cis-window lengths. Without an index, or when the chromosome is not in
+# the index, the counts are None.
+def predictVariantCounts(chr):
+	coords = np.array(coordsPerChr.get(chr), dtype=np.int64)
+	starts = np.maximum(coords[:, 0] - ciswindow, 0)
+	ends = coords[:, 1] + ciswindow
+	chrgenotype = genotype.replace("CHR", str(chr))
+	indexfile = TabixIndex.find(chrgenotype)
+	if indexfile is None:
+		print("No tabix index for "+chrgenotype+", estimating variant counts from cis-window length")
+		return None, ends - starts
+	counts = TabixIndex(indexfile).estimateCounts(chr, starts, ends)
+	if counts is None:
+		print("Chromosome "+str(chr)+" not in tabix index "+indexfile+", estimating variant counts from cis-window length")
+	return counts, ends - starts
+
+# predicted cost of each gene: the number of variants in its cis window plus one for the per-gene
+# overhead. For chromosomes without an index, the cis-window length times the mean variant density
+# of the indexed chromosomes is used, so all costs are in the same unit (without any index: the
+# cis-window length in kb).
+def predictGeneCosts(chrs):
+	counts = {}
+	lengths = {}
+	for chr in chrs:
+		counts[chr], lengths[chr] = predictVariantCounts(chr)
+	indexed = [chr for chr in chrs if counts[chr] is not None]
+	if len(indexed) > 0:
+		density = sum(counts[chr].sum() for chr in indexed) / sum(lengths[chr].sum() for chr in indexed)
+	else:
+		density = 1 / 1000
+	if len(indexed) < len(chrs):
+		print("Variant density of indexed chromosomes: {:.3f} per kb".format(density * 1000))
+	geneCostsPerChr = {}
+	for chr in chrs:
+		costs = counts[chr] if counts[chr] is not None else lengths[chr] * density
+		geneCostsPerChr[chr] = dict(zip(genesPerChr.get(chr), (costs + 1).tolist()))
+	return geneCostsPerChr
+
+def groupsOnChromosome(chr):
+	chrgenes = genesPerChr.get(chr)
+	groupsOnChr = set()
+	ok = True
+	for gene in chrgenes:
+		grp = geneToGroup.get(gene)
+		if grp is None:
+			print("Error: groups defined, but "+gene+" not in a group")
+			ok = False
+		else:
+			groupsOnChr.add(grp)
+	if not ok:
+		sys.exit(0)
+	print("{} groups for chr {}".format(len(groupsOnChr), chr))
+	groupsOnChrArr = []
+	for grp in groupsOnChr:
+		groupsOnChrArr.append(grp)
+	groupsOnChrArr.sort()
+	return groupsOnChrArr
+
+# units of work on a chromosome, and their names: the genes of a group stay together in one batch
+def chromosomeItems(chr):
 	if groups is not None:
-		bctr = 1
-		gctr = 0
-		bgctr = 0
-	
-		chrgenes = genesPerChr.get(chr)
-
-		# determine groups on this chromosome
-		groupsOnChr = set()
-		ok = True
-		for gene in chrgenes:
-			grp = geneToGroup.get(gene)
-			if grp is None:
-				print("Error: groups defined, but "+gene+" not in a group")
-				ok = False
-			else:
-				groupsOnChr.add(grp)
-		if not ok:
-			sys.exit(0)
-		print("{} groups for chr {}".format(len(groupsOnChr), chr))
-		groupsOnChrArr = []
-		for grp in groupsOnChr:
-			groupsOnChrArr.append(grp)
-		groupsOnChrArr.sort()
-
-		# write the first job
-		batchname = "chr"+str(chr)+"-batch-"+str(bctr)
-		batchfile = abspath+"/batches/"+batchname+".txt"
-		jobfile = abspath+"/jobs/"+batchname+".sh"
-		outprefix = abspath+"/output/"+batchname
-		logprefix = abspath+"/logs/"+batchname
-		chrgenotype = genotype.replace("CHR", str(chr))
-		jobname = batchnameprefix +"-"+batchname
-		writeJob(expfile, gte, chrgenotype, template, batchfile, jobfile, outprefix, logprefix, chr, annotation, groupsfile, jobname)
-		bgout = open(batchfile, 'w')
-
-		grpctr = 0
-		while grpctr < len(groupsOnChrArr):
-			currentGroup = groupsOnChrArr[grpctr]
-			currentGroupGenes = groups.get(currentGroup)
-
-			# write all genes of this group into batch
-			for gene in currentGroupGenes:
-				bgout.write(gene+"\n")
-				bgctr += 1
-			grpctr += 1
-			# check if there is a next group
-			if grpctr < len(groupsOnChrArr):
-				nextgrp = groupsOnChrArr[grpctr]
-				nextgrpGenes = groups.get(nextgrp)
-				# check if this would overflow the batch
-				if bgctr >= nrgenes or bgctr + len(nextgrpGenes) >= nrgenes:
-					# if so, close thecurrent batch.. and 
-					bgout.close()
-
-					# start a new batch
-					bctr += 1
-
-					batchname = "chr"+str(chr)+"-batch-"+str(bctr)
-					batchfile = abspath+"/batches/"+batchname+".txt"
-					# print a warning if next batch is large!
+		grps = groupsOnChromosome(chr)
+		return grps, [list(groups.get(grp)) for grp in grps]
+	chrgenes = genesPerChr.get(chr)
+	return chrgenes, [[gene] for gene in chrgenes]
+
+# batches of at most nrgenes + 1 genes in annotation order; with groups, a batch is closed when
+# adding the next group would reach nrgenes
+def planSequential(chr, names, items):
+	batches = [[]]
+	if groups is None:
+		for item in items:
+			batches[-1].extend(item)
+			if len(batches[-1]) > nrgenes:
+				batches.append([])
+	else:
+		for i in range(len(items)):
+			batches[-1].extend(items[i])
+			if i + 1 < len(items):
+				nextgrp, nextgrpGenes = names[i + 1], items[i + 1]
+				if len(batches[-1]) >= nrgenes or len(batches[-1]) + len(nextgrpGenes) >= nrgenes:
 					if len(nextgrpGenes) > nrgenes:
-						print("Warning: group "+nextgrp+" will have a large batch: n="+str(len(nextgrpGenes))+ " - "+batchfile)
-
-					jobfile = abspath+"/jobs/"+batchname+".sh"
-					outprefix = abspath+"/output/"+batchname
-					logprefix = abspath+"/logs/"+batchname
-					chrgenotype = genotype.replace("CHR", str(chr))	
-					jobname = batchnameprefix +"-"+batchname
-					writeJob(expfile, gte, chrgenotype, template, batchfile, jobfile, outprefix, logprefix, chr, annotation, groupsfile, jobname)
-					bgout = open(batchfile, 'w')
-					bgctr = 0
-			print("Writing group: {}".format(grpctr), end='\r')
-		# close current batch, if any
-		if not bgout.closed:
-			bgout.close()
-		print()
-		print("Done with chr {}".format(chr))
+						print("Warning: group "+nextgrp+" will have a large batch: n="+str(len(nextgrpGenes))+ " - chr"+str(chr)+"-batch-"+str(len(batches) + 1))
+					batches.append([])
+	return batches
+
+# longest processing time first: items in decreasing cost, each to the batch with the lowest
+# predicted cost so far; items keep their annotation order within a batch
+def planBalanced(items, itemCosts, nrbatches):
+	nrbatches = max(1, min(nrbatches, len(items)))
+	heap = [(0.0, b) for b in range(nrbatches)]
+	assigned = [[] for _ in range(nrbatches)]
+	for i in sorted(range(len(items)), key=lambda i: -itemCosts[i]):
+		load, b = heapq.heappop(heap)
+		assigned[b].append(i)
+		heapq.heappush(heap, (load + itemCosts[i], b))
+	batches = []
+	for b in range(nrbatches):
+		batch = []
+		for i in sorted(assigned[b]):
+			batch.extend(items[i])
+		batches.append(batch)
+	return batches
+
+namesPerChr = {}
+itemsPerChr = {}
+costsPerChr = {}
+geneCostsPerChr = {}
+if plan == "balanced":
+	geneCostsPerChr = predictGeneCosts(chrs)
+for chr in chrs:
+	namesPerChr[chr], itemsPerChr[chr] = chromosomeItems(chr)
+	if plan == "balanced":
+		geneCosts = geneCostsPerChr[chr]
+		costsPerChr[chr] = [sum(geneCosts.get(gene, 1) for gene in item) for item in itemsPerChr[chr]]
+		print("chr {}: {} genes/features, predicted {:.0f} tests".format(chr, len(genesPerChr.get(chr)), sum(costsPerChr[chr])))
+
+# the same total number of batches as nrgenes per batch would give, divided over the chromosomes
+# by predicted cost
+targetcost = None
+if plan == "balanced":
+	totalcost = sum(sum(costsPerChr[chr]) for chr in chrs)
+	totalbatches = sum(max(1, math.ceil(len(genesPerChr.get(chr)) / nrgenes)) for chr in chrs)
+	targetcost = totalcost / totalbatches
+	print("Target predicted cost per batch: {:.0f} tests".format(targetcost))
+
+manifest = []
+for chr in chrs:
+	print("Writing batches for chr: "+str(chr))
+	items = itemsPerChr[chr]
+	if plan == "balanced":
+		costs = costsPerChr[chr]
+		batches = planBalanced(items, costs, math.ceil(sum(costs) / targetcost))
+		geneCosts = geneCostsPerChr[chr]
+		for i in range(len(items)):
+			if costs[i] > targetcost:
+				print("Warning: "+("group " if groups is not None else "")+namesPerChr[chr][i]+" alone exceeds the target batch cost")
 	else:
-		# no groups defined	
-		print("No groups defined. Writing jobs")
-		bctr = 1
-		gctr = 0
-		bgctr = 0
-	
-		chrgenes = genesPerChr.get(chr)
-
-		# write the first job
-		batchname = "chr"+str(chr)+"-batch-"+str(bctr)
+		batches = planSequential(chr, namesPerChr[chr], items)
+		geneCosts = {}
+
+	chrgenotype = genotype.replace("CHR", str(chr))
+	for b in range(len(batches)):
+		batchname = "chr"+str(chr)+"-batch-"+str(b + 1)
 		batchfile = abspath+"/batches/"+batchname+".txt"
 		jobfile = abspath+"/jobs/"+batchname+".sh"
 		outprefix = abspath+"/output/"+batchname
 		logprefix = abspath+"/logs/"+batchname
-		chrgenotype = genotype.replace("CHR", str(chr))
 		jobname = batchnameprefix +"-"+batchname
 		writeJob(expfile, gte, chrgenotype, template, batchfile, jobfile, outprefix, logprefix, chr, annotation, groupsfile, jobname)
 		bgout = open(batchfile, 'w')
-		while gctr < len(chrgenes):
-			gene = chrgenes[gctr]
+		for gene in batches[b]:
 			bgout.write(gene+"\n")
-			bgctr = bgctr + 1
-			# batch is overflowing
-			if bgctr > nrgenes:
-				# close old batch
-				bgout.close()
-
-				# create new batch
-				bctr += 1
-				batchname = "chr"+str(chr)+"-batch-"+str(bctr)
-				batchfile = abspath+"/batches/"+batchname+".txt"
-				jobfile = abspath+"/jobs/"+batchname+".sh"
-				outprefix = abspath+"/output/"+batchname
-				logprefix = abspath+"/logs/"+batchname
-				chrgenotype = genotype.replace("CHR", str(chr))
-				jobname = batchnameprefix +"-"+batchname
-				writeJob(expfile, gte, chrgenotype, template, batchfile, jobfile, outprefix, logprefix, chr, annotation, groupsfile, jobname)
-				bgout = open(batchfile, 'w')
-				bgctr = 0
-			gctr += 1
-
-		# close current batch, if any
-		if not bgout.closed:
-			bgout.close()
+		bgout.close()
+		if plan == "balanced":
+			manifest.append((batchname, chr, len(batches[b]), sum(geneCosts.get(gene, 1) for gene in batches[b])))
+	print("Done with chr {}: {} batches".format(chr, len(batches)))
+
+# predicted runtime per batch, relative to the largest batch (and in seconds with --testspersecond)
+if plan == "balanced" and len(manifest) > 0:
+	maxcost = max(cost for _, _, _, cost in manifest)
+	fho = open(abspath+"/predicted-runtimes.txt", 'w')
+	fho.write("Batch\tChr\tNrGenes\tPredictedTests\tRelativeRuntime\tPredictedSeconds\n")
+	for batchname, chr, n, cost in manifest:
+		seconds = "-" if testspersecond is None else "{:.0f}".format(cost / testspersecond)
+		fho.write("{}\t{}\t{}\t{:.0f}\t{:.3f}\t{}\n".format(batchname, chr, n, cost, cost / maxcost if maxcost > 0 else 0, seconds))
+	fho.close()
+	print("Predicted runtimes written to: "+abspath+"/predicted-runtimes.txt")
 print()
 print("Done creating batches")
 print()